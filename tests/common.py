@@ -0,0 +1,42 @@
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from yoyo66.datastruct import phmImage, Layer
+
+def create_sample_image(filepath : str,
+    dimension : tuple = (120, 160),
+    crack : tuple = np.s_[10:20, 30:90],
+    surf : tuple = np.s_[60:100, 20:50]
+) -> phmImage:
+    """Create a multi-layer image with a random original image and rectangular masks (Crack and SurfDeg).
+
+    Args:
+        filepath (str): the file path of the image
+        dimension (tuple, optional): the size of the image (height, width). Defaults to (120, 160).
+        crack (tuple, optional): the region of the crack mask. Defaults to np.s_[10:20, 30:90].
+        surf (tuple, optional): the region of the surface degradation mask, None for an image without it. Defaults to np.s_[60:100, 20:50].
+
+    Returns:
+        phmImage: the multi-layer image
+    """
+    orig = np.random.randint(0, 255, tuple(dimension) + (3,), dtype=np.uint8)
+    crack_mask = np.zeros(dimension, dtype=np.int8)
+    crack_mask[crack] = 1
+    layers = [Layer('Crack', class_id=100, image=crack_mask)]
+    if surf is not None:
+        surf_mask = np.zeros(dimension, dtype=np.int8)
+        surf_mask[surf] = 1
+        layers.append(Layer('SurfDeg', class_id=120, image=surf_mask))
+    return phmImage(
+        filepath = filepath,
+        properties = {'altitudes' : '12312.123', 'test' : 'yoohooo'},
+        metrics = {'iou' : 0.78, 'f1' : 0.542},
+        orig_image = orig,
+        layers = layers
+    )
@@ -1,8 +1,11 @@
 
 import os
 import sys
+import tempfile
 import unittest
 
+import numpy as np
+
 sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
@@ -11,7 +14,7 @@ import yoyo66.handler
 from yoyo66.datastruct import phmImage, Layer
 from yoyo66.handler.pkg import PKGFileHandler
 from yoyo66.handler.core import build_by_name
-from yoyo66.utils import ConvertHandler, build_converter, convert_file__
+from yoyo66.utils import ConvertHandler, build_converter, convert_file__, create_container
 
 class Convert_Test(unittest.TestCase):
 
@@ -23,6 +26,27 @@ class Convert_Test(unittest.TestCase):
             dest_file = desfile, 
             categories = {'Crack' : 100, 'SurfDeg' : 200}
         )
+    def test_create_container(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            files = []
+            for index in range(2):
+                crack = np.zeros((20, 30), dtype=np.int8)
+                crack[index:10, 5:15] = 1
+                file = os.path.join(tmpdir, f'sample_{index}.pkg')
+                build_by_name('pkg').save(phmImage(
+                    filepath = file,
+                    properties = {},
+                    orig_image = np.zeros((20, 30, 3), dtype=np.uint8),
+                    layers = [Layer('Crack', class_id=100, image=crack)]
+                ), file)
+                files.append(file)
+            dest = os.path.join(tmpdir, 'dataset.h5')
+            self.assertEqual(list(create_container(files, dest)), [(True, f) for f in files])
+            # The images already in the container are skipped
+            self.assertEqual(list(create_container(files[:1], dest)), [(True, files[0])])
+            with build_by_name('h5').open_container(dest) as container:
+                self.assertEqual(container.names, ('sample_0', 'sample_1'))
+                self.assertEqual(container.get(1)['crack'].pixcount(), 90)
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,8 +3,11 @@ import os
 import sys
 import unittest
 
+from unittest import mock
+
 from pyora import Project, TYPE_LAYER, TYPE_GROUP
 from PIL import Image
+from gimpformats.gimpXcfDocument import GimpDocument
 import numpy as np
 
 sys.path.append(os.getcwd())
@@ -31,6 +34,36 @@ class GIMP_Test(unittest.TestCase):
         print(img)
         img.get_stats({'Crack' : 100, 'SurfDeg' : 200})
         
+    def test_peek(self):
+        gimp = build_by_name('gimp', ['Crack', 'SurfDeg'])
+        info = gimp.peek(self.file)
+        img = gimp.load(self.file)
+        self.assertEqual(info.dimension, img.dimension)
+        self.assertEqual(info.layer_names, img.layer_names)
+        self.assertEqual([layer.dimension for layer in info.layers], [layer.dimension for layer in img.layers])
+        
+    def test_filtered_load(self):
+        full = build_by_name('gimp').load(self.file)
+        img = build_by_name('gimp', ['Crack']).load(self.file)
+        # The filter is matched against the normalized layer names
+        self.assertEqual(img.layer_names, ('crack',))
+        np.testing.assert_array_equal(img['crack'].image, full['crack'].image)
+
+    def test_peek_without_alpha(self):
+        # The layers without alpha channel are not mask layers, the crack layer of the file is read as a RGB layer
+        def read(filepath):
+            gimp = GimpDocument(filepath)
+            for layer in (gimp.raw_layers if hasattr(gimp, 'raw_layers') else gimp.layers):
+                if layer.name == 'Crack':
+                    layer.colorMode = 0
+            return gimp
+        gimp = build_by_name('gimp')
+        with mock.patch('yoyo66.handler.gimp.GimpDocument', side_effect = read):
+            info = gimp.peek(self.file)
+            img = gimp.load(self.file)
+        self.assertEqual(img.layer_names, ('surfdeg',))
+        self.assertEqual(info.layer_names, img.layer_names)
+
     def test_blend_and_thumbnail(self):
         file = "tests/resources/gimp_1.xcf"
         gimp = build_by_name('gimp', {'Crack' : 100, 'SurfDeg' : 200})
@@ -2,9 +2,13 @@
 import os
 import sys
 import time
+import tempfile
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+
 from PIL import Image
+import h5py as hp
 import numpy as np
 
 sys.path.append(os.getcwd())
@@ -12,8 +16,9 @@ sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from yoyo66.datastruct import phmImage, Layer, from_image
-from yoyo66.handler.hfive import H5FileHandler
+from yoyo66.handler.hfive import H5FileHandler, H5Image
 from yoyo66.handler.core import build_by_name
+from tests.common import create_sample_image
 
 class H5_Test(unittest.TestCase):
 
@@ -26,6 +31,141 @@ class H5_Test(unittest.TestCase):
         et = time.time() * 1000
         print('Execution time:', et - st, 'miliseconds')
 
+    def test_peek(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.h5')
+            img = create_sample_image(file)
+            handler = build_by_name('h5')
+            handler.save(img, file)
+            info = handler.peek(file)
+            self.assertEqual(info.dimension, (120, 160))
+            self.assertEqual(info.layer_names, ('crack', 'surfdeg'))
+            self.assertEqual(info.layers[0].dimension, (120, 160))
+            self.assertGreater(info.layers[0].size, 0)
+            self.assertEqual(info.properties['altitudes'], '12312.123')
+            self.assertAlmostEqual(info.metrics['iou'], 0.78)
+
+    def test_lazy_chunked(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.h5')
+            img = create_sample_image(file, (300, 400), crack = np.s_[10:20, 30:390])
+            crack = img['crack'].image
+            for compression in ('gzip', 'lzf', None):
+                build_by_name('h5', compression = compression, chunk_size = 128).save(img, file)
+                with hp.File(file, 'r') as fin:
+                    dataset = fin['layers/crack']
+                    self.assertEqual((dataset.shape, dataset.dtype, dataset.chunks), ((300, 400), np.uint8, (128, 128)))
+                    self.assertEqual(dataset.compression, compression)
+                    self.assertEqual(fin['original'].chunks, (128, 128, 3))
+
+                loaded = build_by_name('h5', lazy = True).load(file)
+                self.assertFalse(any(layer.is_loaded() for layer in loaded))
+                self.assertIsInstance(loaded['crack'].source, H5Image)
+                region = loaded.read_region(20, 5, 50, 20)
+                self.assertFalse(any(layer.is_loaded() for layer in loaded))
+                np.testing.assert_array_equal(region['crack'].image, crack[5:25, 20:70])
+                np.testing.assert_array_equal(region.orig_layer.image, img.orig_layer.image[5:25, 20:70])
+                np.testing.assert_array_equal(loaded['crack'].image, crack)
+                # Saving on top of the lazy source
+                build_by_name('h5').save(loaded, file)
+                np.testing.assert_array_equal(build_by_name('h5').load(file)['crack'].image, crack)
+            self.assertRaises(ValueError, build_by_name, 'h5', compression = 'zstd')
+
+    def test_threaded_chunks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.h5')
+            img = create_sample_image(file, (300, 400), crack = np.s_[10:20, 30:390])
+            img.orig_layer.image = np.random.randint(0, 4096, (300, 400, 3), dtype=np.uint16)
+            crack = img['crack'].image
+            # The chunks are compressed by the threads and written as raw chunks
+            build_by_name('h5', chunk_size = 128, max_workers = 4).save(img, file)
+            with hp.File(file, 'r') as fin:
+                self.assertEqual(fin['layers/crack'].id.get_num_chunks(), 12)
+                self.assertTrue(fin['original'].shuffle)
+                # The file is readable by hdf5
+                np.testing.assert_array_equal(fin['layers/crack'][()], crack.view(np.uint8))
+                np.testing.assert_array_equal(fin['original'][()], img.orig_layer.image)
+            with ThreadPoolExecutor(max_workers = 4) as executor:
+                loaded = build_by_name('h5', executor = executor).load(file)
+            self.assertEqual(loaded['crack'].image.dtype, np.int8)
+            np.testing.assert_array_equal(loaded['crack'].image, crack)
+            np.testing.assert_array_equal(loaded.orig_layer.image, img.orig_layer.image)
+            # The files written by hdf5 are decompressed by the threads
+            build_by_name('h5', chunk_size = 128).save(img, file)
+            loaded = build_by_name('h5', max_workers = 4).load(file)
+            np.testing.assert_array_equal(loaded['crack'].image, crack)
+            np.testing.assert_array_equal(loaded.orig_layer.image, img.orig_layer.image)
+            # The lazy layers do not keep the executor
+            with ThreadPoolExecutor(max_workers = 4) as executor:
+                loaded = build_by_name('h5', lazy = True, executor = executor).load(file)
+            np.testing.assert_array_equal(loaded['crack'].image, crack)
+            np.testing.assert_array_equal(loaded.orig_layer.image, img.orig_layer.image)
+
+    def test_load_alpha_layers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Older files store the layers as images with alpha channel
+            file = os.path.join(tmpdir, 'legacy.h5')
+            crack = np.zeros((30, 40), dtype=np.int8)
+            crack[10:20, 5:35] = 1
+            with hp.File(file, 'w') as fout:
+                fout.create_dataset('original', data = np.zeros((30, 40, 3), dtype=np.uint8))
+                mask = crack.astype(np.uint8)
+                fout.create_dataset('layers/crack', data = np.stack([mask * 100, mask * 255], axis = -1))
+            img = build_by_name('h5').load(file)
+            self.assertEqual(img['crack'].image.dtype, np.int8)
+            np.testing.assert_array_equal(img['crack'].image, crack)
+            np.testing.assert_array_equal(build_by_name('h5', lazy = True).load(file).read_region(0, 5, 20, 10)['crack'].image, crack[5:15, :20])
+
+    def test_container(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'dataset.h5')
+            samples = []
+            for index in range(3):
+                crack = np.zeros((30 + index, 40), dtype=np.int8)
+                crack[5:10, 2 * index:20] = 1
+                layers = [Layer('Crack', class_id=100, image=crack)]
+                if index == 1:
+                    layers.append(Layer('SurfDeg', class_id=120, image=crack[::-1].copy()))
+                samples.append(phmImage(
+                    filepath = os.path.join(tmpdir, f'sample_{index}.pkg'),
+                    properties = {'index' : index},
+                    orig_image = np.random.randint(0, 255, (30 + index, 40, 3), dtype=np.uint8),
+                    layers = layers
+                ))
+
+            handler = build_by_name('h5')
+            with handler.open_container(file, mode = 'a') as container:
+                for img in samples[:2]:
+                    container.append(img)
+                self.assertRaises(ValueError, container.append, samples[0])
+                # The index in memory is updated by the appends
+                self.assertEqual(container.find('SurfDeg'), [1])
+                self.assertEqual(container.layer_names(0), ('crack',))
+            # Appending to an existing container
+            with handler.open_container(file, mode = 'a') as container:
+                self.assertEqual(container.append(samples[2]), 2)
+
+            with build_by_name('h5', lazy = True).open_container(file) as container:
+                self.assertEqual(len(container), 3)
+                self.assertEqual(container.names, ('sample_0', 'sample_1', 'sample_2'))
+                self.assertEqual(container.dimension(2), (32, 40))
+                self.assertEqual(container.layer_names('sample_1'), ('crack', 'surfdeg'))
+                self.assertEqual(container.layer_names(0), ('crack',))
+                self.assertEqual(container.find('SurfDeg'), [1])
+                self.assertRaises(ValueError, container.append, samples[0])
+                self.assertRaises(KeyError, container.get, 'sample_3')
+                self.assertRaises(IndexError, container.get, 3)
+                img = container['sample_1']
+                self.assertEqual(img.title, 'sample_1')
+                self.assertEqual(img.properties['index'], 1)
+                self.assertFalse(any(layer.is_loaded() for layer in img))
+                self.assertEqual(img.get_stats(), samples[1].get_stats())
+                loaded = list(container)
+            # The lazy images stay valid once the container is closed
+            np.testing.assert_array_equal(loaded[-1]['crack'].image, samples[-1]['crack'].image)
+            np.testing.assert_array_equal(loaded[-1].orig_layer.image, samples[-1].orig_layer.image)
+            self.assertRaises(ValueError, handler.load, file)
+
     def test_save_with_category(self):
         file = "tests/resources/h5_1.h5"
         classes = {'Crack' : 100, 'SurfDeg' : 200}
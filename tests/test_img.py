@@ -1,8 +1,11 @@
 
 import os
 import sys
+import tempfile
 import unittest
 
+from unittest import mock
+
 from pyora import Project, TYPE_LAYER, TYPE_GROUP
 from PIL import Image
 import numpy as np
@@ -11,13 +14,203 @@ sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from yoyo66.datastruct import phmImage, Layer, from_image
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, from_image
 from yoyo66.handler import PKGFileHandler, build_by_name, load_file
 
-from yoyo66.utils import create_from_image
+from yoyo66.utils import create_from_image, calculate_stats
+from tests.common import create_sample_image
+
+# The crack and the surface degradation of the 50 x 70 sample images
+CRACK_REGION = np.s_[5:20, 10:60]
+SURF_REGION = np.s_[10:40, 30:50]
 
 class phmImage_Test(unittest.TestCase):
 
+    def test_stats(self):
+        img = create_sample_image('stats.pkg', (50, 70), CRACK_REGION, SURF_REGION)
+        img.layers.append(Layer('Empty', image=np.zeros((50, 70), dtype=np.int8)))
+        crack, surf = img['crack'].image, img['surfdeg'].image
+        stats = img.get_stats()
+        self.assertEqual(stats['Crack Pixcount'], 750)
+        self.assertEqual(stats['Surfdeg Cover'], 600 / 3500 * 100)
+        self.assertEqual(stats['Mask Cover'], np.count_nonzero(crack | surf) / 3500 * 100)
+        self.assertNotIn('Empty Pixcount', stats)
+
+        counts, covered = img.count_pixels()
+        self.assertEqual(counts, {'crack' : 750, 'surfdeg' : 600, 'empty' : 0})
+        # Precomputed values do not touch the masks
+        for layer in img.layers:
+            layer.image = None
+        self.assertEqual(img.get_stats(counts, covered), stats)
+
+    def test_stored_stats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('pkg', 'tif', 'h5', 'ora', 'json'):
+                file = os.path.join(tmpdir, f'stats.{ext}')
+                img = create_sample_image(file, (50, 70), CRACK_REGION, SURF_REGION)
+                crack, surf = img['crack'].image, img['surfdeg'].image
+                stats = img.get_stats()
+                metadata = img.stats_metadata()
+                self.assertEqual(metadata['layers']['crack']['bbox'], [10, 5, 50, 15])
+                self.assertEqual(metadata['covered'], np.count_nonzero(crack | surf))
+                handler = build_by_name({'tif' : 'tiff', 'ora' : 'openraster', 'json' : 'rle'}.get(ext, ext))
+                handler.save(img, file)
+
+                info = handler.peek(file)
+                self.assertTrue(info.has_valid_stats(), ext)
+                self.assertEqual(info.stats['checksum'], metadata['checksum'])
+                self.assertEqual(info.get_stats(), stats)
+                self.assertEqual(next(calculate_stats([file]))[1], stats)
+                # The stored stats are only partially used for a subset of the layers
+                filtered = next(calculate_stats([file], ['Crack']))[1]
+                self.assertEqual(filtered['Crack Pixcount'], 750)
+                self.assertEqual(filtered['Mask Cover'], 750 / 3500 * 100)
+
+        # The checksum does not depend on the cropping of the layers
+        img.crop_layers()
+        self.assertEqual(img.stats_metadata(), metadata)
+
+    def test_stale_stats(self):
+        img = create_sample_image('stale.pkg', (50, 70), CRACK_REGION, surf = None)
+        stats = img.stats_metadata()
+        info = phmImageInfo('stale.pkg', 'stale', (50, 70), layers = [LayerInfo('Crack', (50, 70))], stats = stats)
+        self.assertTrue(info.has_valid_stats())
+        # The statistics are updated without their checksum
+        stats['layers']['crack']['pixcount'] = 10
+        self.assertFalse(info.has_valid_stats())
+        self.assertEqual(info.get_pixcounts(), {})
+        # The masks are out of the stored layer
+        info = phmImageInfo('stale.pkg', 'stale', (50, 70), layers = [LayerInfo('Crack', (10, 20), x = 40, y = 30)], stats = img.stats_metadata())
+        self.assertFalse(info.has_valid_stats())
+
+    def test_reused_stats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ext in ('tpk', 'tif', 'h5', 'pkg'):
+                file = os.path.join(tmpdir, f'stats.{ext}')
+                copy = os.path.join(tmpdir, f'copy.{ext}')
+                img = create_sample_image(file, (50, 70), CRACK_REGION, surf = None)
+                handler = build_by_name({'tif' : 'tiff', 'tpk' : 'tiled'}.get(ext, ext))
+                handler.save(img, file)
+                # The statistics of the untouched layers are not calculated again
+                loaded = handler.load(file)
+                with mock.patch.object(phmImage, '_count_pixels', side_effect = AssertionError) as count:
+                    handler.save(loaded, copy)
+                count.assert_not_called()
+                self.assertTrue(handler.peek(copy).has_valid_stats(), ext)
+                # The statistics do not depend on the original image
+                loaded.orig_layer.image = np.ones((50, 70, 3), dtype=np.uint8)
+                with mock.patch.object(phmImage, '_count_pixels', side_effect = AssertionError) as count:
+                    handler.save(loaded, copy)
+                count.assert_not_called()
+                # A modified layer is calculated again
+                loaded['crack'].image = np.zeros((50, 70), dtype=np.int8)
+                handler.save(loaded, copy)
+                info = handler.peek(copy)
+                self.assertTrue(info.has_valid_stats(), ext)
+                self.assertEqual(info.get_pixcounts(), {'crack' : 0})
+
+    def test_layer_index(self):
+        layers = [Layer(f'Class_{i}', image=np.zeros((4, 4), dtype=np.int8)) for i in range(5)]
+        img = phmImage(
+            filepath = 'index.pkg',
+            properties = {},
+            orig_image = np.zeros((4, 4, 3), dtype=np.uint8),
+            layers = layers
+        )
+        self.assertIs(img['class_3'], layers[3])
+        self.assertIn('class_4', img)
+        self.assertNotIn('class_9', img)
+        self.assertIn('original', img)
+
+        img.layers.append(Layer('Crack', image=np.zeros((4, 4), dtype=np.int8)))
+        self.assertIs(img.get_layer('crack'), img.layers[-1])
+        del img.layers[0]
+        self.assertNotIn('class_0', img)
+        img.layers[0].name = 'renamed'
+        self.assertIs(img['renamed'], layers[1])
+        self.assertFalse(img.has_layer('class_1'))
+
+        other = phmImage('other.pkg', {}, np.zeros((4, 4, 3), dtype=np.uint8), [Layer('SurfDeg', image=np.zeros((4, 4), dtype=np.int8))])
+        img.update_from(other)
+        self.assertEqual(img.layer_names, ('surfdeg',))
+        self.assertRaises(KeyError, img.get_layer, 'crack')
+
+    def test_classmap_buffer(self):
+        img = create_sample_image('classmap.pkg', (50, 70), CRACK_REGION, SURF_REGION)
+        img['crack'].class_id = 200
+        img['surfdeg'].class_id = 30
+        crack = img['crack'].image
+        expected = img.get_classmap(lambda x : np.amax(x, axis = 2))
+        np.testing.assert_array_equal(img.classmap(), expected)
+
+        buffer = np.full((50, 70), 7, dtype=np.uint8)
+        orig, target = img.get_dp_ready(out = buffer)
+        self.assertIs(target, buffer)
+        np.testing.assert_array_equal(target, expected)
+        self.assertEqual(img.classmap(dtype = np.uint16).dtype, np.uint16)
+        np.testing.assert_array_equal(img.layers[0].classmap(np.uint8), crack.astype(np.uint8) * 200)
+        img.layers[0].pack()
+        np.testing.assert_array_equal(img.classmap(out = buffer), expected)
+        self.assertEqual(img.classmap_rgb().shape, (50, 70, 3))
+
+    def test_label_stack(self):
+        layers = []
+        for index, cid in enumerate([30, 200, 10]):
+            mask = np.zeros((50, 70), dtype=np.int8)
+            mask[index * 10:index * 10 + 25, 5 + index * 3:40] = 1
+            layers.append(Layer(f'class_{index}', class_id=cid, image=mask))
+        img = phmImage(
+            filepath = 'stacked.pkg',
+            properties = {},
+            orig_image = np.zeros((50, 70, 3), dtype=np.uint8),
+            layers = layers
+        )
+        masks = [layer.image.copy() for layer in layers]
+        classmap = img.classmap()
+        stats = img.get_stats()
+
+        stack = img.stack_layers()
+        self.assertIs(img.label_stack, stack)
+        self.assertEqual(stack.bits.dtype, np.uint8)
+        for layer, mask in zip(img.layers, masks):
+            np.testing.assert_array_equal(layer.image, mask)
+            self.assertFalse(layer.image.flags.writeable)
+        np.testing.assert_array_equal(img.classmap(), classmap)
+        self.assertEqual(img.get_stats(), stats)
+
+        # Modifying a layer detaches it from the label stack
+        img.layers[0].image = masks[0]
+        self.assertIsNone(img.label_stack)
+        np.testing.assert_array_equal(img.classmap(), classmap)
+        img.unstack_layers()
+        self.assertTrue(all(layer.is_loaded() for layer in img.layers))
+
+    def test_packed_layer(self):
+        mask = np.zeros((37, 61), dtype=np.int8)
+        mask[3:9, 5:50] = 1
+        mask[36, 60] = 1
+        layer = Layer('Crack', class_id=200, image=mask.copy())
+        classmap = layer.classmap()
+        stats = layer.get_stats()
+
+        layer.pack()
+        self.assertTrue(layer.is_packed())
+        self.assertLess(layer.source.nbytes, mask.nbytes)
+        self.assertEqual(layer.get_stats(), stats)
+        self.assertFalse(layer.is_empty())
+        np.testing.assert_array_equal(layer.classmap(), classmap)
+        np.testing.assert_array_equal(layer.image, mask)
+        self.assertTrue(layer.is_packed())
+        # The decoded copy of a packed mask cannot be modified in place
+        with self.assertRaises(ValueError):
+            layer.image[0, 0] = 1
+
+        layer.unpack()
+        self.assertFalse(layer.is_packed())
+        np.testing.assert_array_equal(layer.image, mask)
+        layer.image[0, 0] = 1
+        self.assertEqual(layer.pixcount(), np.count_nonzero(mask) + 1)
+
     def test_create(self):
         file = "tests/resources/orig.png"
         img = create_from_image(file)
@@ -0,0 +1,64 @@
+
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+sys.path.append(__file__)
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from yoyo66.handler.core import build_by_name, load_file
+from tests.common import create_sample_image
+
+
+class Memmap_Test(unittest.TestCase):
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.mpk')
+            sample = create_sample_image(file)
+            # A mask stored as zero and 255
+            sample['surfdeg'].image = sample['surfdeg'].image.view(np.uint8) * np.uint8(255)
+            sample['crack'].crop()
+            handler = build_by_name('memmap')
+            handler.save(sample, file)
+            with zipfile.ZipFile(file) as zfile:
+                self.assertIsNone(zfile.testzip())
+                self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in zfile.infolist()))
+
+            img = load_file(file)
+            self.assertEqual(img.properties, sample.properties)
+            self.assertEqual(img.metrics, sample.metrics)
+            for layer in img:
+                self.assertIsInstance(layer.image, np.memmap)
+                self.assertFalse(layer.image.flags.writeable)
+                self.assertEqual(layer.image.ctypes.data % 64, 0)
+            np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+            self.assertEqual((img['crack'].x, img['crack'].y), (30, 10))
+            np.testing.assert_array_equal(img['crack'].image, sample['crack'].image)
+            np.testing.assert_array_equal(img['surfdeg'].image, sample['surfdeg'].image != 0)
+            self.assertEqual(img.get_stats(), sample.get_stats())
+
+            # Saving on top of the mapped file
+            handler.save(img, file)
+            np.testing.assert_array_equal(load_file(file)['crack'].image, sample['crack'].image)
+
+    def test_peek(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.mpk')
+            sample = create_sample_image(file)
+            build_by_name('memmap').save(sample, file)
+            info = build_by_name('memmap', ['SurfDeg']).peek(file)
+            self.assertEqual(info.dimension, (120, 160))
+            self.assertEqual(info.layer_names, ('surfdeg',))
+            self.assertEqual(info.layers[0].size, 120 * 160 + 128)
+            self.assertEqual(info.get_stats(), None)
+            self.assertEqual(build_by_name('memmap').peek(file).get_stats(), sample.get_stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 
 import os
 import sys
+import tempfile
 import unittest
+import zipfile
+
+from unittest import mock
 
 from PIL import Image
 import numpy as np
@@ -10,9 +14,12 @@ sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+from pyora import Project
+
 from yoyo66.datastruct import phmImage, Layer, from_image
-from yoyo66.handler.openraster import OpenRasterFileHandler
+from yoyo66.handler.openraster import OpenRasterFileHandler, ORAImage
 from yoyo66.handler.core import build_by_name
+from tests.common import create_sample_image
 
 class ORA_Test(unittest.TestCase):
     
@@ -28,6 +35,90 @@ class ORA_Test(unittest.TestCase):
         img = ora.load(file)
         print(img)
     
+    def test_peek(self):
+        file = "tests/resources/ora_1.ora"
+        ora = build_by_name('openraster', ['Crack', 'SurfDeg'])
+        info = ora.peek(file)
+        img = ora.load(file)
+        self.assertEqual(info.dimension, img.dimension)
+        self.assertEqual(info.layer_names, img.layer_names)
+        self.assertEqual(info.properties, img.properties)
+        self.assertEqual([layer.dimension for layer in info.layers], [layer.dimension for layer in img.layers])
+        self.assertTrue(all(layer.size > 0 for layer in info.layers))
+    
+    def test_filtered_load(self):
+        file = "tests/resources/ora_1.ora"
+        full = build_by_name('openraster').load(file)
+        # Only the stack, the original image and the requested layer are read
+        with mock.patch.object(zipfile.ZipFile, 'open', autospec = True, side_effect = zipfile.ZipFile.open) as zopen:
+            img = build_by_name('openraster', ['Crack']).load(file)
+        self.assertEqual(img.layer_names, ('crack',))
+        self.assertEqual(len(zopen.call_args_list), 3)
+        np.testing.assert_array_equal(img['crack'].image, full['crack'].image)
+        np.testing.assert_array_equal(img.orig_layer.image, full.orig_layer.image)
+
+    def test_native_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.ora')
+            sample = create_sample_image(file)
+            sample['surfdeg'].opacity = 0.5
+            crack, surf = sample['crack'].image, sample['surfdeg'].image
+            fast = os.path.join(tmpdir, 'fast.ora')
+            build_by_name('openraster').save(sample, file)
+            build_by_name('openraster', compress_level = 0).save(sample, fast)
+            self.assertGreater(os.path.getsize(fast), os.path.getsize(file))
+            # The png files encoded by the threads are the same
+            threaded = os.path.join(tmpdir, 'threaded.ora')
+            build_by_name('openraster', max_workers = 4).save(sample, threaded)
+            with zipfile.ZipFile(file) as src, zipfile.ZipFile(threaded) as dest:
+                self.assertEqual({info.filename : info.CRC for info in src.infolist()},
+                    {info.filename : info.CRC for info in dest.infolist()})
+            np.testing.assert_array_equal(build_by_name('openraster', max_workers = 4).load(threaded)['crack'].image, crack)
+            with zipfile.ZipFile(file) as ora:
+                self.assertEqual(ora.namelist()[0], 'mimetype')
+                merged = ora.getinfo('mergedimage.png').CRC
+            # The layout stays readable by other openraster readers
+            project = Project.load(file)
+            self.assertIsNotNone(project.get_by_path('/original'))
+            self.assertIsNotNone(project.get_by_path('/layers/crack'))
+
+            img = build_by_name('openraster', lazy = True).load(file)
+            self.assertIsInstance(img['crack'].source, ORAImage)
+            self.assertEqual(img.layer_names, ('crack', 'surfdeg'))
+            self.assertEqual(img.properties, sample.properties)
+            self.assertEqual(img.metrics, sample.metrics)
+            self.assertEqual(img['surfdeg'].opacity, 0.5)
+            np.testing.assert_array_equal(img['crack'].image, crack)
+            np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+            # The untouched file is copied without regenerating the merged image
+            copy = os.path.join(tmpdir, 'copy.ora')
+            with mock.patch.object(phmImage, 'blended_image') as blended:
+                build_by_name('openraster').save(img, copy)
+            blended.assert_not_called()
+            with zipfile.ZipFile(copy) as ora:
+                self.assertEqual(ora.getinfo('mergedimage.png').CRC, merged)
+            # A modified layer regenerates the merged image
+            img['crack'].image[:] = 0
+            build_by_name('openraster').save(img, copy)
+            with zipfile.ZipFile(copy) as ora:
+                self.assertNotEqual(ora.getinfo('mergedimage.png').CRC, merged)
+            loaded = build_by_name('openraster').load(copy)
+            self.assertEqual(loaded['crack'].pixcount(), 0)
+            np.testing.assert_array_equal(loaded['surfdeg'].image, surf)
+
+    def test_original_mode(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.ora')
+            gray = np.random.randint(0, 255, (120, 160), dtype=np.uint8)
+            sample = create_sample_image(file)
+            sample.orig_layer.image = gray
+            build_by_name('openraster').save(sample, file)
+            # The grayscale original image is not converted to RGB
+            img = build_by_name('openraster', lazy = True).load(file)
+            self.assertEqual(img.orig_layer.source.shape, (120, 160))
+            np.testing.assert_array_equal(img.orig_layer.image, gray)
+            np.testing.assert_array_equal(build_by_name('openraster').load(file).orig_layer.image, gray)
+
     def test_save_with_category(self):
         file = "tests/resources/ora_1_test_edited.ora"
         classes = {'Crack' : 100, 'SurfDeg' : 200}
@@ -2,7 +2,12 @@
 import os
 import sys
 import time
+import tempfile
 import unittest
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 from PIL import Image
 import numpy as np
@@ -14,9 +19,250 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from yoyo66.utils import create_image
 from yoyo66.datastruct import phmImage, Layer, from_image
 from yoyo66.handler.core import build_by_name
+from yoyo66.handler.pkg import PKGImage
+from yoyo66.handler import zipio
+from tests.common import create_sample_image
+
 
 class PKG_Test(unittest.TestCase):
 
+    def test_archive_overwrite_and_compact(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            pkg = build_by_name('pkg')
+            pkg.save(create_sample_image(file), file)
+            img = pkg.load(file)
+            asset = np.random.randint(0, 2, (120, 160), dtype=np.uint8)
+            for value in range(3):
+                with img.archive as ac:
+                    ac.set_asset('phm.prediction.crack', asset * value, overwrite = True)
+            self.assertEqual(zipio.count_garbage(file), 0)
+            with img.archive as ac:
+                np.testing.assert_array_equal(ac.get_asset('phm.prediction.crack'), asset * 2)
+
+            # A pkg file containing dead copies
+            with zipfile.ZipFile(file, mode = 'a') as zfile:
+                for value in range(3):
+                    zfile.writestr('archive/phm/prediction/crack.png', str(value))
+            self.assertEqual(zipio.count_garbage(file), 3)
+            size = os.path.getsize(file)
+            self.assertEqual(img.archive.compact(), 3)
+            self.assertEqual(zipio.count_garbage(file), 0)
+            self.assertLess(os.path.getsize(file), size)
+            with zipfile.ZipFile(file) as zfile:
+                self.assertIsNone(zfile.testzip())
+                self.assertEqual(zfile.read('archive/phm/prediction/crack.png'), b'2')
+            np.testing.assert_array_equal(pkg.load(file)['crack'].image, create_sample_image(file)['crack'].image)
+
+    def test_save_archive_passthrough(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            copy = os.path.join(tmpdir, 'copy.pkg')
+            pkg = build_by_name('pkg')
+            pkg.save(create_sample_image(file), file)
+            img = pkg.load(file)
+            asset = np.random.randint(0, 255, (120, 160), dtype=np.uint8)
+            with img.archive as ac:
+                ac.set_asset('phm.prediction.crack', asset)
+            with zipfile.ZipFile(file) as zfile:
+                info = zfile.getinfo('archive/phm/prediction/crack.png')
+                raw = zipio.read_raw(zfile.fp, info)
+
+            img['crack'].image = np.zeros((120, 160), dtype=np.uint8)
+            for target in (file, copy):
+                pkg.save(img, target)
+                with zipfile.ZipFile(target) as zfile:
+                    self.assertIsNone(zfile.testzip())
+                    self.assertEqual(zipio.read_raw(zfile.fp, zfile.getinfo(info.filename)), raw)
+                with build_by_name('pkg').load(target).archive as ac:
+                    np.testing.assert_array_equal(ac.get_asset('phm.prediction.crack'), asset)
+
+            # A failed save leaves the destination untouched
+            size = os.path.getsize(file)
+            img['surfdeg'].image = 'invalid'
+            self.assertRaises(Exception, pkg.save, img, file)
+            self.assertEqual(os.path.getsize(file), size)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['copy.pkg', 'sample.pkg'])
+            np.testing.assert_array_equal(pkg.load(file)['crack'].image, 0)
+
+    def test_archive_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            sample = create_sample_image(file)
+            pkg = build_by_name('pkg')
+            pkg.save(sample, file)
+            img = pkg.load(file)
+            asset = np.zeros((120, 160), dtype=np.uint8)
+            with img.archive as ac:
+                ac.set_assets({
+                    'phm.postprocessing.crack' : asset,
+                    'phm.postprocessing.surfdeg' : asset,
+                    'phm.prediction.crack' : asset
+                })
+                self.assertRaises(KeyError, ac.set_asset, 'phm.prediction.crack', asset)
+            img.archive.cache_size = asset.nbytes
+            with img.archive as ac:
+                self.assertEqual(ac.get_asset_list('phm.postprocessing.*'), ['phm.postprocessing.crack', 'phm.postprocessing.surfdeg'])
+                self.assertEqual(len(ac.get_asset_list()), 3)
+                self.assertIs(ac.get_asset('phm.prediction.crack'), ac['phm.prediction.crack'])
+                ac.get_asset('phm.postprocessing.crack')
+                # Only one asset fits in the cache
+                self.assertEqual(list(ac._cache.keys()), ['phm.postprocessing.crack'])
+                self.assertIsNone(ac.get_asset('phm.missing'))
+
+    def test_cropped_layers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            sample = create_sample_image(file)
+            classmap = sample.classmap()
+            stats = sample.get_stats()
+            blended = np.asarray(sample.blended_image())
+            build_by_name('pkg', crop = True).save(sample, file)
+
+            img = build_by_name('pkg').load(file)
+            crack = img['crack']
+            self.assertEqual((crack.x, crack.y), (30, 10))
+            self.assertEqual(crack.dimension, (10, 60))
+            self.assertEqual(crack.bbox(), sample['crack'].bbox())
+            np.testing.assert_array_equal(crack.expand(img.dimension), sample['crack'].image)
+            for layer in img.mask_layers:
+                layer.class_id = sample[layer.name].class_id
+            np.testing.assert_array_equal(img.classmap(), classmap)
+            np.testing.assert_array_equal(np.asarray(img.blended_image()), blended)
+            # The cropped layer is drawn at its offset: inside its region, and not at the origin of the image
+            loaded = np.asarray(img.blended_image())
+            self.assertEqual(tuple(loaded[15, 50]), (100, 100, 100, 255))
+            self.assertEqual(tuple(loaded[5, 5]), tuple(sample.orig_layer.image[5, 5]) + (255,))
+            self.assertEqual(img.get_stats()['Mask Cover'], stats['Mask Cover'])
+            self.assertEqual(img.get_stats()['Crack Cover'], stats['Crack Cover'])
+
+            sample.crop_layers()
+            np.testing.assert_array_equal(sample.classmap(), classmap)
+
+    def test_incremental_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            copy = os.path.join(tmpdir, 'copy.pkg')
+            sample = create_sample_image(file)
+            pkg = build_by_name('pkg')
+            pkg.save(sample, file)
+            with zipfile.ZipFile(file) as zfile:
+                members = {info.filename : info.CRC for info in zfile.infolist()}
+
+            img = pkg.load(file)
+            self.assertFalse(any(layer.is_dirty() for layer in img))
+            # In-place modification
+            img['crack'].image[0, 0] = 1
+            self.assertTrue(img['crack'].is_dirty())
+            self.assertFalse(img['surfdeg'].is_dirty())
+            pkg.save(img, copy)
+            with zipfile.ZipFile(copy) as zfile:
+                self.assertIsNone(zfile.testzip())
+                copied = {info.filename : info.CRC for info in zfile.infolist()}
+            self.assertNotEqual(copied['layers/crack.png'], members['layers/crack.png'])
+            for member in ('layers/surfdeg.png', f'{sample.title}.png'):
+                self.assertEqual(copied[member], members[member])
+            # The thumbnail is regenerated since a layer is changed
+            self.assertIn('thumbnail.png', copied)
+
+            saved = pkg.load(copy)
+            self.assertEqual(saved['crack'].image[0, 0], 1)
+            np.testing.assert_array_equal(saved['surfdeg'].image, sample['surfdeg'].image)
+            np.testing.assert_array_equal(saved.orig_layer.image, sample.orig_layer.image)
+
+            # The statistics of a lazy image decode every untouched layer once
+            lazy = build_by_name('pkg', lazy = True).load(file)
+            lazy['crack'].image = saved['crack'].image
+            with mock.patch.object(PKGImage, 'decode', autospec = True, side_effect = PKGImage.decode) as decode:
+                lazy.stats_metadata()
+            self.assertEqual(sorted(call.args[0].member for call in decode.call_args_list), ['layers/surfdeg.png'])
+
+            # Nothing changed: the file is rewritten with the same images and thumbnail
+            pkg.save(saved, copy)
+            with zipfile.ZipFile(copy) as zfile:
+                for member in ('layers/crack.png', 'layers/surfdeg.png', f'{sample.title}.png', 'thumbnail.png'):
+                    self.assertEqual(zfile.getinfo(member).CRC, copied[member])
+
+    def test_threaded_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            copy = os.path.join(tmpdir, 'copy.pkg')
+            sample = create_sample_image(file)
+            build_by_name('pkg').save(sample, file)
+            build_by_name('pkg', max_workers = 4).save(sample, copy)
+            # The same png files are written by the threads
+            with zipfile.ZipFile(file) as src, zipfile.ZipFile(copy) as dest:
+                self.assertEqual({info.filename : info.CRC for info in src.infolist()}, 
+                    {info.filename : info.CRC for info in dest.infolist()})
+            with ThreadPoolExecutor(max_workers = 4) as executor:
+                img = build_by_name('pkg', executor = executor).load(copy)
+                self.assertTrue(all(layer.is_loaded() for layer in img))
+                for name in ('crack', 'surfdeg'):
+                    np.testing.assert_array_equal(img[name].image, sample[name].image)
+                np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+                img['crack'].image[0, 0] = 1
+                build_by_name('pkg', executor = executor).save(img, copy)
+            self.assertEqual(build_by_name('pkg').load(copy)['crack'].image[0, 0], 1)
+
+    def test_peek(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            sample = create_sample_image(file)
+            build_by_name('pkg', crop = True).save(sample, file)
+            info = build_by_name('pkg', ['Crack']).peek(file)
+            self.assertEqual(info.title, 'sample')
+            self.assertEqual(info.dimension, (120, 160))
+            self.assertEqual(info.layer_names, ('crack',))
+            self.assertEqual(info.properties, build_by_name('pkg').load(file).properties)
+            self.assertEqual(info.metrics, sample.metrics)
+            crack = info.layers[0]
+            self.assertEqual((crack.x, crack.y, crack.dimension), (30, 10, (10, 60)))
+            with zipfile.ZipFile(file) as zfile:
+                self.assertEqual(crack.size, zfile.getinfo('layers/crack.png').compress_size)
+
+    def test_lazy_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            sample = create_sample_image(file)
+            build_by_name('pkg').save(sample, file)
+
+            pkg = build_by_name('pkg', ['Crack', 'SurfDeg'], lazy = True)
+            img = pkg.load(file)
+            self.assertEqual(img.layer_names, ('crack', 'surfdeg'))
+            self.assertFalse(any(layer.is_loaded() for layer in img))
+            self.assertEqual(img.dimension, (120, 160))
+            self.assertFalse(img.orig_layer.is_loaded())
+
+            crack = img['crack']
+            np.testing.assert_array_equal(crack.image, sample['crack'].image)
+            self.assertTrue(crack.is_loaded())
+            self.assertFalse(img['surfdeg'].is_loaded())
+            np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+
+            img.release()
+            self.assertFalse(any(layer.is_loaded() for layer in img))
+            # Saving on top of the source file
+            pkg.save(img, file)
+            img = pkg.load(file)
+            np.testing.assert_array_equal(img['surfdeg'].image, sample['surfdeg'].image)
+
+    def test_layer_png_values(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.pkg')
+            sample = create_sample_image(file)
+            build_by_name('pkg').save(sample, file)
+            # The gray channel keeps the class id and the alpha channel keeps the mask
+            with zipfile.ZipFile(file) as zfile, zfile.open('layers/crack.png') as f:
+                png = np.asarray(Image.open(f))
+            self.assertEqual(png.dtype, np.uint8)
+            np.testing.assert_array_equal(png[..., 0], sample['crack'].image.astype(np.uint8) * 100)
+            np.testing.assert_array_equal(png[..., 1], sample['crack'].image.astype(np.uint8) * 255)
+            # The layers are drawn over the original image
+            blended = np.asarray(sample.blended_image())
+            self.assertEqual(tuple(blended[15, 50]), (100, 100, 100, 255))
+            self.assertEqual(tuple(blended[80, 30]), (120, 120, 120, 255))
+            self.assertEqual(tuple(blended[50, 120]), tuple(sample.orig_layer.image[50, 120]) + (255,))
+
     def test_load_without_category(self):
         st = time.time() * 1000
         file = "tests/resources/pkg_1.pkg"
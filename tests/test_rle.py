@@ -0,0 +1,153 @@
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+sys.path.append(__file__)
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from yoyo66.datastruct import Layer
+from yoyo66.handler.rle import RLEMask, index_path
+from yoyo66.handler.core import build_by_name
+from tests.common import create_sample_image
+
+# The surface degradation overlaps the crack
+SURF_REGION = np.s_[15:100, 20:50]
+
+
+class RLE_Test(unittest.TestCase):
+
+    def test_rle_mask(self):
+        sample = create_sample_image('sample.json', surf = SURF_REGION)
+        crack = RLEMask.from_array(sample['crack'].image)
+        surf = RLEMask.from_array(sample['surfdeg'].image)
+        layer = Layer('Crack', image=crack)
+        self.assertEqual(layer.pixcount(), 600)
+        self.assertEqual(layer.bbox(), (30, 10, 60, 10))
+        self.assertEqual(layer.bbox(), sample['crack'].bbox())
+        self.assertEqual(crack.union(surf).count_nonzero(),
+            np.count_nonzero(sample['crack'].image | sample['surfdeg'].image))
+        self.assertEqual(crack.intersection(surf).count_nonzero(), 100)
+        np.testing.assert_array_equal(layer.image, sample['crack'].image)
+
+    def test_peek(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.json')
+            sample = create_sample_image(file, surf = SURF_REGION)
+            sample['crack'].image[:] = 0
+            rle = build_by_name('rle')
+            rle.save(sample, file)
+            info = rle.peek(file)
+            self.assertEqual(info.dimension, (120, 160))
+            self.assertEqual(info.layer_names, ('crack', 'surfdeg'))
+            self.assertEqual(info.metrics, sample.metrics)
+            self.assertEqual(info.properties['altitudes'], '12312.123')
+            self.assertEqual(info.layers[0].size, 0)
+            self.assertGreater(info.layers[1].size, 0)
+
+    def test_save_load_rle(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.json')
+            sample = create_sample_image(file, surf = SURF_REGION)
+            rle = build_by_name('rle', keep_rle = True)
+            rle.save(sample, file)
+            img = rle.load(file)
+            for layer in img.mask_layers:
+                self.assertIsInstance(layer.compact_source, RLEMask)
+                np.testing.assert_array_equal(layer.image, sample[layer.name].image)
+                self.assertFalse(layer.image.flags.writeable)
+            # The statistics of the RLE layers are calculated without densifying them
+            with mock.patch.object(RLEMask, 'decode', side_effect = AssertionError) as decode:
+                self.assertEqual(img.get_stats(), sample.get_stats())
+                self.assertEqual(img.count_pixels()[1], np.count_nonzero(sample['crack'].image | sample['surfdeg'].image))
+            decode.assert_not_called()
+            # Save the RLE layers without densifying them
+            rle.save(img, file)
+            img = build_by_name('rle').load(file)
+            self.assertEqual(img['surfdeg'].pixcount(), sample['surfdeg'].pixcount())
+            np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+
+    def test_batched_annotations(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.json')
+            sample = create_sample_image(file, surf = SURF_REGION)
+            # An empty layer before the others
+            sample.layers = [Layer('Empty', image=np.zeros((120, 160), dtype=np.int8))] + list(sample.layers)
+            sample['crack'].image = RLEMask.from_array(sample['crack'].image)
+            rle = build_by_name('rle')
+            rle.save(sample, file)
+            with open(file) as fid:
+                annotations = json.load(fid)['annotations']
+            self.assertEqual([ann['category_id'] for ann in annotations], [2, 3])
+            self.assertEqual([ann['bbox'] for ann in annotations], [[30, 10, 60, 10], [20, 15, 30, 85]])
+            self.assertEqual([ann['area'] for ann in annotations], [600, 2550])
+            # The layers stay aligned with their annotations
+            img = rle.load(file)
+            self.assertEqual(img.layer_names, ('empty', 'crack', 'surfdeg'))
+            self.assertEqual(img['empty'].pixcount(), 0)
+            for name in ('crack', 'surfdeg'):
+                self.assertEqual(img[name].image.dtype, np.int8)
+                np.testing.assert_array_equal(img[name].image, sample[name].image)
+
+    def test_class_ids(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.json')
+            dataset_file = os.path.join(tmpdir, 'dataset.json')
+            sample = create_sample_image(file, surf = SURF_REGION)
+            build_by_name('rle').save(sample, file)
+            with build_by_name('rle').open_dataset(dataset_file, mode = 'w') as dataset:
+                dataset.append(sample)
+            # Both read paths take the class ids from the handler categories
+            rle = build_by_name('rle', ['SurfDeg'])
+            img = rle.load(file)
+            self.assertEqual(img.layer_names, ('surfdeg',))
+            self.assertEqual(img['surfdeg'].class_id, rle.categories['surfdeg'])
+            with rle.open_dataset(dataset_file) as dataset:
+                self.assertEqual(dataset[0]['surfdeg'].class_id, img['surfdeg'].class_id)
+
+    def test_dataset(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'dataset.json')
+            samples = [create_sample_image(os.path.join(tmpdir, f'sample_{index}.json'), surf = SURF_REGION) for index in range(3)]
+            samples[1]['crack'].image[:] = 0
+            samples[2].layers = [samples[2]['surfdeg']]
+            with build_by_name('rle').open_dataset(file, mode = 'w') as dataset:
+                for img in samples:
+                    dataset.append(img)
+                self.assertEqual(len(dataset), 3)
+            # The annotation file is a valid COCO document
+            with open(file) as fid:
+                coco = json.load(fid)
+            self.assertEqual([img['id'] for img in coco['images']], [0, 1, 2])
+            self.assertEqual(len(coco['annotations']), 4)
+            self.assertEqual([cat['name'] for cat in coco['categories']], ['crack', 'surfdeg'])
+            self.assertTrue(os.path.isfile(index_path(file)))
+
+            with build_by_name('rle').open_dataset(file) as dataset:
+                self.assertEqual(len(dataset), 3)
+                self.assertEqual(dataset.categories, ('crack', 'surfdeg'))
+                img = dataset.get(1)
+                self.assertEqual(img.title, 'sample_1')
+                self.assertEqual(img.layer_names, ('crack', 'surfdeg'))
+                self.assertEqual(img['crack'].pixcount(), 0)
+                np.testing.assert_array_equal(img['surfdeg'].image, samples[1]['surfdeg'].image)
+                np.testing.assert_array_equal(img.orig_layer.image, samples[1].orig_layer.image)
+                self.assertEqual(img.metrics, samples[1].metrics)
+                for loaded, sample in zip(dataset, samples):
+                    self.assertEqual(loaded.layer_names, sample.layer_names)
+                    self.assertEqual(loaded.get_stats(), sample.get_stats())
+            with build_by_name('rle', ['SurfDeg'], keep_rle = True).open_dataset(file) as dataset:
+                img = dataset[0]
+                self.assertEqual(img.layer_names, ('surfdeg',))
+                self.assertIsInstance(img['surfdeg'].compact_source, RLEMask)
+            self.assertRaises(ValueError, build_by_name('rle').open_dataset, file, 'a')
+
+if __name__ == '__main__':
+    unittest.main()
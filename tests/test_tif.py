@@ -2,18 +2,24 @@
 import os
 import sys
 import time
+import tempfile
 import unittest
 
+from unittest import mock
+
 from PIL import Image
+from tifffile import TiffPage
 import numpy as np
 
 sys.path.append(os.getcwd())
 sys.path.append(__file__)
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+from yoyo66 import datastruct
 from yoyo66.utils import create_image
 from yoyo66.datastruct import phmImage, Layer, from_image
 from yoyo66.handler.core import build_by_name
+from tests.common import create_sample_image
 
 class Tif_Test(unittest.TestCase):
 
@@ -26,6 +32,87 @@ class Tif_Test(unittest.TestCase):
         et = time.time() * 1000
         print('Execution time:', et - st, 'miliseconds')
 
+    def test_peek(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.tif')
+            img = create_sample_image(file)
+            handler = build_by_name('tiff')
+            handler.save(img, file)
+            info = handler.peek(file)
+            self.assertEqual(info.dimension, (120, 160))
+            self.assertEqual(info.layer_names, ('crack', 'surfdeg'))
+            self.assertEqual(info.layers[0].dimension, (120, 160))
+            self.assertGreater(info.layers[0].size, 0)
+            self.assertEqual(info.properties['altitudes'], '12312.123')
+            self.assertAlmostEqual(info.metrics['iou'], 0.78)
+
+    def test_selective_memmap_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.tif')
+            img = create_sample_image(file)
+            crack, surf = img['crack'].image, img['surfdeg'].image
+            build_by_name('tiff').save(img, file)
+            # Only the original page and the requested layers are decoded
+            with mock.patch.object(TiffPage, 'asarray', autospec = True, side_effect = TiffPage.asarray) as asarray:
+                loaded = build_by_name('tiff', ['SurfDeg']).load(file)
+            self.assertEqual(asarray.call_count, 2)
+            self.assertEqual(loaded.layer_names, ('surfdeg',))
+            np.testing.assert_array_equal(loaded['surfdeg'].image, surf)
+            self.assertEqual(loaded.properties['altitudes'], '12312.123')
+
+            # The uncompressed pages are memory-mapped
+            build_by_name('tiff', compression = None).save(img, file)
+            with mock.patch.object(TiffPage, 'asarray', autospec = True, side_effect = TiffPage.asarray) as asarray, \
+                mock.patch('yoyo66.datastruct._checksum', side_effect = datastruct._checksum) as checksum:
+                loaded = build_by_name('tiff').load(file)
+            self.assertEqual(asarray.call_count, 0)
+            # The mapped page is not read for detecting the modifications, only the converted rgba masks are
+            self.assertEqual(checksum.call_count, 2)
+            self.assertIsInstance(loaded.orig_layer.image, np.memmap)
+            self.assertFalse(loaded.orig_layer.image.flags.writeable)
+            self.assertFalse(loaded.orig_layer.is_dirty())
+            np.testing.assert_array_equal(loaded.orig_layer.image, img.orig_layer.image)
+            np.testing.assert_array_equal(loaded['crack'].image, crack)
+            self.assertFalse(isinstance(build_by_name('tiff', memmap = False).load(file).orig_layer.image, np.memmap))
+            # Saving on top of the mapped file
+            build_by_name('tiff').save(loaded, file)
+            np.testing.assert_array_equal(build_by_name('tiff').load(file).orig_layer.image, img.orig_layer.image)
+
+    def test_mask_profiles(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            crack = np.zeros((300, 400), dtype=np.int8)
+            for index in range(20):
+                crack[10 * index:10 * index + 5, 15 * index:15 * index + 100] = 1
+            img = phmImage(
+                filepath = os.path.join(tmpdir, 'sample.tif'),
+                properties = {},
+                orig_image = np.zeros((300, 400, 3), dtype=np.uint8),
+                layers = [Layer('Crack', class_id=100, image=crack)]
+            )
+            sizes = {}
+            for profile in ('rgba', 'bilevel', 'uint8'):
+                file = os.path.join(tmpdir, f'{profile}.tif')
+                build_by_name('tiff', mask_profile = profile).save(img, file)
+                sizes[profile] = build_by_name('tiff').peek(file).layers[0].size
+                loaded = build_by_name('tiff').load(file)
+                self.assertEqual(loaded['crack'].image.dtype, np.int8)
+                np.testing.assert_array_equal(loaded['crack'].image, crack)
+                if profile != 'rgba':
+                    # The class id is stored with the mask
+                    self.assertEqual(loaded['crack'].class_id, 100)
+                    self.assertNotEqual(build_by_name('tiff', ['Crack']).load(file)['crack'].class_id, None)
+            # The uncompressed uint8 masks are memory-mapped
+            file = os.path.join(tmpdir, 'mapped.tif')
+            build_by_name('tiff', compression = None, mask_profile = 'uint8').save(img, file)
+            loaded = build_by_name('tiff').load(file)
+            self.assertIsInstance(loaded['crack'].image, np.memmap)
+            self.assertEqual(loaded['crack'].image.dtype, np.int8)
+            np.testing.assert_array_equal(loaded['crack'].image, crack)
+            self.assertEqual(loaded['crack'].pixcount(), np.count_nonzero(crack))
+            self.assertLess(sizes['bilevel'], sizes['rgba'])
+            self.assertLess(sizes['uint8'], sizes['rgba'])
+            self.assertRaises(ValueError, build_by_name, 'tiff', mask_profile = 'rgb')
+
     def test_save_with_category(self):
         file = "tests/resources/tif_1.tif"
         classes = {'Crack' : 100, 'SurfDeg' : 200}
@@ -0,0 +1,80 @@
+
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+sys.path.append(__file__)
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from yoyo66.datastruct import phmImage
+from yoyo66.handler.core import build_by_name, load_file
+from tests.common import create_sample_image
+
+def create_tiled_image(filepath : str) -> phmImage:
+    # An image spanning several tiles
+    return create_sample_image(filepath, (300, 500), crack = np.s_[10:20, 30:290], surf = np.s_[200:290, 420:480])
+
+class Tiled_Test(unittest.TestCase):
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.tpk')
+            sample = create_tiled_image(file)
+            sample['surfdeg'].crop()
+            handler = build_by_name('tiled', tile_size = 128)
+            handler.save(sample, file)
+            with zipfile.ZipFile(file) as zfile:
+                self.assertEqual(len([f for f in zfile.namelist() if f.startswith('original/')]), 3 * 4)
+                # Only the tiles containing the masks are stored
+                self.assertEqual(len([f for f in zfile.namelist() if f.startswith('layers/0/')]), 3)
+                self.assertEqual(len([f for f in zfile.namelist() if f.startswith('layers/1/')]), 1)
+
+            img = load_file(file)
+            self.assertFalse(any(layer.is_loaded() for layer in img))
+            self.assertEqual(img.dimension, (300, 500))
+            self.assertEqual(img.properties, sample.properties)
+            np.testing.assert_array_equal(img.orig_layer.image, sample.orig_layer.image)
+            np.testing.assert_array_equal(img['crack'].image, sample['crack'].image)
+            np.testing.assert_array_equal(img['surfdeg'].expand(img.dimension), sample['surfdeg'].expand(sample.dimension))
+            self.assertEqual(build_by_name('tiled').peek(file).get_stats(), sample.get_stats())
+
+            # Saving the untouched layers copies their tiles
+            img['crack'].image = np.zeros((300, 500), dtype=np.int8)
+            handler.save(img, file)
+            img = load_file(file)
+            self.assertEqual(img['crack'].pixcount(), 0)
+            np.testing.assert_array_equal(img['surfdeg'].expand(img.dimension), sample['surfdeg'].expand(sample.dimension))
+
+    def test_read_region(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file = os.path.join(tmpdir, 'sample.tpk')
+            sample = create_tiled_image(file)
+            sample['surfdeg'].crop()
+            build_by_name('tiled', tile_size = 64).save(sample, file)
+            img = load_file(file)
+
+            region = img.read_region(400, 180, 120, 80, layers = ['SurfDeg'])
+            self.assertEqual(region.dimension, (80, 120))
+            self.assertEqual(region.layer_names, ('surfdeg',))
+            self.assertFalse(any(layer.is_loaded() for layer in img))
+            expected = np.zeros((80, 120), dtype=np.int8)
+            expected[20:80, 20:80] = 1
+            np.testing.assert_array_equal(region['surfdeg'].image, expected)
+            # The parts of the region outside of the image are zero
+            np.testing.assert_array_equal(region.orig_layer.image[:, :100], sample.orig_layer.image[180:260, 400:500])
+            self.assertFalse(region.orig_layer.image[:, 100:].any())
+            # Decoded layers are sliced
+            for x, y in ((0, 0), (25, 5), (470, 280)):
+                np.testing.assert_array_equal(
+                    img.read_region(x, y, 40, 30, original = False)['crack'].image, 
+                    sample.read_region(x, y, 40, 30)['crack'].image
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
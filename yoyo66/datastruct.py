@@ -3,16 +3,19 @@
 import functools
 import numbers
 import os
+import zlib
 from abc import ABC, abstractmethod
 from PIL import Image
 from collections import namedtuple
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Tuple, Union, Callable, Any
+from typing import Dict, List, Tuple, Union, Callable, Any, ClassVar, Iterable
 
 import numpy as np
 
 ORIGINAL_LAYER_KEY = 'original'
+# Key of the statistics stored in the file metadata (see ``phmImage.stats_metadata``)
+STATS_KEY = 'stats'
 
 """
 Dimension is a entity class used to keep the dimension al values (width and height)
@@ -20,6 +23,434 @@ Dimension class has two main fields: width and height.
 """
 Dimension = namedtuple('Dimension', ['width', 'height'])
 
+def classmap_dtype(class_ids : List[int]) -> np.dtype:
+    """The default data type of class maps, i.e. the smallest type keeping the binary masks (int8) and the given class ids.
+
+    Args:
+        class_ids (List[int]): class identifiers
+
+    Returns:
+        np.dtype: data type of the class map
+    """
+    return np.result_type(np.int8, *[np.min_scalar_type(cid) for cid in class_ids])
+
+def _class_value(class_id : int, dtype : np.dtype) -> np.ndarray:
+    # Class id converted to the requested type (wrapped around like ``astype``)
+    return np.array(class_id).astype(dtype)
+
+def _checksum(data : np.ndarray) -> int:
+    # CRC32 of the array content
+    return zlib.crc32(np.ascontiguousarray(data).view(np.uint8).reshape(-1))
+
+def _content_checksum(data : np.ndarray) -> int:
+    # Checksum detecting the in-place modifications of decoded data, the read-only arrays (e.g. memory-mapped pages)
+    # cannot be modified so they are not read for it
+    return _checksum(data) if data.flags.writeable else None
+
+def as_bool_mask(mask : np.ndarray) -> np.ndarray:
+    """Provide a boolean version of a mask. Binary masks stored in one byte are viewed without copying.
+
+    Args:
+        mask (np.ndarray): the mask
+
+    Returns:
+        np.ndarray: the boolean mask
+    """
+    if mask.dtype in (np.int8, np.uint8, np.bool_):
+        return mask.view(bool)
+    return mask != 0
+
+def _stats_checksum(stats : Dict[str, Any]) -> str:
+    # Checksum of the stored statistics, it covers the dimension, the union cover and the entries (and mask checksums) of the layers
+    checksum = zlib.crc32(f"{list(stats['dimension'])}:{stats['covered']}".encode())
+    for name, layer in stats['layers'].items():
+        checksum = zlib.crc32(f"{name}:{layer['pixcount']}:{list(layer['bbox'])}:{layer['checksum']}".encode(), checksum)
+    return f'{checksum:08x}'
+
+def _valid_stats(stats : Dict[str, Any], dimension : Tuple[int, int], frames : Dict[str, Tuple[int, int, int, int]]) -> bool:
+    # Check the stored statistics against their checksum and the frames (x, y, height, width) of the stored layers
+    if not stats:
+        return False
+    try:
+        if tuple(stats['dimension']) != tuple(dimension) or stats['checksum'] != _stats_checksum(stats) or \
+           set(stats['layers'].keys()) != set(frames.keys()):
+            return False
+        for name, (x, y, height, width) in frames.items():
+            bx, by, bw, bh = stats['layers'][name]['bbox']
+            pixcount = stats['layers'][name]['pixcount']
+            if (pixcount == 0) != (bw == 0) or pixcount > bw * bh:
+                return False
+            # The masks are inside their layers
+            if bw > 0 and height is not None and \
+               (bx < x or by < y or bx + bw > x + width or by + bh > y + height):
+                return False
+        return True
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return False
+
+def _format_stats(
+    title : str,
+    dimension : Tuple[int, int],
+    names : Iterable[str],
+    counts : Dict[str, int],
+    covered : int
+) -> Dict[str, Any]:
+    # Statistics of a multi-layer image based on the pixel counts (see ``phmImage.get_stats``)
+    total = dimension[0] * dimension[1]
+    if total == 0:
+        total = 1
+    lstats = {}
+    defects = []
+    # Layers statistics
+    for name in names:
+        dcount = counts[name]
+        if dcount == 0:
+            continue
+        defects.append(name)
+        sts = {
+            'pixcount' : dcount,
+            'total' : total,
+            'cover' : (dcount / total) * 100
+        }
+        for k,v in sts.items():
+            lstats[f'{name.title()} {k.title()}'] = v
+    # Image statistics
+    mask_cover = (covered / total) * 100
+    return {
+        **lstats,
+        'Name' : title,
+        'Mask Cover' : mask_cover,
+        'Defects' : ','.join(map(str, set(defects))) 
+    }
+
+class LazyImage(ABC):
+    """
+    LazyImage is the base class for imagery data that is decoded on demand.
+    A lazy image keeps a reference to where the data is stored (e.g. a member of a zip file) and decodes it only when the pixels are requested.
+    """
+
+    # cacheable (bool) determine whether the layer keeps the decoded array after the first access.
+    # Compact representations are not cached so the memory footprint stays small.
+    cacheable : bool = True
+
+    @property
+    @abstractmethod
+    def shape(self) -> Tuple[int, ...]:
+        """ The shape of the decoded array. The implementations should provide it without decoding the pixels.
+
+        Returns:
+            Tuple[int, ...]: shape of the decoded array
+        """
+        pass
+
+    @abstractmethod
+    def decode(self) -> np.ndarray:
+        """Decode the imagery data
+
+        Returns:
+            np.ndarray: the decoded array
+        """
+        pass
+
+    def count_nonzero(self) -> int:
+        """Count the number of nonzero pixels. The implementations can override it to avoid decoding the pixels.
+
+        Returns:
+            int: the number of nonzero pixels
+        """
+        return int(np.count_nonzero(self.decode()))
+
+    @classmethod
+    def count_union(cls, images : List['LazyImage']) -> int:
+        """Count the nonzero pixels of the union of images of this type (with the same shape).
+        The implementations can override it to avoid decoding the pixels (e.g. in a compact representation).
+
+        Args:
+            images (List[LazyImage]): the images
+
+        Returns:
+            int: the number of nonzero pixels of the union, or None if the union must be calculated from the decoded pixels
+        """
+        return None
+
+    def bbox(self) -> Tuple[int, int, int, int]:
+        """Bounding box of the nonzero pixels. The implementations can override it to avoid decoding the pixels.
+
+        Returns:
+            Tuple[int, int, int, int]: the bounding box (x, y, width, height)
+        """
+        return bounding_box(self.decode())
+
+    def read_region(self, x : int, y : int, width : int, height : int) -> np.ndarray:
+        """Read a region of the imagery data. The region must be inside of the image.
+        The implementations can override it to decode only the parts intersecting the region (e.g. tiled images).
+
+        Args:
+            x (int): the x position of the region
+            y (int): the y position of the region
+            width (int): the width of the region
+            height (int): the height of the region
+
+        Returns:
+            np.ndarray: the region of the decoded array
+        """
+        return self.decode()[y:y + height, x:x + width]
+
+def bounding_box(mask : np.ndarray) -> Tuple[int, int, int, int]:
+    """Calculate the bounding box of the nonzero pixels of a mask.
+
+    Args:
+        mask (np.ndarray): the mask
+
+    Returns:
+        Tuple[int, int, int, int]: the bounding box (x, y, width, height). All zeros if the mask is empty.
+    """
+    rows = np.flatnonzero(np.any(mask, axis = 1))
+    if rows.size == 0:
+        return (0, 0, 0, 0)
+    cols = np.flatnonzero(np.any(mask, axis = 0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+# Bits of every byte value (256 x 8) and the number of set bits for every byte value
+_BITS_LUT = np.unpackbits(np.arange(256, dtype = np.uint8)[:, np.newaxis], axis = 1)
+_POPCOUNT_LUT = _BITS_LUT.sum(axis = 1)
+
+class PackedMask(LazyImage):
+    """
+    PackedMask is a compact representation of a binary mask where every pixel is stored as one bit (``np.packbits`` rows).
+    The statistics and the class map are calculated from the packed bits and the dense mask is only created on demand.
+    """
+
+    cacheable = False
+
+    def __init__(self, bits : np.ndarray, shape : Tuple[int, int]) -> None:
+        """
+        Args:
+            bits (np.ndarray): packed rows of the mask (``np.packbits(mask, axis = 1)``)
+            shape (Tuple[int, int]): the shape of the dense mask
+        """
+        self.bits = bits
+        self._shape = tuple(shape)
+
+    @classmethod
+    def from_array(cls, mask : np.ndarray):
+        """Create a packed mask from a dense mask
+
+        Args:
+            mask (np.ndarray): the dense mask
+
+        Returns:
+            PackedMask: the packed version of the mask
+        """
+        return cls(np.packbits(mask != 0, axis = 1), mask.shape[:2])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def decode(self) -> np.ndarray:
+        return np.unpackbits(self.bits, axis = 1, count = self._shape[1]).view(np.int8)
+
+    def count_nonzero(self) -> int:
+        return int(_POPCOUNT_LUT[self.bits].sum(dtype = np.int64))
+
+    def any(self) -> bool:
+        return bool(self.bits.any())
+
+    def bbox(self) -> Tuple[int, int, int, int]:
+        rows = np.flatnonzero(np.any(self.bits, axis = 1))
+        if rows.size == 0:
+            return (0, 0, 0, 0)
+        # The columns are found from the OR of the packed rows
+        cols = np.bitwise_or.reduce(self.bits[rows[0]:rows[-1] + 1], axis = 0)
+        cols = np.flatnonzero(np.unpackbits(cols, count = self._shape[1]))
+        return (int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1))
+
+    def classmap(self, class_id : int, dtype : np.dtype = None) -> np.ndarray:
+        """Calculate the class map directly from the packed bits using a lookup table (one entry per byte value).
+
+        Args:
+            class_id (int): class identifier
+            dtype (np.dtype, optional): data type of the class map. Defaults to ``classmap_dtype``.
+
+        Returns:
+            np.ndarray: class map
+        """
+        dtype = classmap_dtype([class_id]) if dtype is None else np.dtype(dtype)
+        lut = _BITS_LUT.astype(dtype) * _class_value(class_id, dtype)
+        height, width = self._shape
+        return lut[self.bits].reshape(height, -1)[:, :width]
+
+class LabelStack:
+    """
+    LabelStack keeps the masks of all layers of a multi-layer image in one H x W bitfield where the bit *k* presents the layer *k*.
+    The per-layer masks, the class map, the mask cover and the per-layer pixel counts are derived from the bitfield in a single vectorized pass.
+    """
+
+    # Number of pixels processed at once when the histogram of the bitfield is calculated
+    __CHUNK_SIZE = 1 << 20
+
+    def __init__(self, bits : np.ndarray, count : int) -> None:
+        """
+        Args:
+            bits (np.ndarray): the bitfield (H x W unsigned integers)
+            count (int): number of layers in the bitfield
+        """
+        self.bits = bits
+        self.count = count
+        self._histogram = None
+
+    @staticmethod
+    def bits_dtype(count : int) -> np.dtype:
+        """The smallest unsigned integer type which can keep the given number of layers
+
+        Args:
+            count (int): number of layers
+
+        Raises:
+            ValueError: if the number of layers is more than 64
+
+        Returns:
+            np.dtype: unsigned integer type
+        """
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+            if count <= np.iinfo(dtype).bits:
+                return np.dtype(dtype)
+        raise ValueError('A label stack supports up to 64 layers (%d is given)' % count)
+
+    @classmethod
+    def from_layers(cls, layers : List['Layer'], dimension : Tuple[int, int]):
+        """Create the label stack from the masks of the given layers
+
+        Args:
+            layers (List[Layer]): the layers
+            dimension (Tuple[int, int]): the dimension of the multi-layer image
+
+        Returns:
+            LabelStack: the label stack
+        """
+        dtype = cls.bits_dtype(len(layers))
+        bits = np.zeros(tuple(dimension[:2]), dtype = dtype)
+        for index, layer in enumerate(layers):
+            slices = layer.frame_slices(dimension)
+            if slices is None:
+                continue
+            region = bits[slices[0]]
+            mask = (layer.image[slices[1]] != 0).astype(dtype)
+            np.bitwise_or(region, np.left_shift(mask, dtype.type(index)), out = region)
+        return cls(bits, len(layers))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.bits.shape
+
+    def mask(self, index : int) -> np.ndarray:
+        """The mask of the layer *index*
+
+        Args:
+            index (int): layer index
+
+        Returns:
+            np.ndarray: the mask (int8)
+        """
+        bit = self.bits.dtype.type(1 << index)
+        return (np.bitwise_and(self.bits, bit) != 0).view(np.int8)
+
+    def histogram(self) -> np.ndarray:
+        """The number of pixels for every value of the bitfield. Only supported for up to 16 layers.
+
+        Returns:
+            np.ndarray: the histogram of the bitfield
+        """
+        if self._histogram is None:
+            flat = self.bits.reshape(-1)
+            hist = np.zeros(1 << self.count, dtype = np.int64)
+            for start in range(0, flat.size, self.__CHUNK_SIZE):
+                chunk = np.bincount(flat[start:start + self.__CHUNK_SIZE], minlength = hist.size)
+                hist += chunk
+            self._histogram = hist
+        return self._histogram
+
+    def counts(self) -> np.ndarray:
+        """Pixel count of every layer
+
+        Returns:
+            np.ndarray: pixel counts
+        """
+        if self.count <= 16:
+            hist = self.histogram()
+            values = np.arange(hist.size)
+            return np.array([hist[(values >> k) & 1 == 1].sum() for k in range(self.count)], dtype = np.int64)
+        return np.array([np.count_nonzero(self.mask(k)) for k in range(self.count)], dtype = np.int64)
+
+    def cover(self) -> int:
+        """Number of pixels covered by at least one layer
+
+        Returns:
+            int: number of pixels
+        """
+        if self.count <= 16:
+            return int(self.bits.size - self.histogram()[0])
+        return int(np.count_nonzero(self.bits))
+
+    def classmap(self, class_ids : List[int], dtype : np.dtype = None, out : np.ndarray = None) -> np.ndarray:
+        """Calculate the class map where the bigger class ids are preferred (a priority lookup table over the bitfield values)
+
+        Args:
+            class_ids (List[int]): the class id of every layer
+            dtype (np.dtype, optional): data type of the class map. Defaults to the type of ``out`` or ``classmap_dtype``.
+            out (np.ndarray, optional): the buffer for storing the class map. Defaults to None.
+
+        Returns:
+            np.ndarray: class map
+        """
+        if dtype is None:
+            dtype = out.dtype if out is not None else classmap_dtype(class_ids)
+        dtype = np.dtype(dtype)
+        if self.count <= 16:
+            values = np.arange(1 << self.count)
+            lut = np.zeros(values.size, dtype = dtype)
+            for k, cid in enumerate(class_ids):
+                np.maximum(lut, _class_value(cid, dtype), out = lut, where = (values >> k) & 1 == 1)
+            return np.take(lut, self.bits, out = out)
+        result = np.zeros(self.shape, dtype = dtype) if out is None else out
+        if out is not None:
+            result.fill(0)
+        for k, cid in enumerate(class_ids):
+            bit = self.bits.dtype.type(1 << k)
+            np.maximum(result, _class_value(cid, dtype), out = result, where = np.bitwise_and(self.bits, bit) != 0)
+        return result
+
+class StackedMask(LazyImage):
+    """
+    StackedMask presents the mask of one layer kept inside a shared ``LabelStack``.
+    """
+
+    cacheable = False
+
+    def __init__(self, stack : LabelStack, index : int) -> None:
+        """
+        Args:
+            stack (LabelStack): the shared label stack
+            index (int): the index of the layer in the label stack
+        """
+        self.stack = stack
+        self.index = index
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.stack.shape
+
+    def decode(self) -> np.ndarray:
+        return self.stack.mask(self.index)
+
+    def count_nonzero(self) -> int:
+        return int(self.stack.counts()[self.index])
+
 @dataclass(init=False)
 class Layer:
     """
@@ -34,22 +465,35 @@ class Layer:
     visibility : bool = field(default=True, compare=False)
     # Class identifier
     class_id : int = field(default=1, compare=False)
-    # image (PIL.Image) the imagery data of the layer. Default None
-    image : np.ndarray = field(default=None, compare=False)
+    # image (np.ndarray) the imagery data of the layer. Default None
+    _image : np.ndarray = field(default=None, repr=False, compare=False)
+    # source (LazyImage) the source used for decoding the imagery data on demand. Default None
+    _source : LazyImage = field(default=None, repr=False, compare=False)
+    # dirty (bool) determine whether the imagery data is modified after it is loaded from its source
+    _dirty : bool = field(default=True, repr=False, compare=False)
+    # checksum (int) the checksum of the decoded data (used for detecting in-place modifications)
+    _checksum : int = field(default=None, repr=False, compare=False)
     # x (int) the x position of the layer. Normally it should be always zero but it can be non-zero in case the layer is smaller than the image size.
     x : int = field(default=0, compare=False)
     # y (int) the y position of the layer. Normally it should be always zero but it can be non-zero in case the layer is smaller than the image size.
     y : int = field(default=0, compare=False)
 
+    # Number of times the layers are renamed (used for invalidating the name indexes)
+    _renames : ClassVar[int] = 0
+
     def __init__(self,
         name: str,
         opacity: float = 1,
         visibility: bool = True,
         class_id: int = 1,
-        image: np.ndarray = None,
+        image: Union[np.ndarray, LazyImage] = None,
         x: int = 0,
         y: int = 0
     ) -> None:
+        self._image = None
+        self._source = None
+        self._dirty = True
+        self._checksum = None
         self.name = name
         self.opacity = opacity
         self.visibility = visibility
@@ -64,45 +508,353 @@ class Layer:
     
     @name.setter
     def name(self, name):
+        if getattr(self, '_name', None) is not None:
+            # Renaming a layer invalidates the name indexes of the layer lists
+            Layer._renames += 1
         self._name = name.strip().lower()
 
+    @property
+    def image(self) -> np.ndarray:
+        """ The imagery data of the layer. If the layer is lazy, the data is decoded on the first access.
+        The masks kept in a compact representation (see ``compact_source``) are decoded on each access as read-only arrays,
+        they are modified by assigning a new image or after ``unpack``.
+
+        Returns:
+            np.ndarray: the imagery data
+        """
+        if self.compact_source is not None:
+            image = self._source.decode()
+            # An in-place modification of the decoded copy would be lost
+            image.flags.writeable = False
+            return image
+        self.load()
+        return self._image
+
+    @image.setter
+    def image(self, image : Union[np.ndarray, LazyImage]):
+        self._checksum = None
+        if isinstance(image, LazyImage):
+            self._source = image
+            self._image = None
+            # The data is presented by the source
+            self._dirty = False
+        else:
+            self._source = None
+            self._image = image
+            self._dirty = True
+
+    @property
+    def source(self) -> LazyImage:
+        """ The source used for decoding the imagery data on demand (None if the layer is not lazy).
+
+        Returns:
+            LazyImage: the source of imagery data
+        """
+        return self._source
+
+    @property
+    def compact_source(self) -> LazyImage:
+        """ The source of the layer if the mask is kept in a compact representation (e.g. packed bits or RLE) instead of a dense array.
+
+        Returns:
+            LazyImage: the compact source or None
+        """
+        if self._image is None and self._source is not None and not self._source.cacheable:
+            return self._source
+        return None
+
+    def is_loaded(self) -> bool:
+        """ Check if the imagery data of the layer is already decoded.
+
+        Returns:
+            bool: True if the imagery data is in memory
+        """
+        return self._image is not None
+
+    def load(self, decode : Callable = None) -> None:
+        """ Decode the imagery data of a lazy layer if it is not already decoded.
+        Compact sources (e.g. ``PackedMask``) are never kept decoded.
+
+        Args:
+            decode (Callable, optional): the function decoding the source (e.g. using worker threads). Defaults to None (the ``decode`` method of the source).
+        """
+        if self._image is None and self._source is not None and self._source.cacheable:
+            self._image = decode() if decode is not None else self._source.decode()
+            if not self._dirty:
+                self._checksum = _content_checksum(self._image)
+
+    def is_dirty(self) -> bool:
+        """ Check if the imagery data is modified since it was loaded from its source. 
+        Assigning a new image makes the layer dirty. The in-place modifications of the decoded data are detected using a checksum,
+        and the read-only decoded data (e.g. memory-mapped pages) is never modified.
+
+        Returns:
+            bool: True if the imagery data is modified (or it does not have a source)
+        """
+        if self._dirty or self._source is None:
+            return True
+        if self._image is not None and self._checksum is not None:
+            return _checksum(self._image) != self._checksum
+        return False
+
+    def mark_dirty(self) -> None:
+        """ Mark the imagery data as modified."""
+        self._dirty = True
+
+    def mark_clean(self) -> None:
+        """ Mark the imagery data as identical to its source."""
+        if self._source is not None:
+            self._dirty = False
+            if self._image is not None and self._source.cacheable:
+                self._checksum = _content_checksum(self._image)
+
+    def pack(self) -> None:
+        """ Store the mask of the layer as packed bits (one bit per pixel)."""
+        if not self.is_packed():
+            self.image = PackedMask.from_array(self.image)
+
+    def unpack(self) -> None:
+        """ Store the mask of the layer as a dense array (e.g. for modifying it in place)."""
+        if self.compact_source is not None:
+            self.image = self._source.decode()
+
+    def is_packed(self) -> bool:
+        """ Check if the mask of the layer is stored as packed bits.
+
+        Returns:
+            bool: True if the mask is packed
+        """
+        return isinstance(self.compact_source, PackedMask)
+
+    def release(self) -> None:
+        """ Release the decoded imagery data of a lazy layer. The data is decoded again on the next access.
+        The function does nothing if the layer is not lazy or its data is modified.
+        """
+        if self._source is not None and not self.is_dirty():
+            self._image = None
+            self._checksum = None
+
     def is_valid(self) -> bool:
         """ Check if the layer is valid. The image is valid if the image field is initialized!
 
         Returns:
             bool: True if valid
         """
-        return self.image is not None
+        return self._image is not None or self._source is not None
 
     def is_empty(self) -> bool:
-        return np.sum(self.image)
+        """ Check if the mask of the layer does not contain any pixel.
+
+        Returns:
+            bool: True if the mask is empty
+        """
+        if self.is_packed():
+            return not self._source.any()
+        return self.pixcount() == 0
+
+    def pixcount(self) -> int:
+        """ Number of pixels in the mask of the layer.
+
+        Returns:
+            int: number of nonzero pixels
+        """
+        if self.compact_source is not None:
+            return self._source.count_nonzero()
+        return int(np.count_nonzero(self.image))
+
+    def _mask_bbox(self) -> Tuple[int, int, int, int]:
+        if self.compact_source is not None:
+            return self._source.bbox()
+        return bounding_box(self.image)
+
+    def bbox(self) -> Tuple[int, int, int, int]:
+        """ Bounding box of the mask of the layer in the coordinates of the multi-layer image (the offsets of the layer are considered).
+
+        Returns:
+            Tuple[int, int, int, int]: the bounding box (x, y, width, height)
+        """
+        bx, by, bw, bh = self._mask_bbox()
+        if bw == 0:
+            return (0, 0, 0, 0)
+        return (bx + self.x, by + self.y, bw, bh)
+
+    def is_cropped(self, dimension : Tuple[int, int]) -> bool:
+        """ Check if the layer does not cover the whole multi-layer image.
+
+        Args:
+            dimension (Tuple[int, int]): the dimension of the multi-layer image
+
+        Returns:
+            bool: True if the layer is smaller than the image or it has offsets
+        """
+        return self.x != 0 or self.y != 0 or self.dimension != tuple(dimension[:2])
+
+    def frame_slices(self, dimension : Tuple[int, int]) -> Tuple[Tuple[slice, slice], Tuple[slice, slice]]:
+        """ Slices mapping the layer into the multi-layer image considering the offsets of the layer.
+
+        Args:
+            dimension (Tuple[int, int]): the dimension of the multi-layer image
+
+        Returns:
+            Tuple[Tuple[slice, slice], Tuple[slice, slice]]: the slices of the image and the slices of the layer. None if the layer is outside of the image.
+        """
+        height, width = self.dimension
+        fy0, fx0 = max(self.y, 0), max(self.x, 0)
+        fy1, fx1 = min(self.y + height, dimension[0]), min(self.x + width, dimension[1])
+        if fy1 <= fy0 or fx1 <= fx0:
+            return None
+        return (
+            (slice(fy0, fy1), slice(fx0, fx1)),
+            (slice(fy0 - self.y, fy1 - self.y), slice(fx0 - self.x, fx1 - self.x))
+        )
+
+    def expand(self, dimension : Tuple[int, int], data : np.ndarray = None) -> np.ndarray:
+        """ Place the data of the layer (by default the mask) in a full-size frame of the multi-layer image.
+
+        Args:
+            dimension (Tuple[int, int]): the dimension of the multi-layer image
+            data (np.ndarray, optional): the data with the size of the layer (e.g. class map). Defaults to the mask of the layer.
+
+        Returns:
+            np.ndarray: the data with the size of the multi-layer image
+        """
+        data = self.image if data is None else data
+        if not self.is_cropped(dimension):
+            return data
+        result = np.zeros(tuple(dimension[:2]) + data.shape[2:], dtype = data.dtype)
+        slices = self.frame_slices(dimension)
+        if slices is not None:
+            result[slices[0]] = data[slices[1]]
+        return result
+
+    def cropped(self) -> 'Layer':
+        """ Create a copy of the layer cropped to the bounding box of its mask. The offsets of the layer are updated accordingly.
+        An empty layer is cropped to a single pixel.
+
+        Returns:
+            Layer: the cropped layer
+        """
+        bx, by, bw, bh = self._mask_bbox()
+        if bw == 0:
+            image = np.zeros((1, 1), dtype = self.image.dtype)
+            x, y = 0, 0
+        else:
+            image = self.image[by:by + bh, bx:bx + bw].copy()
+            x, y = self.x + bx, self.y + by
+        return Layer(
+            name = self.name,
+            opacity = self.opacity,
+            visibility = self.visibility,
+            class_id = self.class_id,
+            image = image,
+            x = x, y = y
+        )
+
+    def crop(self) -> None:
+        """ Crop the layer to the bounding box of its mask and keep the position using the offsets of the layer."""
+        packed = self.is_packed()
+        layer = self.cropped()
+        self.image = layer.image
+        self.x, self.y = layer.x, layer.y
+        if packed:
+            self.pack()
+
+    def uncropped(self, dimension : Tuple[int, int]) -> 'Layer':
+        """ Provide the layer with the full size of the multi-layer image. It is used for storing the layers in formats not supporting offsets.
+
+        Args:
+            dimension (Tuple[int, int]): the dimension of the multi-layer image
+
+        Returns:
+            Layer: the layer itself if it is not cropped, otherwise a full-size copy.
+        """
+        if not self.is_cropped(dimension):
+            return self
+        return Layer(
+            name = self.name,
+            opacity = self.opacity,
+            visibility = self.visibility,
+            class_id = self.class_id,
+            image = self.expand(dimension)
+        )
     
-    def get_stats(self) -> Dict[str, float]:
+    def read_region(self, x : int, y : int, width : int, height : int) -> np.ndarray:
+        """ Read a region of the layer in the coordinates of the multi-layer image (the offsets of the layer are considered).
+        If the layer is not decoded, only the region is read from its source (see ``LazyImage.read_region``). 
+        The pixels of the region outside of the layer are zero.
+
+        Args:
+            x (int): the x position of the region
+            y (int): the y position of the region
+            width (int): the width of the region
+            height (int): the height of the region
+
+        Returns:
+            np.ndarray: the region (height x width)
+        """
+        lheight, lwidth = self.dimension
+        # The region in the coordinates of the layer
+        x0, y0 = min(max(x - self.x, 0), lwidth), min(max(y - self.y, 0), lheight)
+        x1, y1 = max(min(x - self.x + width, lwidth), x0), max(min(y - self.y + height, lheight), y0)
+        if self._image is None and self._source is not None:
+            part = self._source.read_region(x0, y0, x1 - x0, y1 - y0)
+        else:
+            part = self._image[y0:y1, x0:x1]
+        if part.shape[:2] == (height, width):
+            return part
+        region = np.zeros((height, width) + part.shape[2:], dtype = part.dtype)
+        ry, rx = y0 + self.y - y, x0 + self.x - x
+        region[ry:ry + part.shape[0], rx:rx + part.shape[1]] = part
+        return region
+
+    def get_stats(self, dimension : Tuple[int, int] = None) -> Dict[str, float]:
         """Provide statistics about the layer
 
+        Args:
+            dimension (Tuple[int, int], optional): the dimension of the multi-layer image used for calculating the cover. Defaults to the dimension of the layer.
+
         Returns:
             Dict[str, float]: Calculated statistics
         """
-        total = self.dimension[0] * self.dimension[1]
+        dimension = self.dimension if dimension is None else dimension
+        total = dimension[0] * dimension[1]
         if total == 0: 
             total = 1
-        dcount = np.sum(self.image)
+        dcount = self.pixcount()
         return {
             'pixcount' : dcount,
             'total' : total,
             'cover' : (dcount / total) * 100
         }
 
-    def classmap(self) -> np.ndarray:
+    def classmap(self, dtype : np.dtype = None, out : np.ndarray = None) -> np.ndarray:
         """Calculate class map of the layer. The class map uses the mask and the classid to create class map.
 
+        Args:
+            dtype (np.dtype, optional): data type of the class map. Defaults to the type of ``out`` or ``classmap_dtype``.
+            out (np.ndarray, optional): the buffer (with the size of the layer) for storing the class map. Defaults to None.
+
         Returns:
             numpy.ndarray: classmap
         """
-        return self.image * self.class_id
+        if dtype is None and out is None:
+            if self.is_packed():
+                return self._source.classmap(self.class_id)
+            return self.image * np.array(self.class_id, dtype = np.min_scalar_type(self.class_id))
+
+        dtype = np.dtype(out.dtype if dtype is None else dtype)
+        if self.is_packed():
+            cmap = self._source.classmap(self.class_id, dtype)
+            if out is None:
+                return cmap
+            out[...] = cmap
+            return out
+        result = np.empty(self.dimension, dtype = dtype) if out is None else out
+        np.multiply(self.image, _class_value(self.class_id, dtype), out = result, casting = 'unsafe')
+        return result
     
     def classmap_rgb(self) -> np.ndarray:
-        return np.array(Image.fromarray(self.classmap().astype('uint8')).convert('RGB'))
+        return np.repeat(self.classmap(np.uint8)[..., np.newaxis], 3, axis = 2)
     
     def classmap_rgba(self) -> np.ndarray:
         img = self.classmap().astype('uint8')
@@ -122,7 +874,71 @@ class Layer:
         Returns:
             Tuple[int, int]: The size of the layer (width, height)
         """
-        return (self.image.shape[0], self.image.shape[1])
+        shape = self._source.shape if self._image is None and self._source is not None else self.image.shape
+        return (shape[0], shape[1])
+
+class LayerList(list):
+    """
+    LayerList is the list of mask layers of a multi-layer image which keeps a name index of the layers.
+    The index is rebuilt on the first lookup after the list is modified or a layer is renamed, so the lookups are constant-time.
+    """
+
+    def __init__(self, layers : Iterable[Layer] = ()) -> None:
+        super().__init__(layers)
+        self._index = None
+        self._renames = -1
+
+    def _modifier(name : str):
+        method = getattr(list, name)
+        @functools.wraps(method)
+        def __modify(self, *args, **kwargs):
+            self._index = None
+            return method(self, *args, **kwargs)
+        return __modify
+
+    __setitem__ = _modifier('__setitem__')
+    __delitem__ = _modifier('__delitem__')
+    __iadd__ = _modifier('__iadd__')
+    __imul__ = _modifier('__imul__')
+    append = _modifier('append')
+    extend = _modifier('extend')
+    insert = _modifier('insert')
+    pop = _modifier('pop')
+    remove = _modifier('remove')
+    clear = _modifier('clear')
+    sort = _modifier('sort')
+    reverse = _modifier('reverse')
+    del _modifier
+
+    @property
+    def index_map(self) -> Dict[str, Layer]:
+        """The name index of the layers (the first layer is kept if the names are duplicated)
+
+        Returns:
+            Dict[str, Layer]: layer name -> layer
+        """
+        if self._index is None or self._renames != Layer._renames:
+            index = {}
+            for layer in self:
+                index.setdefault(layer.name, layer)
+            self._index = index
+            self._renames = Layer._renames
+        return self._index
+
+    def get(self, name : str, default : Layer = None) -> Layer:
+        """Getting the layer based on its name
+
+        Args:
+            name (str): layer name
+            default (Layer, optional): the returned value if the layer does not exist. Defaults to None.
+
+        Returns:
+            Layer: the layer
+        """
+        return self.index_map.get(name, default)
+
+    def names(self) -> Tuple[str]:
+        return tuple(layer.name for layer in self)
 
 def from_image(img : Image) -> np.ndarray:
     """Convert a ``PIL.Image`` to ``numpy.ndarray`` presenting the layer.
@@ -140,11 +956,12 @@ def from_image(img : Image) -> np.ndarray:
     return np.where(np.asarray(img_ch) != 0, 1, 0).astype(np.int8)
 
 def create_image(layer : Layer) -> Image:
-    img = Image.fromarray(layer.classmap(), mode = 'L')
+    # The gray channel keeps the class id (8 bits)
+    img = Image.fromarray(layer.classmap(np.uint8))
 
     # Add alpha channel to the image.
-    alpha = np.where(layer.image != 0, 255, 0).astype(np.int8)
-    alpha = Image.fromarray(alpha, mode = 'L')
+    alpha = np.where(layer.image != 0, 255, 0).astype(np.uint8)
+    alpha = Image.fromarray(alpha)
     img.putalpha(alpha)
     return img
 
@@ -169,10 +986,11 @@ def default_create_blendimage_func(orig : np.ndarray, layers : List[np.ndarray])
         # So bigger class ids will be preferred pixel by pixel.
         # It is assumed that the layers have one color channel
         blayer = np.max(merged, axis = 2)
-        alpha = np.where(blayer != 0, 255, 0).astype(np.int8)
+        alpha = np.where(blayer != 0, 255, 0).astype(np.uint8)
         
-        blayer = Image.fromarray(blayer, mode = 'L')
-        alpha = Image.fromarray(alpha, mode = 'L')
+        # The class maps may use wider types than one byte (e.g. int16)
+        blayer = Image.fromarray(blayer.astype(np.uint8))
+        alpha = Image.fromarray(alpha)
         blayer.putalpha(alpha)
 
         result = Image.alpha_composite(lorig, blayer.convert('RGBA'))
@@ -196,7 +1014,7 @@ class BaseArchive(ABC):
         self.set_asset(path, data)
 
     def __getitem__(self, path : str) -> np.ndarray:
-        return self.get_asset()
+        return self.get_asset(path)
 
     @abstractmethod
     def set_assets(self, assets : Dict[str, np.ndarray]):
@@ -229,6 +1047,115 @@ class BaseArchive(ABC):
     ):
         pass
 
+@dataclass
+class LayerInfo:
+    """
+    LayerInfo is the metadata of a layer stored in a multi-layer image file (see ``phmImageInfo``).
+    """
+
+    # name (str) the name of layer
+    name : str
+    # dimension (Tuple[int, int]) the size of the stored layer (height, width). None if it is unknown.
+    dimension : Tuple[int, int] = None
+    # x (int) the x position of the layer
+    x : int = 0
+    # y (int) the y position of the layer
+    y : int = 0
+    # size (int) the number of bytes used for storing the layer in the file. None if it is unknown.
+    size : int = None
+    # opacity (float) the opacity of the layer
+    opacity : float = 1.0
+    # visibility (bool) determine whether the layer is hidden (False) or not (True)
+    visibility : bool = True
+
+    def __post_init__(self):
+        # Layer names are normalized as in ``Layer``
+        self.name = self.name.strip().lower()
+
+@dataclass
+class phmImageInfo:
+    """
+    phmImageInfo is the metadata of a multi-layer image file, which is read without decoding the imagery data (see ``BaseFileHandler.peek``).
+    """
+
+    # filepath (str) the path to the file
+    filepath : str
+    # title (str) the title of the image
+    title : str
+    # dimension (Tuple[int, int]) the size of the image (height, width)
+    dimension : Tuple[int, int]
+    # properties (Dict) the properties of the image (as presented by ``phmImage.properties``)
+    properties : Dict = field(default_factory=dict)
+    # metrics (Dict) the metrics of the image
+    metrics : Dict = field(default_factory=dict)
+    # layers (List[LayerInfo]) the metadata of the mask layers
+    layers : List[LayerInfo] = field(default_factory=list)
+    # size (int) the number of bytes used for storing the original image in the file. None if it is unknown.
+    size : int = None
+    # stats (Dict) the statistics stored in the file at save time (see ``phmImage.stats_metadata``). None if they are not stored.
+    stats : Dict = None
+
+    def __post_init__(self):
+        # The title is presented in the properties as in ``phmImage``
+        self.properties = {'title' : self.title, **self.properties}
+
+    @property
+    def layer_names(self) -> Tuple[str]:
+        """List of the mask layers' name
+
+        Returns:
+            Tuple[str]: List of mask layers
+        """
+        return tuple(layer.name for layer in self.layers)
+
+    @property
+    def width(self) -> int:
+        return self.dimension[1]
+
+    @property
+    def height(self) -> int:
+        return self.dimension[0]
+
+    def has_valid_stats(self) -> bool:
+        """Check if the stored statistics match the image, i.e. they are stored for the same dimension and the same layers,
+        they match their checksum (stale or partially updated statistics are rejected), and the masks lie inside the stored layers.
+
+        Returns:
+            bool: True if the stored statistics can be used instead of the masks
+        """
+        frames = {
+            layer.name : (layer.x, layer.y) + (tuple(layer.dimension) if layer.dimension is not None else (None, None))
+            for layer in self.layers
+        }
+        return _valid_stats(self.stats, self.dimension, frames)
+
+    def get_pixcounts(self) -> Dict[str, int]:
+        """The stored pixel counts of the layers (see ``phmImage.get_stats``).
+
+        Returns:
+            Dict[str, int]: the pixel count of the layers. Empty if the statistics are not stored for the dimension of the image or they do not match their checksum.
+        """
+        try:
+            if tuple(self.stats['dimension']) != tuple(self.dimension) or self.stats['checksum'] != _stats_checksum(self.stats):
+                return {}
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return {}
+        return {
+            name : int(layer['pixcount'])
+            for name, layer in self.stats['layers'].items() 
+            if name in self.layer_names
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Provides the statistics of the multi-layer image (as ``phmImage.get_stats``) using the stored statistics.
+
+        Returns:
+            Dict[str, Any]: the statistics. None if the stored statistics are missing or they do not match the image.
+        """
+        if not self.has_valid_stats():
+            return None
+        return _format_stats(self.title, self.dimension, self.layer_names, self.get_pixcounts(), int(self.stats['covered']))
+
 class phmImage:
     """ 
     It is the class for the multi-layer image.
@@ -237,7 +1164,7 @@ class phmImage:
     def __init__(self,
         filepath : str,
         properties : Dict,
-        orig_image : np.ndarray,
+        orig_image : Union[np.ndarray, LazyImage],
         layers : List[Layer] = [],
         title : str = None,
         metrics : Dict = {},
@@ -257,7 +1184,7 @@ class phmImage:
         }
         # Metrics
         self.metrics = metrics
-        # Layers
+        # Layers (the layers are kept in a list indexed by their names)
         self.layers = layers
         # Original Layer
         self.orig_layer = Layer(
@@ -268,6 +1195,19 @@ class phmImage:
         # Archive
         self.archive = archive
 
+    @property
+    def layers(self) -> LayerList:
+        """The mask layers of the multi-layer image
+
+        Returns:
+            LayerList: the list of mask layers
+        """
+        return self._layers
+
+    @layers.setter
+    def layers(self, layers : Iterable[Layer]):
+        self._layers = LayerList(layers)
+
     def update_from(self, img, only_layers : bool = False):
         # Update layers
         self.layers = list(img.layers)
@@ -277,32 +1217,230 @@ class phmImage:
             # Update metrics
             self.metrics.update(img.metrics)
 
-    def get_stats(self):
-        """Provides statistics about the multi-layer image
+    def release(self) -> None:
+        """Release the decoded imagery data of the lazy layers (original and mask layers)"""
+        for layer in self:
+            layer.release()
+
+    def stack_layers(self) -> LabelStack:
+        """Keep the masks of the layers in one shared label stack (see ``LabelStack``). The layers present views of the label stack.
+
+        Returns:
+            LabelStack: the label stack
+        """
+        stack = LabelStack.from_layers(self.layers, self.dimension)
+        for index, layer in enumerate(self.layers):
+            layer.image = StackedMask(stack, index)
+            layer.x, layer.y = 0, 0
+        return stack
+
+    def unstack_layers(self) -> None:
+        """Store the masks of the layers as separated dense arrays."""
+        for layer in self.layers:
+            if isinstance(layer.compact_source, StackedMask):
+                layer.image = layer.compact_source.decode()
+
+    @property
+    def label_stack(self) -> LabelStack:
+        """The label stack keeping the masks of all layers. None if the layers are not stacked or they are modified after stacking.
+
+        Returns:
+            LabelStack: the label stack
+        """
+        stack = None
+        for index, layer in enumerate(self.layers):
+            source = layer.compact_source
+            if not isinstance(source, StackedMask) or source.index != index or \
+               (stack is not None and source.stack is not stack) or layer.x != 0 or layer.y != 0:
+                return None
+            stack = source.stack
+        if stack is None or stack.count != len(self.layers):
+            return None
+        return stack
+
+    def read_region(self, 
+        x : int, y : int, 
+        width : int, height : int, 
+        layers : List[str] = None,
+        original : bool = True
+    ) -> 'phmImage':
+        """Read a region of the multi-layer image. The lazy layers (e.g. tiled images) decode only the parts intersecting the region,
+        so the image is never entirely loaded in memory.
 
         Args:
-            categories (Dict[str, int]): the categories of interest
+            x (int): the x position of the region
+            y (int): the y position of the region
+            width (int): the width of the region
+            height (int): the height of the region
+            layers (List[str], optional): the name of the layers to read. Defaults to all layers.
+            original (bool, optional): if False, the original image is not read and it is presented by zeros. Defaults to True.
+
+        Returns:
+            phmImage: the region as a multi-layer image
         """
-        lstats = {}
-        defects = []
-        # Layers statistics
+        names = self.layer_names if layers is None else layers
+        region_layers = []
+        for name in names:
+            layer = self.get_layer(name.strip().lower())
+            region_layers.append(Layer(
+                name = layer.name,
+                opacity = layer.opacity,
+                visibility = layer.visibility,
+                class_id = layer.class_id,
+                image = layer.read_region(x, y, width, height)
+            ))
+        if original:
+            orig = self.orig_layer.read_region(x, y, width, height)
+        else:
+            orig = np.broadcast_to(np.zeros(1, dtype = np.uint8), (height, width, 3))
+        return phmImage(
+            filepath = self.filepath,
+            properties = dict(self.properties),
+            orig_image = orig,
+            layers = region_layers,
+            title = self.title,
+            metrics = dict(self.metrics)
+        )
+
+    def crop_layers(self) -> None:
+        """Crop the mask layers to the bounding box of their masks. The positions are kept using the offsets of the layers."""
         for layer in self.layers:
-            sts = layer.get_stats()
-            if sts['pixcount'] == 0:
-                continue
-            defects.append(layer.name)
-            for k,v in sts.items():
-                lstats[f'{layer.name.title()} {k.title()}'] = v
-        # Image statistics
-        ls = np.dstack([l.image for l in self.layers])
-        ls = np.max(ls, axis = 2)
-        mask_cover = (np.sum(ls) / (self.dimension[0] * self.dimension[1])) * 100    
-        return {
-            **lstats,
-            'Name' : self.title,
-            'Mask Cover' : mask_cover,
-            'Defects' : ','.join(map(str, set(defects))) 
+            layer.crop()
+
+    def count_pixels(self, 
+        pixcounts : Dict[str, int] = None, 
+        covered : int = None
+    ) -> Tuple[Dict[str, int], int]:
+        """Count the pixels of every layer and the pixels covered by the union of the layers.
+        Every mask is visited once: its pixels are counted with ``np.count_nonzero`` and it is merged into the union cover with an in-place OR.
+        Lazy layers which are not decoded before are released after they are counted.
+        The union of compact masks is counted without decoding them if their type supports it (see ``LazyImage.count_union``).
+
+        Args:
+            pixcounts (Dict[str, int], optional): precomputed pixel counts of the layers (e.g. stored in the file metadata). Defaults to None.
+            covered (int, optional): precomputed number of pixels covered by the union of the layers. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, int], int]: the pixel count of every layer and the number of covered pixels
+        """
+        return self._count_pixels(pixcounts, covered)
+
+    def _count_pixels(self,
+        pixcounts : Dict[str, int] = None,
+        covered : int = None,
+        visit : Callable[['Layer', np.ndarray], None] = None
+    ) -> Tuple[Dict[str, int], int]:
+        # Count the pixels (see ``count_pixels``), the visit function is called with every decoded mask (as a boolean mask) before it is released
+        pixcounts = {} if pixcounts is None else pixcounts
+        dimension = self.dimension
+        counts = {}
+        stack = self.label_stack
+        if stack is not None:
+            stack_counts = stack.counts()
+            for index, layer in enumerate(self.layers):
+                counts[layer.name] = int(pixcounts.get(layer.name, stack_counts[index]))
+            return counts, stack.cover() if covered is None else covered
+
+        if covered is None and self.layers:
+            # The union of compact masks of the same type is counted without decoding them (e.g. ``RLEMask``)
+            sources = [layer.compact_source for layer in self.layers]
+            kinds = {type(source) for source in sources}
+            if len(kinds) == 1 and sources[0] is not None and not any(layer.is_cropped(dimension) for layer in self.layers):
+                covered = kinds.pop().count_union(sources)
+        cover = np.zeros(dimension, dtype = bool) if covered is None else None
+        for layer in self.layers:
+            if layer.name in pixcounts:
+                counts[layer.name] = int(pixcounts[layer.name])
+                if cover is None:
+                    continue
+            elif cover is None or layer.compact_source is not None:
+                counts[layer.name] = layer.pixcount()
+                if cover is None:
+                    continue
+            loaded = layer.is_loaded()
+            mask = as_bool_mask(layer.image)
+            if layer.name not in counts:
+                counts[layer.name] = int(np.count_nonzero(mask))
+            slices = layer.frame_slices(dimension)
+            if slices is not None:
+                region = cover[slices[0]]
+                np.logical_or(region, mask[slices[1]], out = region)
+            if visit is not None:
+                visit(layer, mask)
+            if not loaded:
+                layer.release()
+        if cover is not None:
+            covered = int(np.count_nonzero(cover))
+        return counts, covered
+
+    def get_stats(self, 
+        pixcounts : Dict[str, int] = None, 
+        covered : int = None
+    ) -> Dict[str, Any]:
+        """Provides statistics about the multi-layer image. Cropped layers are placed at their offsets without expanding them.
+        If the precomputed values are given (e.g. from the file metadata), the masks are not visited at all.
+
+        Args:
+            pixcounts (Dict[str, int], optional): precomputed pixel counts of the layers. Defaults to None.
+            covered (int, optional): precomputed number of pixels covered by the union of the layers. Defaults to None.
+
+        Returns:
+            Dict[str, Any]: the statistics
+        """
+        counts, covered = self.count_pixels(pixcounts, covered)
+        return _format_stats(self.title, self.dimension, self.layer_names, counts, covered)
+
+    def stats_metadata(self, stored : Dict[str, Any] = None) -> Dict[str, Any]:
+        """The statistics stored in the file metadata at save time, so the statistics can be provided without decoding the masks (see ``phmImageInfo.get_stats``).
+        It contains the dimension, the pixel count, the bounding box (in the coordinates of the image), the cover and a checksum of the mask content of every layer
+        (independent of the cropping of the layers), the number of pixels covered by the union of the layers, and a checksum of the statistics.
+
+        Args:
+            stored (Dict[str, Any], optional): the statistics stored in the source file of the layers. They are reused without decoding the masks 
+                if none of the layers is modified (see ``Layer.is_dirty``) and they are valid for the layers. Defaults to None.
+
+        Returns:
+            Dict[str, Any]: the statistics (JSON serializable)
+        """
+        dimension = self.dimension
+        if stored is not None and all(not layer.is_dirty() for layer in self.layers):
+            frames = {layer.name : (layer.x, layer.y) + tuple(layer.dimension) for layer in self.layers}
+            if len(frames) == len(self.layers) and _valid_stats(stored, dimension, frames):
+                return stored
+        total = max(dimension[0] * dimension[1], 1)
+        frames = {}
+
+        def describe(layer : Layer, mask : np.ndarray):
+            # The bounding box and the checksum of a mask, computed while the mask is decoded for counting its pixels
+            bx, by, bw, bh = bounding_box(mask)
+            bbox = (bx + layer.x, by + layer.y, bw, bh) if bw > 0 else (0, 0, 0, 0)
+            checksum = zlib.crc32(np.packbits(mask[by:by + bh, bx:bx + bw]).tobytes()) if bw > 0 else 0
+            frames[layer.name] = (bbox, zlib.crc32(f'{layer.name}:{bbox}'.encode(), checksum))
+
+        counts, covered = self._count_pixels(visit = describe)
+        layers = {}
+        for layer in self.layers:
+            if layer.name not in frames:
+                # The masks counted without being visited (e.g. a label stack)
+                loaded = layer.is_loaded()
+                describe(layer, as_bool_mask(layer.image))
+                if not loaded:
+                    layer.release()
+            bbox, checksum = frames[layer.name]
+            layers[layer.name] = {
+                'pixcount' : counts[layer.name],
+                'bbox' : list(bbox),
+                'cover' : (counts[layer.name] / total) * 100,
+                'checksum' : f'{checksum:08x}'
+            }
+        stats = {
+            'dimension' : list(dimension),
+            'layers' : layers,
+            'covered' : covered,
+            'mask_cover' : (covered / total) * 100
         }
+        stats['checksum'] = _stats_checksum(stats)
+        return stats
 
     def get_metric(self, key : str) -> Any:
         """Returning the metric stored inside the multi-layer image
@@ -368,11 +1506,22 @@ class phmImage:
             Layer: The layer associated to the layer's name
         """
 
-        resly = tuple(filter(lambda l : l.name == layer_name, self.layers))
-        if len(resly) == 0:
+        layer = self.layers.get(layer_name)
+        if layer is None:
              raise KeyError('%s layer does not exist!' % layer_name)
 
-        return resly[0]
+        return layer
+
+    def has_layer(self, layer_name : str) -> bool:
+        """Check if a layer with the given name exists
+
+        Args:
+            layer_name (str): Layer's name
+
+        Returns:
+            bool: True if the layer exists
+        """
+        return layer_name in self.layers.index_map
     
     def get_layer_by_index(self, index : int) -> Layer:
         """Getting a layer based on its index
@@ -392,26 +1541,48 @@ class phmImage:
         
         return self.layers[index]
 
-    def get_classmap(self, fusion_func : Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+    def get_classmap(self, 
+        fusion_func : Callable[[np.ndarray], np.ndarray] = None,
+        dtype : np.dtype = None,
+        out : np.ndarray = None
+    ) -> np.ndarray:
         """Getting classmap based on the given blending function.
+        If no blending function is given, the layers are fused in place (see ``classmap``) without stacking them.
 
         Args:
-            fusion_func (Callable[[np.ndarray], np.ndarray]): blending function
+            fusion_func (Callable[[np.ndarray], np.ndarray], optional): blending function. Defaults to None.
+            dtype (np.dtype, optional): data type of the class map. Defaults to None.
+            out (np.ndarray, optional): the buffer for storing the class map. Defaults to None.
 
         Returns:
             np.ndarray: classmap resulted by applying blending function on the multi-layer image
         """
 
+        if fusion_func is None:
+            return self.classmap(dtype = dtype, out = out)
+
+        dimension = self.dimension
         layers = self.mask_layers
-        ls = [l.classmap() for l in layers]
+        ls = [l.expand(dimension, l.classmap()) for l in layers]
         ls = np.dstack(ls)
-        return fusion_func(ls)
-
-    def get_dp_ready(self, fusion_func : Callable[[np.ndarray], np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
-        """Getting a data item ready to use in deep learning application
+        result = fusion_func(ls)
+        if out is not None:
+            out[...] = result
+            return out
+        return result if dtype is None else result.astype(dtype, copy = False)
+
+    def get_dp_ready(self, 
+        fusion_func : Callable[[np.ndarray], np.ndarray] = None,
+        dtype : np.dtype = None,
+        out : np.ndarray = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Getting a data item ready to use in deep learning application.
+        Training loaders can pass the same ``out`` buffer for every sample, so no class map is allocated per call.
 
         Args:
-            fusion_func (Callable[[np.ndarray], np.ndarray]): blending function
+            fusion_func (Callable[[np.ndarray], np.ndarray], optional): blending function. Defaults to None.
+            dtype (np.dtype, optional): data type of the class map. Defaults to None.
+            out (np.ndarray, optional): the buffer for storing the class map. Defaults to None.
 
         Returns:
             Tuple[np.ndarray, np.ndarray]: a tuple containing the original image and target class map
@@ -419,24 +1590,59 @@ class phmImage:
 
         return (
             self.original_layer.image,
-            self.get_classmap(fusion_func)
+            self.get_classmap(fusion_func, dtype = dtype, out = out)
         )
 
-    def classmap(self) -> np.ndarray:
-        """Calculating class map using default blending function
+    def classmap(self, dtype : np.dtype = None, out : np.ndarray = None) -> np.ndarray:
+        """Calculating class map using default blending function (bigger class ids are preferred).
+        The layers are fused with an in-place running maximum at their offsets, so neither the layers are stacked nor the cropped layers are expanded.
+
+        Args:
+            dtype (np.dtype, optional): data type of the class map. Defaults to the type of ``out`` or ``classmap_dtype``.
+            out (np.ndarray, optional): the buffer for storing the class map (with the size of the image). Defaults to None.
 
         Returns:
             np.ndarray: class map representing the class map using the given categories
         """
-        return self.get_classmap(lambda x : np.amax(x, axis = 2))
+        class_ids = [layer.class_id for layer in self.layers]
+        if dtype is None:
+            dtype = out.dtype if out is not None else classmap_dtype(class_ids)
+        dtype = np.dtype(dtype)
+
+        stack = self.label_stack
+        if stack is not None:
+            return stack.classmap(class_ids, dtype = dtype, out = out)
+
+        dimension = self.dimension
+        if out is None:
+            result = np.zeros(dimension, dtype = dtype)
+        else:
+            if out.shape != tuple(dimension):
+                raise ValueError('The buffer shape %s does not match the image dimension %s' % (out.shape, dimension))
+            result = out
+            result.fill(0)
+        for layer in self.layers:
+            slices = layer.frame_slices(dimension)
+            if slices is None:
+                continue
+            region = result[slices[0]]
+            if layer.compact_source is not None:
+                cmap = layer.classmap(dtype)[slices[1]]
+                np.maximum(region, cmap, out = region)
+            else:
+                # Binary masks stored in one byte are used directly as the condition
+                where = as_bool_mask(layer.image[slices[1]])
+                np.maximum(region, _class_value(layer.class_id, dtype), out = region, where = where)
+        return result
     
     def classmap_rgb(self) -> np.ndarray:
-        return np.array(Image.fromarray(self.classmap().astype('uint8')).convert('RGB'))
+        return np.repeat(self.classmap(np.uint8)[..., np.newaxis], 3, axis = 2)
         
     def blended_image(self, 
         blending_func : Callable[[np.ndarray, List[np.ndarray]], Any] = default_create_blendimage_func
     ) -> Image:
-        """Render a blended version of the multi-layer image
+        """Render a blended version of the multi-layer image.
+        The default blending function receives the merged class map, other blending functions receive the full-size class maps of the layers.
 
         Args:
             blending_func (Callable[[np.ndarray, List[np.ndarray]], Any], optional): blending function. Defaults to default_create_blendimage_func.
@@ -446,7 +1652,11 @@ class phmImage:
         """
 
         orig = self.original_layer.image
-        layers = list(map(lambda x : x.classmap(), self.layers))
+        if blending_func is default_create_blendimage_func:
+            layers = [self.classmap(np.uint8)] if self.layers else []
+        else:
+            dimension = self.dimension
+            layers = list(map(lambda x : x.expand(dimension, x.classmap()), self.layers))
         return blending_func(orig, layers)
     
     def thumbnail(self, size : Tuple[int,int] = (400,350)) -> Image:
@@ -554,10 +1764,44 @@ class phmImage:
         """
         return iter(tuple([self.orig_layer]) + self.mask_layers)
     
+    def __contains__(self, key) -> bool:
+        """Check if the multi-layer image has the layer
+
+        Args:
+            key (Union[str, Layer]): the layer name or the layer
+
+        Returns:
+            bool: True if the layer exists
+        """
+        if isinstance(key, Layer):
+            key = key.name
+        return key == ORIGINAL_LAYER_KEY or self.has_layer(key)
+
     def __str__(self) -> str:
         """Returing the string representation of multi-layer image"""
         return f'{self.title} (Layers : {self.count_layers}) [Dimension : {self.dimension}]'
 
+    def info(self) -> phmImageInfo:
+        """The metadata of the multi-layer image (the on-disk sizes are unknown)
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        return phmImageInfo(
+            filepath = self.filepath,
+            title = self.title,
+            dimension = self.dimension,
+            properties = dict(self.properties),
+            metrics = dict(self.metrics),
+            layers = [LayerInfo(
+                name = layer.name,
+                dimension = layer.dimension,
+                x = layer.x, y = layer.y,
+                opacity = layer.opacity,
+                visibility = layer.visibility
+            ) for layer in self.layers]
+        )
+
     def __getitem__(self, key : str) -> Union[Dict, Layer] :
         """Getting an entity from multi-layer image
 
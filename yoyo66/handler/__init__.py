@@ -9,4 +9,6 @@ from .openraster import *
 from .pkg import *
 from .tiff import *
 from .rle import *
-from .hfive import *
\ No newline at end of file
+from .hfive import *
+from .memmap import *
+from .tiled import *
\ No newline at end of file
@@ -8,9 +8,10 @@ import random
 import pathlib
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Union, Tuple, Any
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, List, Union, Tuple, Any, Callable, Iterable
 
-from yoyo66.datastruct import phmImage
+from yoyo66.datastruct import phmImage, phmImageInfo
 
 # List of file handlers
 file_handlers = {}
@@ -84,14 +85,21 @@ class BaseFileHandler(ABC):
     """
 
     def __init__(self,
-        filter : List[str] = None
+        filter : List[str] = None,
+        max_workers : int = None,
+        executor : Executor = None
     ) -> None:
         """
         Args:
             filter (List[str], optional): List of class names to load. Defaults to None.
+            max_workers (int, optional): the number of threads used for decoding and encoding the layers of a file (None or 1 for no threads). Defaults to None.
+            executor (Executor, optional): a shared executor used instead of creating a thread pool for each file (``max_workers`` is ignored). Defaults to None.
         """
         super().__init__()
 
+        self.max_workers = max_workers
+        self.executor = executor
+
         # File extensions filled by the creator method
         self.file_extensions = []
 
@@ -141,7 +149,43 @@ class BaseFileHandler(ABC):
             # if the img field is given, it means the call method uses the given path to save the multi-level imagery file.
             self.save(img, filepath)
 
+    @property
+    def threaded(self) -> bool:
+        """True if the layers are decoded and encoded by worker threads (see ``max_workers`` and ``executor``)"""
+        return self.executor is not None or (self.max_workers is not None and self.max_workers > 1)
+
+    def _map(self, func : Callable, items : Iterable) -> List:
+        """Apply a function on the items using the worker threads of the file handler.
+        The codecs (png, zlib) release the GIL, so the file handlers run the decoding and encoding of the layers by this function.
+        A job may read its own member of the file (e.g. the png files of pkg and openraster files, each opened by the job),
+        while the files are always written by the calling thread.
+
+        Args:
+            func (Callable): the function applied on each item
+            items (Iterable): the items
+
+        Returns:
+            List: the results in the order of the items
+        """
+        items = list(items)
+        if not self.threaded or len(items) < 2:
+            return [func(item) for item in items]
+        if self.executor is not None:
+            return list(self.executor.map(func, items))
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            return list(executor.map(func, items))
+
     def init_class_id(self, layer_name) -> int:
+        """The class id of a layer, or None if the layer is not accepted by the filter.
+        The file handlers check the layer names before decoding the layers, so the filtered layers are never decoded.
+
+        Args:
+            layer_name (str): the name of the layer (normalized as in ``Layer``)
+
+        Returns:
+            int: the class id of the layer
+        """
+        layer_name = layer_name.strip().lower()
         if not layer_name in self.categories:
             if self._enable_filter:
                 return None
@@ -160,6 +204,19 @@ class BaseFileHandler(ABC):
         """
         pass
 
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a multi-layer image (title, properties, metrics, dimensions, and layers) without decoding the imagery data.
+        File handlers override this function for reading only the headers of the file. 
+        By default, the image is loaded.
+
+        Args:
+            filepath (str): File path
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        return self.load(filepath).info()
+
     @abstractmethod
     def save(self, img : phmImage, filepath : str) -> None:
         """Save a multi-layer image in the specified file path.
@@ -170,12 +227,13 @@ class BaseFileHandler(ABC):
         """
         pass
 
-def build_by_name(name : str, filter : List[str] = None) -> BaseFileHandler:
+def build_by_name(name : str, filter : List[str] = None, **kwargs) -> BaseFileHandler:
     """Build an instance of a file handler based on the given name
 
     Args:
         name (str): name of the file handler
         filter (List[str], optional): List of class names to load. Defaults to None.
+        kwargs: handler-specific options passed to the constructor of the file handler.
 
     Raises:
         KeyError: if the given name is not a registered file handler
@@ -188,17 +246,18 @@ def build_by_name(name : str, filter : List[str] = None) -> BaseFileHandler:
         raise KeyError(f'{name} does not exist in file handlers!')
 
     # Instantiate the handler based on the given name
-    handler = file_handlers[name][0](filter)
+    handler = file_handlers[name][0](filter, **kwargs)
     # Initialize the file extensions associated with the handler!
     handler.file_extensions = file_handlers[name][1]
     return handler
 
-def build_by_file_extension(ext : str, filter : List[str] = None) -> BaseFileHandler:
+def build_by_file_extension(ext : str, filter : List[str] = None, **kwargs) -> BaseFileHandler:
     """Build an instance of a file handler based on the given file extension
 
     Args:
         ext (str): the name of file extension
         filter (List[str], optional): List of class names to load. Defaults to None.
+        kwargs: handler-specific options passed to the constructor of the file handler.
 
     Raises:
         KeyError: if the given name is not a registered file handler
@@ -216,14 +275,15 @@ def build_by_file_extension(ext : str, filter : List[str] = None) -> BaseFileHan
     if name is None: 
         raise KeyError(f'{ext} does not associated with any file handler')
 
-    return build_by_name(name, filter)
+    return build_by_name(name, filter, **kwargs)
 
-def load_file(filepath : str, filter : List[str] = None) -> phmImage:
+def load_file(filepath : str, filter : List[str] = None, **kwargs) -> phmImage:
     """A quick access for loading a file based on its file extension.
 
     Args:
         filepath (str): file path of the multi-layer image file
         filter (List[str], optional): List of class names to load. Defaults to None.
+        kwargs: handler-specific options passed to the constructor of the file handler.
 
     Raises:
         ValueError: if file does not exist
@@ -238,7 +298,30 @@ def load_file(filepath : str, filter : List[str] = None) -> phmImage:
     # Extract file extension of the given file
     ext = pathlib.Path(filepath).suffix[1:]
     # Loading the file handler based on the given file extension
-    handler = build_by_file_extension(ext, filter)
+    handler = build_by_file_extension(ext, filter, **kwargs)
     
     return handler.load(filepath)
 
+def peek_file(filepath : str, filter : List[str] = None, **kwargs) -> phmImageInfo:
+    """A quick access for reading the metadata of a file based on its file extension (see ``BaseFileHandler.peek``).
+
+    Args:
+        filepath (str): file path of the multi-layer image file
+        filter (List[str], optional): List of class names to read. Defaults to None.
+        kwargs: handler-specific options passed to the constructor of the file handler.
+
+    Raises:
+        ValueError: if file does not exist
+
+    Returns:
+        phmImageInfo: the metadata of the multi-layer image
+    """
+
+    if not os.path.isfile(filepath):
+        raise ValueError(f'File is invalid: {filepath}')
+
+    ext = pathlib.Path(filepath).suffix[1:]
+    handler = build_by_file_extension(ext, filter, **kwargs)
+
+    return handler.peek(filepath)
+
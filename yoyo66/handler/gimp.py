@@ -9,7 +9,7 @@ from typing import Any, Callable, Dict, List
 from gimpformats.gimpXcfDocument import GimpDocument
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, Layer, ORIGINAL_LAYER_KEY, from_image
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, ORIGINAL_LAYER_KEY, from_image
 
 @mmfile_handler('gimp', ['xcf'])
 class GIMPFileHandler(BaseFileHandler):
@@ -22,6 +22,14 @@ class GIMPFileHandler(BaseFileHandler):
 
     def __init__(self, filter : List[str] = None) -> None:
         super().__init__(filter)
+
+    def __layers(self, gimp : GimpDocument) -> List:
+        # The list of layers (named raw_layers in the recent versions of gimpformats)
+        return gimp.raw_layers if hasattr(gimp, 'raw_layers') else gimp.layers
+
+    def __is_mask(self, layer) -> bool:
+        # The mask layers keep the mask in their alpha channel, the color mode (with alpha: RGBA, GrayA or IndexedA) is read from the layer header
+        return layer.colorMode in (1, 3, 5)
     
     def load(self, filepath: str, only_imgs : bool = False) -> phmImage:
         """Load the multi-layer image using the presented file path (gimp file).
@@ -48,7 +56,7 @@ class GIMPFileHandler(BaseFileHandler):
         # Go through the layers
         orig_img = None
         layers = []
-        for layer in gimp.layers:
+        for layer in self.__layers(gimp):
             # Check if the layer is a group layers
             if not layer.isGroup:
                 layer_name = layer.name
@@ -57,19 +65,14 @@ class GIMPFileHandler(BaseFileHandler):
                     # Add the original layer
                     orig_img = np.asarray(layer.image)
                 else:
-                    img = layer.image
-                    if img.mode in ("RGBA", "LA") or \
-                        (img.mode == "P" and "transparency" in img.info):
-
-                        class_id = self.init_class_id(layer_name)
-                        if class_id is None:
-                            continue
-                        
-                        limg = from_image(img)
-                        layers.append(Layer(
-                            name = layer_name,
-                            class_id = class_id,
-                            image = limg))
+                    # The filter and the color mode are checked before decoding the layer
+                    class_id = self.init_class_id(layer_name)
+                    if class_id is None or not self.__is_mask(layer):
+                        continue
+                    layers.append(Layer(
+                        name = layer_name,
+                        class_id = class_id,
+                        image = from_image(layer.image)))
 
         return phmImage(
             filepath = filepath,
@@ -78,6 +81,40 @@ class GIMPFileHandler(BaseFileHandler):
             layers = layers
         )
 
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a gimp file (image and layer headers) without decoding the layers.
+
+        Args:
+            filepath (str): the path to a gimp file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        gimp = GimpDocument(filepath)
+        layers = []
+        for layer in self.__layers(gimp):
+            if layer.isGroup:
+                continue
+            layer_name = layer.name
+            fex = layer_name.split('.')[-1].lower()
+            # The same layers as ``load``
+            if fex in self.__file_formats__ or self.init_class_id(layer_name) is None or not self.__is_mask(layer):
+                continue
+            layers.append(LayerInfo(
+                name = layer_name,
+                dimension = (layer.height, layer.width),
+                x = layer.xOffset, y = layer.yOffset,
+                opacity = layer.opacity,
+                visibility = layer.visible
+            ))
+
+        return phmImageInfo(
+            filepath = filepath,
+            title = Path(filepath).stem,
+            dimension = (gimp.height, gimp.width),
+            layers = layers
+        )
+
     def save(self, img: phmImage, filepath: str):
         """Save a multi-layer image as a gimp file
 
@@ -1,15 +1,119 @@
 
+import os
+import json
+import zlib
+import itertools
 import h5py as hp
 import numpy as np
 
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Union, Callable
 from pathlib import Path
+from functools import partial
+from concurrent.futures import Executor
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, Layer, create_image
+from yoyo66.handler.zipio import atomic_write
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, LazyImage, STATS_KEY
+
+def _deflated(dataset) -> bool:
+    # Check if the chunks of the dataset are only compressed by zlib (gzip filter), optionally after shuffling their bytes
+    return dataset.chunks is not None and dataset.compression == 'gzip' and \
+        not dataset.fletcher32 and dataset.scaleoffset is None
+
+def _shuffle(data : np.ndarray) -> bytes:
+    # The shuffle filter of hdf5 groups the bytes by their position in the items
+    return data.view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+def _unshuffle(data : bytes, dtype : np.dtype) -> np.ndarray:
+    return np.frombuffer(data, dtype = np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype)
+
+class H5Image(LazyImage):
+    """
+    A lazy image stored as a dataset of a hdf5 file. A region read only reads the chunks intersecting the region.
+    The masks stored as images with alpha channel (older files) are converted using their alpha channel.
+    """
+
+    def __init__(self, filepath : str, path : str, shape : Tuple[int, ...], is_mask : bool = True) -> None:
+        """
+        Args:
+            filepath (str): the path to the hdf5 file
+            path (str): the path of the dataset inside the hdf5 file
+            shape (Tuple[int, ...]): the shape of the dataset
+            is_mask (bool, optional): True if the image is a mask layer, otherwise it is the original image. Defaults to True.
+        """
+        self.filepath = filepath
+        self.path = path
+        self.dataset_shape = tuple(shape)
+        self.is_mask = is_mask
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.dataset_shape[:2] if self.is_mask else self.dataset_shape
+
+    def __to_mask(self, data : np.ndarray) -> np.ndarray:
+        return data.view(np.int8) if data.dtype.itemsize == 1 else (data != 0).view(np.int8)
+
+    def read_region(self, x : int, y : int, width : int, height : int) -> np.ndarray:
+        with hp.File(self.filepath, mode = 'r') as fin:
+            dataset = fin[self.path]
+            if not self.is_mask:
+                return dataset[y:y + height, x:x + width]
+            if len(self.dataset_shape) > 2:
+                # Mask stored as an image with alpha channel
+                return (dataset[y:y + height, x:x + width, -1] != 0).view(np.int8)
+            data = dataset[y:y + height, x:x + width]
+        return self.__to_mask(data)
+
+    def __read_chunks(self, dataset, mapper : Callable) -> np.ndarray:
+        # The raw chunks are read one after another and decompressed by the mapper
+        dtype = dataset.dtype
+        chunks = [dataset.id.get_chunk_info(index) for index in range(dataset.id.get_num_chunks())]
+        raws = [dataset.id.read_direct_chunk(info.chunk_offset) for info in chunks]
+
+        def inflate(raw : Tuple[int, bytes]) -> np.ndarray:
+            filter_mask, data = raw
+            # The filters skipped for a chunk are flagged in its filter mask
+            if dataset.shuffle:
+                data = data if filter_mask & 2 else zlib.decompress(data)
+                return _unshuffle(data, dtype) if not filter_mask & 1 else np.frombuffer(data, dtype = dtype)
+            return np.frombuffer(data if filter_mask & 1 else zlib.decompress(data), dtype = dtype)
+
+        data = np.full(dataset.shape, dataset.fillvalue, dtype = dtype)
+        for info, chunk in zip(chunks, mapper(inflate, raws)):
+            # The chunks on the borders are stored with the full size of a chunk
+            region = tuple(slice(offset, min(offset + size, dim)) for offset, size, dim in zip(info.chunk_offset, dataset.chunks, dataset.shape))
+            chunk = chunk.reshape(dataset.chunks)
+            data[region] = chunk[tuple(slice(0, r.stop - r.start) for r in region)]
+        return data
+
+    def decode(self, mapper : Callable = None) -> np.ndarray:
+        """Decode the dataset.
+
+        Args:
+            mapper (Callable, optional): a map function (e.g. ``BaseFileHandler._map``) used for decompressing the raw chunks concurrently.
+                The lazy image does not keep it, so a lazy layer never uses a worker thread. Defaults to None (the dataset is read by hdf5).
+
+        Returns:
+            np.ndarray: the decoded array
+        """
+        if mapper is None:
+            return self.read_region(0, 0, self.dataset_shape[1], self.dataset_shape[0])
+        with hp.File(self.filepath, mode = 'r') as fin:
+            dataset = fin[self.path]
+            data = self.__read_chunks(dataset, mapper) if _deflated(dataset) else dataset[()]
+        if not self.is_mask:
+            return data
+        if len(self.dataset_shape) > 2:
+            # Mask stored as an image with alpha channel
+            return (data[..., -1] != 0).view(np.int8)
+        return self.__to_mask(data)
 
 @mmfile_handler('h5', ['h5'])
 class H5FileHandler(BaseFileHandler):
+    """
+    HDF5 file handler for loading and saving hdf5 files (*.h5).
+    The masks are stored as single-channel uint8 datasets (zero and one) chunked by tiles.
+    """
 
     __H5_FILEEXTENSION = '.h5'
     __PROP_PREFIX = 'prop_'
@@ -17,8 +121,35 @@ class H5FileHandler(BaseFileHandler):
     __LAYERS_KEY = 'layers'
     __ORIG_KEY = 'original'
 
-    def __init__(self, filter: List[str] = None) -> None:
-        super().__init__(filter)
+    def __init__(self, 
+        filter: List[str] = None, 
+        lazy : bool = False,
+        compression : str = 'gzip',
+        compression_level : int = 4,
+        chunk_size : int = 256,
+        max_workers : int = None,
+        executor : Executor = None
+    ) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            lazy (bool, optional): if True, the datasets are read on their first access (or by regions). Defaults to False.
+            compression (str, optional): the compressor of the datasets ('gzip', 'lzf', or None). Defaults to 'gzip'.
+            compression_level (int, optional): the level of the gzip compression (0-9). Defaults to 4.
+            chunk_size (int, optional): the size of the (square) chunks of the datasets. Defaults to 256.
+            max_workers (int, optional): the number of threads compressing and decompressing the gzip chunks of the datasets. Defaults to None.
+            executor (Executor, optional): a shared executor used instead of creating a thread pool for each dataset. Defaults to None.
+
+        Raises:
+            ValueError: if the compressor is not supported
+        """
+        super().__init__(filter, max_workers, executor)
+        if compression not in (None, 'none', 'gzip', 'lzf'):
+            raise ValueError(f'{compression} compression is not supported!')
+        self.lazy = lazy
+        self.compression = None if compression == 'none' else compression
+        self.compression_level = compression_level
+        self.chunk_size = chunk_size
 
     def __read_metadata(self, handler) -> Tuple[Dict, Dict]:
         metrics = {}
@@ -46,6 +177,44 @@ class H5FileHandler(BaseFileHandler):
     def __layer_path(self, clss : str):
         return f'{self.__LAYERS_KEY}/{clss}'
 
+    def _load_group(self, filepath : str, group, only_imgs : bool = False, title : str = None) -> phmImage:
+        # Load a multi-layer image stored in a group (the root group of a file or an image of a container)
+        props = {}
+        metrics = {}
+        if not only_imgs:
+            props, metrics = self.__read_metadata(group)
+        # Load original layer
+        if not self.__ORIG_KEY in group.keys():
+            raise KeyError('original layer is missing!')
+        orig = group[self.__ORIG_KEY]
+        orig = H5Image(filepath, orig.name, orig.shape, is_mask = False)
+        # Load mask layers
+        layers = []
+        layers_group = group[self.__LAYERS_KEY]
+        for layer_name in layers_group.keys():
+            class_id = self.init_class_id(layer_name)
+            if class_id is None:
+                continue
+            dataset = layers_group[layer_name]
+            layers.append(Layer(
+                name = layer_name,
+                class_id = class_id,
+                image = H5Image(filepath, dataset.name, dataset.shape)
+            ))
+        img = phmImage(
+            filepath = filepath,
+            title = title,
+            properties = props,
+            metrics = metrics,
+            orig_image = orig,
+            layers = layers
+        )
+        if not self.lazy:
+            # The chunks of the datasets are decompressed by the worker threads
+            for layer in img:
+                layer.load(partial(layer.source.decode, self._map) if self.threaded else None)
+        return img
+
     def load(self, filepath: str, only_imgs : bool = False) -> phmImage:
         # Argument initialization and checking
         if not Path(filepath).is_file():
@@ -53,64 +222,349 @@ class H5FileHandler(BaseFileHandler):
         if not filepath.endswith(self.__H5_FILEEXTENSION):
             raise ValueError(message=f'The file format ({filepath}) is not supported!')
         #####################
-        img = None
         with hp.File(filepath, mode = 'r') as fin:
-            # Load metrics and properties
-            props = metrics = {}
-            if not only_imgs:
-                props, metrics = self.__read_metadata(fin)
-            # Load original layer
+            if H5Container.INDEX_KEY in fin.keys():
+                raise ValueError(f'{filepath} is a container of images, use open_container to read it!')
+            return self._load_group(filepath, fin, only_imgs)
+
+    def open_container(self, filepath : str, mode : str = 'r') -> 'H5Container':
+        """Open a hdf5 file containing many multi-layer images (see ``H5Container``).
+        The images are loaded and saved using the settings of this file handler.
+
+        Args:
+            filepath (str): the path to the hdf5 file
+            mode (str, optional): 'r' for reading and 'a' for appending images (the file is created if it does not exist). Defaults to 'r'.
+
+        Returns:
+            H5Container: the opened container
+        """
+        return H5Container(self, filepath, mode)
+
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a hdf5 file (attributes and dataset shapes) without reading the datasets.
+
+        Args:
+            filepath (str): the path to a hdf5 file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with hp.File(filepath, mode = 'r') as fin:
+            props, metrics = self.__read_metadata(fin)
             if not self.__ORIG_KEY in fin.keys():
                 raise KeyError('original layer is missing!')
-            orig = np.array(fin[self.__ORIG_KEY])
-            # Load mask layers
+            orig = fin[self.__ORIG_KEY]
             layers = []
             layers_group = fin[self.__LAYERS_KEY]
             for layer_name in layers_group.keys():
-                class_id = self.init_class_id(layer_name)
-                if class_id is None:
+                if self.init_class_id(layer_name) is None:
                     continue
-                layer = np.array(layers_group[layer_name])
-                layers.append(Layer(
+                dataset = layers_group[layer_name]
+                layers.append(LayerInfo(
                     name = layer_name,
-                    class_id = class_id,
-                    image = layer
+                    dimension = tuple(dataset.shape[:2]),
+                    size = dataset.id.get_storage_size()
                 ))
-            img = phmImage(
+            return phmImageInfo(
                 filepath = filepath,
+                title = Path(filepath).stem,
+                dimension = tuple(orig.shape[:2]),
                 properties = props,
                 metrics = metrics,
-                orig_image = orig,
-                layers = layers
+                layers = layers,
+                size = orig.id.get_storage_size(),
+                stats = json.loads(fin.attrs[STATS_KEY]) if STATS_KEY in fin.attrs else None
             )
-        
-        return img
 
-    def save(self, img: phmImage, filepath: str):
-        with hp.File(filepath, mode = 'w') as fout:
-            # Write the metrics and properties
-            self.__write_metadata(fout, img.metrics, img.properties)
-            # Write the original image
-            orig = img.orig_layer.image
-            fout.create_dataset(
-                name = self.__ORIG_KEY,
-                shape = orig.shape,
-                dtype = orig.dtype,
-                compression = 'gzip',
-                compression_opts = 9,
-                data = orig
+    def __create_dataset(self, handler, name : str, data : np.ndarray):
+        # Chunks are tiles of the image (all channels)
+        chunks = tuple(min(self.chunk_size, dim) for dim in data.shape[:2]) + data.shape[2:]
+        options = {}
+        if self.compression is not None:
+            options['compression'] = self.compression
+            options['shuffle'] = data.dtype.itemsize > 1
+        if self.compression == 'gzip':
+            options['compression_opts'] = self.compression_level
+        if not self.threaded or self.compression != 'gzip' or data.size == 0:
+            handler.create_dataset(
+                name = name,
+                data = data,
+                chunks = chunks if data.size > 0 else None,
+                **options
             )
-            # Write the layers
-            for layer in img.layers:
-                lname = layer.name
-                limg = create_image(layer)
-                limg = np.array(limg)
-                fout.create_dataset(
-                    name = self.__layer_path(lname),
-                    shape = limg.shape,
-                    dtype = limg.dtype,
-                    data = limg,
-                    compression = 'gzip',
-                    compression_opts = 9,
-                )
+            return
+        # The chunks are compressed by the worker threads and written one after another as raw chunks
+        dataset = handler.create_dataset(
+            name = name,
+            shape = data.shape,
+            dtype = data.dtype,
+            chunks = chunks,
+            **options
+        )
+        offsets = list(itertools.product(*(range(0, dim, size) for dim, size in zip(data.shape, chunks))))
+
+        def deflate(offset : Tuple[int, ...]) -> bytes:
+            tile = data[tuple(slice(start, start + size) for start, size in zip(offset, chunks))]
+            if tile.shape != chunks:
+                # The chunks on the borders are stored with the full size of a chunk
+                tile = np.pad(tile, [(0, size - dim) for dim, size in zip(tile.shape, chunks)])
+            tile = np.ascontiguousarray(tile)
+            return zlib.compress(_shuffle(tile) if dataset.shuffle else tile.tobytes(), self.compression_level)
+
+        for offset, raw in zip(offsets, self._map(deflate, offsets)):
+            dataset.id.write_direct_chunk(offset, raw)
+
+    def __stored_stats(self, group, img : phmImage) -> Dict:
+        # The statistics stored with the source group of the layers (if all of them come from the same group of a hdf5 file)
+        sources = {
+            (os.path.abspath(layer.source.filepath), layer.source.path.rsplit('/', 2)[0] or '/') if isinstance(layer.source, H5Image) else None 
+            for layer in img.layers
+        }
+        if len(sources) != 1 or None in sources:
+            return None
+        filepath, path = next(iter(sources))
+        if not os.path.isfile(filepath):
+            return None
+        if os.path.abspath(group.file.filename) == filepath:
+            # The source is the file being written (e.g. a container)
+            stats = group.file[path].attrs.get(STATS_KEY) if path in group.file else None
+        else:
+            with hp.File(filepath, mode = 'r') as fin:
+                stats = fin[path].attrs.get(STATS_KEY) if path in fin else None
+        return json.loads(stats) if stats is not None else None
+
+    def _save_group(self, group, img : phmImage):
+        # Save a multi-layer image in a group (the root group of a file or an image of a container)
+        # Write the metrics and properties
+        self.__write_metadata(group, img.metrics, img.properties)
+        # Write the statistics of the layers (the statistics of the source are reused if no layer is modified)
+        group.attrs[STATS_KEY] = json.dumps(img.stats_metadata(self.__stored_stats(group, img)))
+        # Write the original image
+        self.__create_dataset(group, self.__ORIG_KEY, img.orig_layer.image)
+        # Write the layers
+        for layer in img.layers:
+            layer = layer.uncropped(img.dimension)
+            mask = layer.image
+            mask = mask.view(np.uint8) if mask.dtype in (np.int8, np.bool_) else (mask != 0).astype(np.uint8)
+            self.__create_dataset(group, self.__layer_path(layer.name), mask)
+
+    def save(self, img: phmImage, filepath: str):
+        """Save a multi-layer image as a hdf5 file.
+        The file is written in a temporary file which replaces the destination once it is complete.
+
+        Args:
+            img (phmImage): Multi-layer image
+            filepath (str): Path of hdf5 file
+        """
+        with atomic_write(filepath) as tmppath, hp.File(tmppath, mode = 'w') as fout:
+            self._save_group(fout, img)
+
+class H5Container:
+    """
+    A hdf5 file containing many multi-layer images, each one stored in its own group (``images/<index>``).
+    An index (``index/images``) keeps the name and the dimension of the images and ``index/layers`` keeps
+    the presence of the layers (one column per class listed in the ``classes`` attribute of the index),
+    so the images are accessed by their position or name without scanning the groups.
+    """
+
+    INDEX_KEY = 'index'
+    __IMAGES_KEY = 'images'
+    __ENTRIES_PATH = 'index/images'
+    __PRESENCE_PATH = 'index/layers'
+    __CLASSES_ATTR = 'classes'
+    __ENTRY_DTYPE = np.dtype([
+        ('name', hp.string_dtype()),
+        ('height', np.int32),
+        ('width', np.int32)
+    ])
+
+    def __init__(self, handler : H5FileHandler, filepath : str, mode : str = 'r') -> None:
+        """
+        Args:
+            handler (H5FileHandler): the file handler used for loading and saving the images
+            filepath (str): the path to the hdf5 file
+            mode (str, optional): 'r' for reading and 'a' for appending images (the file is created if it does not exist). Defaults to 'r'.
+
+        Raises:
+            ValueError: if the mode is not supported or the file is not a container
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError(f'{mode} mode is not supported!')
+        self.handler = handler
+        self.filepath = filepath
+        self.mode = mode
+        self._file = hp.File(filepath, mode = mode)
+        if not self.INDEX_KEY in self._file.keys():
+            if mode == 'r' or len(self._file.keys()) > 0:
+                self._file.close()
+                raise ValueError(f'{filepath} is not a container of images!')
+            self.__create_index()
+        # The index is read once, the images are accessed by their position
+        entries = self._file[self.__ENTRIES_PATH]
+        self._names = [name.decode() if isinstance(name, bytes) else name for name in entries['name']]
+        self._positions = {name : index for index, name in enumerate(self._names)}
+        self._dimensions = [tuple(dim) for dim in zip(entries['height'], entries['width'])]
+        self._classes = json.loads(self._file[self.INDEX_KEY].attrs[self.__CLASSES_ATTR])
+        self._presence = self._file[self.__PRESENCE_PATH][()]
+
+    def __create_index(self):
+        index = self._file.create_group(self.INDEX_KEY)
+        index.attrs[self.__CLASSES_ATTR] = json.dumps([])
+        index.create_dataset('images', shape = (0,), maxshape = (None,), dtype = self.__ENTRY_DTYPE, chunks = (1024,))
+        index.create_dataset('layers', shape = (0, 0), maxshape = (None, None), dtype = np.bool_, chunks = (1024, 16))
+        self._file.create_group(self.__IMAGES_KEY)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the hdf5 file. The lazy images loaded from the container stay valid."""
+        if self._file:
+            self._file.close()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get(index)
+
+    def __contains__(self, name : str) -> bool:
+        return name in self._positions
+
+    def __getitem__(self, key : Union[int, str]) -> phmImage:
+        return self.get(key)
+
+    @property
+    def names(self) -> Tuple[str]:
+        """The names of the images in the container"""
+        return tuple(self._names)
+
+    @property
+    def classes(self) -> Tuple[str]:
+        """The names of the layers present in the images of the container"""
+        return tuple(self._classes)
+
+    def index_of(self, name : str) -> int:
+        """The position of an image in the container
+
+        Args:
+            name (str): the name of the image
+
+        Raises:
+            KeyError: if the image does not exist
+
+        Returns:
+            int: the position of the image
+        """
+        if not name in self._positions:
+            raise KeyError(f'{name} does not exist in {self.filepath}!')
+        return self._positions[name]
+
+    def dimension(self, key : Union[int, str]) -> Tuple[int, int]:
+        """The dimension of an image read from the index
+
+        Args:
+            key (Union[int, str]): the position or the name of the image
+
+        Returns:
+            Tuple[int, int]: the height and the width of the image
+        """
+        return self._dimensions[self.__position(key)]
+
+    def layer_names(self, key : Union[int, str]) -> Tuple[str]:
+        """The names of the layers of an image read from the index
+
+        Args:
+            key (Union[int, str]): the position or the name of the image
+
+        Returns:
+            Tuple[str]: the names of the layers
+        """
+        row = self._presence[self.__position(key)]
+        return tuple(clss for clss, present in zip(self._classes, row) if present)
+
+    def find(self, layer_name : str) -> List[int]:
+        """The positions of the images having a layer
+
+        Args:
+            layer_name (str): the name of the layer
+
+        Returns:
+            List[int]: the positions of the images
+        """
+        layer_name = layer_name.lower().strip()
+        if not layer_name in self._classes:
+            return []
+        return np.flatnonzero(self._presence[:len(self), self._classes.index(layer_name)]).tolist()
+
+    def __position(self, key : Union[int, str]) -> int:
+        if isinstance(key, str):
+            return self.index_of(key)
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(f'{key} is out of range!')
+        return index
+
+    def get(self, key : Union[int, str], only_imgs : bool = False) -> phmImage:
+        """Load an image of the container
+
+        Args:
+            key (Union[int, str]): the position or the name of the image
+            only_imgs (bool, optional): if True, the properties and metrics are not loaded. Defaults to False.
+
+        Returns:
+            phmImage: Loaded multi-layer image
+        """
+        index = self.__position(key)
+        group = self._file[f'{self.__IMAGES_KEY}/{index}']
+        return self.handler._load_group(self.filepath, group, only_imgs, title = self._names[index])
+
+    def append(self, img : phmImage, name : str = None) -> int:
+        """Append an image to the container
+
+        Args:
+            img (phmImage): Multi-layer image
+            name (str, optional): the name of the image. Defaults to the title of the image.
+
+        Raises:
+            ValueError: if the container is read-only or the name already exists
 
+        Returns:
+            int: the position of the image
+        """
+        if self.mode == 'r':
+            raise ValueError(f'{self.filepath} is opened in read-only mode!')
+        name = img.title if name is None else name
+        if name in self._positions:
+            raise ValueError(f'{name} already exists in {self.filepath}!')
+        index = len(self._names)
+        self.handler._save_group(self._file.create_group(f'{self.__IMAGES_KEY}/{index}'), img)
+        # Update the index
+        for clss in img.layer_names:
+            if not clss in self._classes:
+                self._classes.append(clss)
+        self._file[self.INDEX_KEY].attrs[self.__CLASSES_ATTR] = json.dumps(self._classes)
+        entries = self._file[self.__ENTRIES_PATH]
+        entries.resize((index + 1,))
+        entries[index] = (name, *img.dimension)
+        presence = self._file[self.__PRESENCE_PATH]
+        presence.resize((index + 1, len(self._classes)))
+        row = np.isin(self._classes, img.layer_names)
+        presence[index] = row
+        # Keep the index in memory in sync, its capacity grows geometrically so appending many images takes linear time
+        rows, cols = self._presence.shape
+        if index >= rows or len(self._classes) > cols:
+            presence = np.zeros((max(2 * rows, index + 1), max(2 * cols, len(self._classes))), dtype = np.bool_)
+            presence[:rows, :cols] = self._presence
+            self._presence = presence
+        self._presence[index, :len(self._classes)] = row
+        self._names.append(name)
+        self._positions[name] = index
+        self._dimensions.append(tuple(img.dimension))
+        return index
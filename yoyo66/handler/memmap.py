@@ -0,0 +1,164 @@
+import io
+import json
+import zipfile
+
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from yoyo66.handler import BaseFileHandler, mmfile_handler
+from yoyo66.handler import zipio
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, STATS_KEY
+
+def _npy_header(arr : np.ndarray) -> bytes:
+    # The header of the npy format (padded so that the data is aligned to 64 bytes)
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(arr))
+    return header.getvalue()
+
+@mmfile_handler('memmap', ['mpk'])
+class MemmapFileHandler(BaseFileHandler):
+    """
+    Memory-mappable file handler for loading and saving mpk files (*.mpk).
+    An mpk file is a zip file in which the original image and the layers are stored as uncompressed npy arrays aligned to 64 bytes.
+    The loaded images are read-only ``np.memmap`` views of the file, so reading a sample costs page faults only
+    and the processes reading the same file share the page cache.
+    """
+
+    __METAINFO_FILE = 'meta.json'
+    __ORIG_FILE = 'original.npy'
+    __ALIGNMENT = 64
+
+    def __init__(self, filter : List[str] = None) -> None:
+        super().__init__(filter)
+
+    def __map_array(self, mm : np.memmap, pkg : zipfile.ZipFile, member : str) -> np.ndarray:
+        # Create a view of an npy member on the memory-mapped file
+        info = pkg.getinfo(member)
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f'{member} is compressed and it cannot be memory-mapped!')
+        offset = zipio.data_offset(pkg.fp, info)
+        version = np.lib.format.read_magic(pkg.fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(pkg.fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(pkg.fp)
+        start = pkg.fp.tell()
+        nbytes = int(np.prod(shape, dtype = np.int64)) * dtype.itemsize
+        if start + nbytes > offset + info.file_size:
+            raise ValueError(f'{member} is truncated!')
+        arr = mm[start:start + nbytes].view(dtype)
+        return arr.reshape(shape[::-1]).T if fortran_order else arr.reshape(shape)
+
+    def load(self, filepath : str, only_imgs : bool = False) -> phmImage:
+        """Load the multi-layer image using the presented file path (mpk file).
+        The original image and the layers are read-only views of the memory-mapped file.
+
+        Args:
+            filepath (str): the path to an mpk file
+
+        Returns:
+            phmImage: Loaded multi-layer image
+        """
+        mm = np.memmap(filepath, dtype = np.uint8, mode = 'r')
+        with zipfile.ZipFile(filepath, mode = 'r') as pkg:
+            metainfo = json.loads(pkg.read(self.__METAINFO_FILE))
+            orig_img = self.__map_array(mm, pkg, self.__ORIG_FILE)
+            layers = []
+            for info in metainfo['layers']:
+                layer_name = info['name']
+                class_id = self.init_class_id(layer_name)
+                if class_id is None:
+                    continue
+                layers.append(Layer(
+                    name = layer_name,
+                    opacity = info['opacity'],
+                    visibility = info['visibility'],
+                    image = self.__map_array(mm, pkg, info['file']),
+                    class_id = class_id,
+                    x = info['x'], y = info['y']
+                ))
+
+        return phmImage(
+            filepath = filepath,
+            properties = {} if only_imgs else metainfo['properties'],
+            metrics = {} if only_imgs else metainfo['metrics'],
+            orig_image = orig_img,
+            layers = layers
+        )
+
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of an mpk file (meta.json) without mapping the arrays.
+
+        Args:
+            filepath (str): the path to an mpk file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with zipfile.ZipFile(filepath, mode = 'r') as pkg:
+            metainfo = json.loads(pkg.read(self.__METAINFO_FILE))
+            layers = []
+            for info in metainfo['layers']:
+                if self.init_class_id(info['name']) is None:
+                    continue
+                layers.append(LayerInfo(
+                    name = info['name'],
+                    dimension = tuple(info['shape'][:2]),
+                    x = info['x'], y = info['y'],
+                    size = pkg.getinfo(info['file']).file_size,
+                    opacity = info['opacity'],
+                    visibility = info['visibility']
+                ))
+            return phmImageInfo(
+                filepath = filepath,
+                title = Path(filepath).stem,
+                dimension = tuple(metainfo['shape'][:2]),
+                properties = metainfo['properties'],
+                metrics = metainfo['metrics'],
+                layers = layers,
+                size = pkg.getinfo(self.__ORIG_FILE).file_size,
+                stats = metainfo.get(STATS_KEY)
+            )
+
+    def __write_array(self, pkg : zipfile.ZipFile, member : str, arr : np.ndarray):
+        arr = np.ascontiguousarray(arr)
+        zipio.write_aligned(pkg, member, [_npy_header(arr), arr], self.__ALIGNMENT)
+
+    def save(self, img : phmImage, filepath : str):
+        """Save a multi-layer image as an mpk file. The masks are stored as int8 arrays (zero and one).
+        The file is written in a temporary file which replaces the destination once it is complete.
+
+        Args:
+            img (phmImage): Multi-layer image
+            filepath (str): Path of mpk file
+        """
+        # The statistics are calculated before the file is replaced (the layers may be mapped on it)
+        stats = img.stats_metadata()
+        with zipio.atomic_write(filepath) as tmppath, zipfile.ZipFile(tmppath, mode = 'w') as pkg:
+            orig = img.orig_layer.image
+            self.__write_array(pkg, self.__ORIG_FILE, orig)
+            layers = []
+            for index, layer in enumerate(img.layers):
+                lfile = f'layers/{index}.npy'
+                mask = layer.image
+                if mask.dtype != np.int8:
+                    mask = (mask != 0).astype(np.int8)
+                self.__write_array(pkg, lfile, mask)
+                layers.append({
+                    'name' : layer.name,
+                    'file' : lfile,
+                    'shape' : list(mask.shape),
+                    'opacity' : layer.opacity,
+                    'visibility' : layer.visibility,
+                    'x' : layer.x,
+                    'y' : layer.y
+                })
+            pkg.writestr(self.__METAINFO_FILE, json.dumps({
+                'shape' : list(orig.shape),
+                'properties' : img.properties,
+                'metrics' : img.metrics,
+                'layers' : layers,
+                STATS_KEY : stats
+            }))
@@ -1,19 +1,76 @@
-
-import random
+import io
+import os
+import json
+import zipfile
 import numpy as np
+import xml.etree.ElementTree as ET
 
 from PIL import Image
 from pathlib import Path
-from typing import Dict, List, Union
-from pyora import Project, TYPE_LAYER
+from functools import partial
+from contextlib import ExitStack
+from concurrent.futures import Executor
+from typing import Dict, List, Tuple
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, Layer, ORIGINAL_LAYER_KEY, create_image, from_image
+from yoyo66.handler import zipio
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, LazyImage, STATS_KEY, create_image, from_image
+
+def _member(ora : zipfile.ZipFile, src : str) -> zipfile.ZipInfo:
+    # The layer sources may be stored with or without the leading slash
+    if src not in ora.NameToInfo:
+        src = src.lstrip('/')
+    return ora.getinfo(src)
+
+class ORAImage(LazyImage):
+    """
+    A lazy image stored as a png file inside an openraster file. The image is decoded straight to numpy only when it is requested.
+    """
+
+    def __init__(self, filepath : str, member : str, is_mask : bool = True) -> None:
+        """
+        Args:
+            filepath (str): the path to the openraster file
+            member (str): the path of the png file inside the openraster file
+            is_mask (bool, optional): True if the image is a mask layer, otherwise it is the original image. Defaults to True.
+        """
+        self.filepath = filepath
+        self.member = member
+        self.is_mask = is_mask
+        self._shape = None
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self._shape is None:
+            # Only the png header is read for getting the size of image
+            with zipfile.ZipFile(self.filepath, mode = 'r') as ora:
+                if self.is_mask:
+                    self._shape = zipio.png_size(ora, _member(ora, self.member))
+                else:
+                    # The original image keeps its mode, so the number of channels is read from the header too
+                    with ora.open(_member(ora, self.member)) as f, Image.open(f) as img:
+                        bands = len(img.getbands())
+                        self._shape = (img.height, img.width) if bands == 1 else (img.height, img.width, bands)
+        return self._shape
+
+    def decode(self) -> np.ndarray:
+        with zipfile.ZipFile(self.filepath, mode = 'r') as ora:
+            with ora.open(_member(ora, self.member)) as f:
+                img = Image.open(f)
+                if self.is_mask:
+                    # The masks are kept in the transparency channel
+                    arr = from_image(img if img.mode in ('RGBA', 'LA') else img.convert('RGBA'))
+                else:
+                    arr = np.asarray(img)
+        self._shape = arr.shape
+        return arr
 
 @mmfile_handler('openraster', ['ora'])
 class OpenRasterFileHandler(BaseFileHandler):
     """
     OpenRaster file handler for loading and saving openraster files (*.ora).
+    The files are read and written directly as zip files: the stack (stack.xml) is parsed by the handler
+    and only the png files of the requested layers are decoded.
     """
 
     __ora_extension = '.ora'
@@ -21,10 +78,31 @@ class OpenRasterFileHandler(BaseFileHandler):
     __LAYERS_KEY = '/layers'
     __PROPERTIES_KEY = 'prop_'
     __METRICS_KEY = 'metrics_'
+    __STACK_FILE = 'stack.xml'
+    __MIMETYPE_FILE = 'mimetype'
+    __MERGED_FILE = 'mergedimage.png'
+    __THUMBNAIL_FILE = 'Thumbnails/thumbnail.png'
+    __THUMBNAIL_SIZE = (256, 256)
+
+    def __init__(self, 
+        filter : List[str] = None, 
+        lazy : bool = False, 
+        compress_level : int = 6,
+        max_workers : int = None,
+        executor : Executor = None
+    ) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            lazy (bool, optional): if True, the layers are decoded on their first access. Defaults to False.
+            compress_level (int, optional): the compression level of the png files (0-9). Defaults to 6.
+            max_workers (int, optional): the number of threads decoding and encoding the png files of an openraster file. Defaults to None.
+            executor (Executor, optional): a shared executor used instead of creating a thread pool for each file. Defaults to None.
+        """
+        super().__init__(filter, max_workers, executor)
+        self.lazy = lazy
+        self.compress_level = compress_level
 
-    def __init__(self, filter : List[str] = None) -> None:
-        super().__init__(filter)
-    
     def load(self, filepath: str, only_imgs : bool = False) -> phmImage:
         """Load the multi-layer image using the presented file path (openraster file).
 
@@ -46,83 +124,221 @@ class OpenRasterFileHandler(BaseFileHandler):
         if not filepath.endswith(self.__ora_extension):
             raise ValueError(message=f'The file format ({filepath}) is not supported!')
         #####################
-        # Load the OpenRaster file
-        project = Project.load(filepath)
-        # Layer containing original layer
-        if not self.__ORIG_LAYER_KEY in project or \
-           not self.__LAYERS_KEY in project:
+        # Load the OpenRaster file (only the requested layers are decoded)
+        with zipfile.ZipFile(filepath, mode = 'r') as ora:
+            _, orig, masks = self.__read_stack(ora, filepath)
+            props, metrics = self.__read_attributes(orig)
+            # Mask Layers
+            mask_layers = []
+            for layer in masks.findall('layer'):
+                layer_name = layer.get('name')
+                class_id = self.init_class_id(layer_name)
+                if class_id is None:
+                    continue
+                mask_layers.append(Layer(
+                    name = layer_name,
+                    opacity = float(layer.get('opacity', 1.0)),
+                    visibility = layer.get('visibility', 'visible') == 'visible',
+                    image = ORAImage(filepath, layer.get('src')),
+                    class_id = class_id,
+                    x = int(layer.get('x', 0)), y = int(layer.get('y', 0))
+                ))
+
+        img = phmImage(
+            filepath = filepath,
+            properties = {} if only_imgs else props,
+            metrics = {} if only_imgs else metrics,
+            orig_image = ORAImage(filepath, orig.get('src'), is_mask = False),
+            layers = mask_layers
+        )
+        if not self.lazy:
+            # Each png file is decoded from its own handle of the file, so they are decoded concurrently
+            self._map(Layer.load, img)
+        return img
+
+    def __read_stack(self, ora : zipfile.ZipFile, filepath : str) -> Tuple[ET.Element, ET.Element, ET.Element]:
+        # Read the stack (stack.xml) containing the original layer and the group of mask layers
+        root = ET.fromstring(ora.read(self.__STACK_FILE))
+        stack = root.find('stack')
+        orig = stack.find(f"layer[@name='{self.__ORIG_LAYER_KEY[1:]}']") if stack is not None else None
+        masks = stack.find(f"stack[@name='{self.__LAYERS_KEY[1:]}']") if stack is not None else None
+        if orig is None or masks is None:
             raise ValueError('Invalid file format %s' % filepath)
-        
-        orig_img = project[self.__ORIG_LAYER_KEY]
+        return root, orig, masks
+
+    def __read_attributes(self, orig : ET.Element) -> Tuple[Dict, Dict]:
         # Extract Properties
         props = {}
         metrics = {}
-        for it in orig_img.raw_attributes.items():
-            if it[0].startswith(self.__PROPERTIES_KEY):
-                pkey = it[0].replace(self.__PROPERTIES_KEY, '')
-                props[pkey] = it[1]
-            elif it[0].startswith(self.__METRICS_KEY):
-                pkey = it[0].replace(self.__METRICS_KEY, '')
-                metrics[pkey] = float(it[1])
-
-        # Mask Layers
-        mask_layers = []
-        layers = project['/layers']
-        for layer in layers.children:
-            if layer.type == TYPE_LAYER:
-                layer_name = layer.name
-                img = layer.image
-                if img.mode in ("RGBA", "LA") or \
-                    (img.mode == "P" and "transparency" in img.info):
-                    limg = from_image(img)
-
-                    class_id = self.init_class_id(layer_name)
-                    if class_id is None:
+        for key, value in orig.attrib.items():
+            if key.startswith(self.__PROPERTIES_KEY):
+                props[key.replace(self.__PROPERTIES_KEY, '')] = value
+            elif key.startswith(self.__METRICS_KEY):
+                metrics[key.replace(self.__METRICS_KEY, '')] = float(value)
+        return props, metrics
+
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of an openraster file (stack.xml and png headers) without decoding the layers.
+
+        Args:
+            filepath (str): the path to an openraster file
+
+        Raises:
+            ValueError: if openraster file format is invalid
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with zipfile.ZipFile(filepath, mode = 'r') as ora:
+            root, orig, masks = self.__read_stack(ora, filepath)
+            props, metrics = self.__read_attributes(orig)
+            # Mask Layers
+            layers = []
+            for layer in masks.findall('layer'):
+                layer_name = layer.get('name')
+                if self.init_class_id(layer_name) is None:
+                    continue
+                member = _member(ora, layer.get('src'))
+                layers.append(LayerInfo(
+                    name = layer_name,
+                    dimension = zipio.png_size(ora, member),
+                    x = int(layer.get('x', 0)), y = int(layer.get('y', 0)),
+                    size = member.compress_size,
+                    opacity = float(layer.get('opacity', 1.0)),
+                    visibility = layer.get('visibility', 'visible') == 'visible'
+                ))
+
+            return phmImageInfo(
+                filepath = filepath,
+                title = Path(filepath).stem,
+                dimension = (int(root.get('h')), int(root.get('w'))),
+                properties = props,
+                metrics = metrics,
+                layers = layers,
+                size = _member(ora, orig.get('src')).compress_size,
+                stats = json.loads(orig.get(STATS_KEY)) if orig.get(STATS_KEY) else None
+            )
+
+    def __layer_attributes(self, name : str, src : str, x : int = 0, y : int = 0, opacity : float = 1.0, visibility : bool = True) -> Dict[str, str]:
+        return {
+            'name' : name,
+            'src' : src,
+            'x' : str(x),
+            'y' : str(y),
+            'opacity' : str(opacity),
+            'visibility' : 'visible' if visibility else 'hidden',
+            'composite-op' : 'svg:src-over'
+        }
+
+    def __find_untouched(self, img : phmImage) -> Tuple[Dict[int, Tuple[str, zipfile.ZipInfo]], Dict[str, Tuple[str, zipfile.ZipInfo]], Dict]:
+        """Find the untouched images (original and layers) of the multi-layer image in their source openraster files.
+
+        Args:
+            img (phmImage): the multi-layer image
+
+        Returns:
+            Tuple[Dict[int, Tuple[str, zipfile.ZipInfo]], Dict[str, Tuple[str, zipfile.ZipInfo]], Dict]: the source file and the member of the untouched images
+                (index 0 is the original layer and index i is the layer i - 1), and the source merged image, thumbnail and statistics if nothing visible is changed.
+        """
+        layers = tuple(img)
+        sources = {}
+        for index, layer in enumerate(layers):
+            if isinstance(layer.source, ORAImage) and not layer.is_dirty():
+                sources.setdefault(os.path.abspath(layer.source.filepath), []).append(index)
+
+        members = {}
+        previews = {}
+        stats = None
+        for srcpath, indexes in sources.items():
+            if not os.path.isfile(srcpath):
+                continue
+            with zipfile.ZipFile(srcpath, mode = 'r') as src:
+                for index in indexes:
+                    try:
+                        members[index] = (srcpath, _member(src, layers[index].source.member))
+                    except KeyError:
                         continue
-                    
-                    mask_layers.append(Layer(
-                        name = layer['name'],
-                        opacity = layer['opacity'],
-                        visibility = layer['visibility'],
-                        image = limg,
-                        class_id = class_id,
-                        x = layer.offsets[0], y = layer.offsets[1]
-                    ))
-        
-        return phmImage(
-            filepath = filepath,
-            properties = props,
-            metrics = metrics,
-            orig_image = np.asarray(orig_img.image),
-            layers = mask_layers
-        )
+                # The merged image and the thumbnail are reused if all images come untouched from this file with the same layout
+                if len(indexes) == len(layers) and len(members) == len(layers):
+                    _, orig, masks = self.__read_stack(src, srcpath)
+                    layout = [(layer.get('name'), int(layer.get('x', 0)), int(layer.get('y', 0)),
+                        float(layer.get('opacity', 1.0)), layer.get('visibility', 'visible') == 'visible')
+                        for layer in masks.findall('layer')]
+                    if layout == [(layer.name, layer.x, layer.y, float(layer.opacity), bool(layer.visibility)) for layer in img.layers]:
+                        for preview in (self.__MERGED_FILE, self.__THUMBNAIL_FILE):
+                            if preview in src.NameToInfo:
+                                previews[preview] = (srcpath, src.getinfo(preview))
+                        stats = json.loads(orig.get(STATS_KEY)) if orig.get(STATS_KEY) else None
+        return members, previews, stats
+
+    def __encode(self, image : Image) -> bytes:
+        with io.BytesIO() as png_io:
+            image.save(png_io, format = 'png', compress_level = self.compress_level)
+            return png_io.getvalue()
+
+    def __encode_layer(self, layer : Layer, is_mask : bool = True) -> bytes:
+        # Encode a layer (or the original image) as a png file, it runs in the worker threads
+        return self.__encode(create_image(layer) if is_mask else Image.fromarray(layer.image))
+
+    def __encode_previews(self, img : phmImage) -> Tuple[bytes, bytes]:
+        # Encode the merged image and the thumbnail, it runs in the worker threads
+        merged = img.blended_image()
+        merged_png = self.__encode(merged)
+        merged.thumbnail(self.__THUMBNAIL_SIZE)
+        return merged_png, self.__encode(merged)
 
     def save(self, img: phmImage, filepath: str):
-        """Save a multi-layer image as an openraster file
+        """Save a multi-layer image as an openraster file.
+        The untouched images (see ``Layer.is_dirty``) are copied from their source openraster files as raw bytes,
+        and only the modified layers are encoded (concurrently, see ``max_workers``). The merged image and the thumbnail are regenerated only if a visible change is made.
+        The file is written in a temporary file which replaces the destination once it is complete.
 
         Args:
             img (phmImage): Multi-layer image
             filepath (str): Path of openraster file
         """
-        project = Project.new(width = img.width, height = img.height)
-        # Create original layer
-        orig_layer = project.add_layer(Image.fromarray(img.orig_layer.image), self.__ORIG_LAYER_KEY)
-        # Add properties
-        for k, v in img.properties.items():
-            orig_layer.raw_attributes[self.__PROPERTIES_KEY + k] = v
-        # Add Metrics
-        for k, v in img.metrics.items():
-            orig_layer.raw_attributes[self.__METRICS_KEY + k] = str(v)
-        # Add Layers
-        masks = project.add_group(path=self.__LAYERS_KEY)
-        for layer in img.layers:
-            img = create_image(layer)
-            masks.add_layer(
-                image = img,
-                name = layer.name,
-                offsets = (layer.x, layer.y),
-                opacity = layer.opacity,
-                visible = layer.visibility
-            )
-        
-        project.save(filepath)
\ No newline at end of file
+        untouched, previews, stats = self.__find_untouched(img)
+        srcpaths = {srcpath for srcpath, _ in untouched.values()}
+        # The modified images are encoded by the worker threads before writing the file
+        layers = tuple(img)
+        jobs = {index : partial(self.__encode_layer, layer, index > 0) for index, layer in enumerate(layers) if index not in untouched}
+        if len(previews) < 2:
+            jobs[self.__MERGED_FILE] = partial(self.__encode_previews, img)
+        encoded = dict(zip(jobs.keys(), self._map(lambda encode: encode(), jobs.values())))
+
+        with zipio.atomic_write(filepath) as tmppath, ExitStack() as stack:
+            sources = {srcpath : stack.enter_context(zipfile.ZipFile(srcpath, mode = 'r')) for srcpath in srcpaths}
+            ora = stack.enter_context(zipfile.ZipFile(tmppath, mode = 'w', compression = zipfile.ZIP_DEFLATED))
+            # The mimetype is the first member and it is not compressed
+            ora.writestr(self.__MIMETYPE_FILE, 'image/openraster', compress_type = zipfile.ZIP_STORED)
+            # Merged image and thumbnail (the png files are already compressed)
+            if len(previews) == 2:
+                for srcpath, info in previews.values():
+                    zipio.copy_member(sources[srcpath], ora, info)
+            else:
+                merged, thumbnail = encoded[self.__MERGED_FILE]
+                ora.writestr(self.__MERGED_FILE, merged, compress_type = zipfile.ZIP_STORED)
+                ora.writestr(self.__THUMBNAIL_FILE, thumbnail, compress_type = zipfile.ZIP_STORED)
+            # Layers, they are written in the order of the image so that they are loaded back in the same order
+            root = ET.Element('image', {'version' : '0.0.3', 'w' : str(img.width), 'h' : str(img.height)})
+            root_stack = ET.SubElement(root, 'stack', {'name' : '', 'isolation' : 'isolate', 'composite-op' : 'svg:src-over', 'opacity' : '1', 'visibility' : 'visible'})
+            masks = ET.SubElement(root_stack, 'stack', {'name' : self.__LAYERS_KEY[1:], 'isolation' : 'isolate', 'composite-op' : 'svg:src-over', 'opacity' : '1', 'visibility' : 'visible'})
+            for index in range(len(layers)):
+                layer = layers[index]
+                src = f'data/layer{index}.png'
+                if index in untouched:
+                    srcpath, info = untouched[index]
+                    zipio.copy_member(sources[srcpath], ora, info, src)
+                else:
+                    ora.writestr(src, encoded[index], compress_type = zipfile.ZIP_STORED)
+                if index > 0:
+                    ET.SubElement(masks, 'layer', self.__layer_attributes(layer.name, src, layer.x, layer.y, layer.opacity, layer.visibility))
+            # Original layer with the properties, the metrics and the statistics of the layers
+            orig = self.__layer_attributes(self.__ORIG_LAYER_KEY[1:], 'data/layer0.png', opacity = img.orig_layer.opacity, visibility = img.orig_layer.visibility)
+            for k, v in img.properties.items():
+                orig[self.__PROPERTIES_KEY + k] = str(v)
+            for k, v in img.metrics.items():
+                orig[self.__METRICS_KEY + k] = str(v)
+            orig[STATS_KEY] = json.dumps(img.stats_metadata(stats))
+            ET.SubElement(root_stack, 'layer', orig)
+            ora.writestr(self.__STACK_FILE, ET.tostring(root, encoding = 'utf-8', xml_declaration = True))
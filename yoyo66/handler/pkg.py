@@ -2,46 +2,145 @@ import zipfile
 import json
 import io
 import os
+import bisect
 
 import numpy as np
 
-from functools import lru_cache
+from collections import OrderedDict
+from pathlib import Path
+from contextlib import ExitStack
+from concurrent.futures import Executor
 from PIL import Image
 from PIL.TiffImagePlugin import IFDRational
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, BaseArchive, Layer, create_image, from_image
+from yoyo66.handler import zipio
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, BaseArchive, Layer, LazyImage, STATS_KEY, create_image, from_image
+
+class PKGImage(LazyImage):
+    """
+    A lazy image stored as a png file inside a pkg file. The image is decoded only when it is requested.
+    """
+
+    def __init__(self, filepath : str, member : str, is_mask : bool = True) -> None:
+        """
+        Args:
+            filepath (str): the path to the pkg file
+            member (str): the path of the png file inside the pkg file
+            is_mask (bool, optional): True if the image is a mask layer, otherwise it is the original image. Defaults to True.
+        """
+        self.filepath = filepath
+        self.member = member
+        self.is_mask = is_mask
+        self._shape = None
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        if self._shape is None:
+            # Only the png header is read for getting the size of image
+            with zipfile.ZipFile(self.filepath, mode = 'r') as pkg:
+                h, w = zipio.png_size(pkg, self.member)
+            self._shape = (h, w) if self.is_mask else (h, w, 3)
+        return self._shape
+
+    def decode(self) -> np.ndarray:
+        with zipfile.ZipFile(self.filepath, mode = 'r') as pkg:
+            with pkg.open(self.member) as f:
+                img = Image.open(f)
+                arr = from_image(img) if self.is_mask else np.asarray(img.convert("RGB"))
+        self._shape = arr.shape
+        return arr
 
 class PKGArchive(BaseArchive):
+    """
+    PKGArchive provides access to the assets (e.g. predictions) stored in the archive directory of a pkg file.
+    The member names are indexed once when the archive is loaded and the decoded assets are kept in a LRU cache bounded by bytes.
+    Overwritten assets supersede the previous entries and the archive is compacted when it is closed, so no dead copies are left in the file.
+    """
 
-    __ORIG_DIR = 'archive'
+    ARCHIVE_DIR = 'archive'
 
-    def __init__(self, filepath: str) -> None:
+    def __init__(self, filepath: str, cache_size : int = 256 * 1024 * 1024) -> None:
+        """
+        Args:
+            filepath (str): the path to the pkg file
+            cache_size (int, optional): maximum number of bytes kept in the asset cache. Defaults to 256 MB.
+        """
         super().__init__(filepath)
         self._handler = None
+        # member name -> ZipInfo
+        self._members = {}
+        # sorted list of the asset paths (used for prefix listing)
+        self._assets = []
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        # Number of entries superseded by overwriting since the archive is loaded
+        self._superseded = 0
 
     def load(self):
         self._handler = zipfile.ZipFile(self.filepath, mode = 'a')
+        self._members = {}
+        for info in self._handler.infolist():
+            self._members[info.filename] = info
+        self._assets = sorted(
+            self._make_path(fp) for fp in self._members 
+            if fp.startswith(f'{self.ARCHIVE_DIR}/') and not fp.endswith('/')
+        )
+        self.clear_cache()
+        self._superseded = 0
 
     def updateAndClose(self):
         self._handler.close()
+        self._handler = None
+        # Remove the superseded entries
+        if self._superseded > 0:
+            zipio.compact(self.filepath)
+            self._superseded = 0
+
+    def compact(self) -> int:
+        """Rewrite the pkg file keeping only the live entries (vacuum). 
+        The entries are copied as raw compressed bytes without decompressing or re-encoding them.
+
+        Returns:
+            int: number of removed entries
+        """
+        reopen = self._handler is not None
+        if reopen:
+            self._handler.close()
+        removed = zipio.compact(self.filepath)
+        self._superseded = 0
+        if reopen:
+            self.load()
+        return removed
     
     def check_path(self, path : str):
-        flist = [x.filename for x in self._handler.infolist()]
-        return path in flist
+        return path in self._members
+
+    def get_asset_list(self, prefix : str = None) -> List[str]:
+        """List the assets stored in the archive
 
-    def get_asset_list(self) -> List[str]:
+        Args:
+            prefix (str, optional): only the assets starting with the prefix are listed, e.g. ``phm.postprocessing.*``. Defaults to None.
+
+        Returns:
+            List[str]: the asset paths
+        """
+        if prefix is None:
+            return list(self._assets)
+        prefix = prefix.rstrip('*')
         flist = []
-        for fz in self._handler.infolist():
-            fp = fz.filename
-            if fp.startswith(self.__ORIG_DIR):
-                flist.append(self._make_path(fp))
+        for index in range(bisect.bisect_left(self._assets, prefix), len(self._assets)):
+            fp = self._assets[index]
+            if not fp.startswith(prefix):
+                break
+            flist.append(fp)
         return flist
 
-    def get_assets(self) -> Dict[str, np.ndarray]:
+    def get_assets(self, prefix : str = None) -> Dict[str, np.ndarray]:
         res = {}
-        for f in self.get_asset_list():
+        for f in self.get_asset_list(prefix):
             arr = self.get_asset(f)
             res[f] = arr
         return res
@@ -53,20 +152,49 @@ class PKGArchive(BaseArchive):
     def _make_abspath(self, path : str) -> str:
         gPath = '/'.join(path.split('.'))
         gPath = f'{gPath}.png'
-        return os.path.join(self.__ORIG_DIR, gPath)
+        return os.path.join(self.ARCHIVE_DIR, gPath)
     
     def _make_path(self, fpath : str) -> str:
         fsec = fpath.split('/')[1:]
         fsec[-1] = fsec[-1].split('.')[0]
         return '.'.join(fsec)
 
-    @lru_cache(maxsize = 3)
+    def clear_cache(self):
+        """Remove all decoded assets from the cache"""
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    def _cache_get(self, path : str) -> np.ndarray:
+        arr = self._cache.get(path)
+        if arr is not None:
+            self._cache.move_to_end(path)
+        return arr
+
+    def _cache_put(self, path : str, arr : np.ndarray):
+        self._cache_pop(path)
+        if arr.nbytes > self.cache_size:
+            return
+        self._cache[path] = arr
+        self._cache_bytes += arr.nbytes
+        # Evict the least recently used assets
+        while self._cache_bytes > self.cache_size:
+            _, old = self._cache.popitem(last = False)
+            self._cache_bytes -= old.nbytes
+
+    def _cache_pop(self, path : str):
+        old = self._cache.pop(path, None)
+        if old is not None:
+            self._cache_bytes -= old.nbytes
+
     def get_asset(self, path : str) -> np.ndarray:
+        arr = self._cache_get(path)
+        if arr is not None:
+            return arr
         gPath = self._make_abspath(path)
-        arr = None
         if self.check_path(gPath):
-            with self._handler.open(gPath) as gfile:
+            with self._handler.open(self._members[gPath]) as gfile:
                 arr = np.array(Image.open(gfile))
+            self._cache_put(path, arr)
         return arr
 
     def set_asset(self,
@@ -75,12 +203,20 @@ class PKGArchive(BaseArchive):
         overwrite : bool = False
     ):
         gPath = self._make_abspath(path)
-        if self.check_path(gPath) and (not overwrite):
+        exist = self.check_path(gPath)
+        if exist and (not overwrite):
             raise KeyError(f'{path} already exist!')
         orig_io = io.BytesIO()
         Image.fromarray(data).save(orig_io, format='png')
+        if exist:
+            self._superseded += 1
         self._handler.writestr(gPath, orig_io.getvalue())
         orig_io.close()
+        # Update the index
+        self._members[gPath] = self._handler.getinfo(gPath)
+        if not exist:
+            bisect.insort(self._assets, path)
+        self._cache_pop(path)
 
 class Exif_JSONEncoder(json.JSONEncoder):
     """A customized JSON encoder for dealing with Exif special types."""
@@ -102,11 +238,28 @@ class PKGFileHandler(BaseFileHandler): # Parham, Keven, Kevin, and Gabriel (PKG)
     __PROP_FILE = 'properties.json'
     __METRICS_FILE = 'metrics.json'
 
-    def __init__(self, filter : List[str] = None) -> None:
-        super().__init__(filter)
+    def __init__(self, 
+        filter : List[str] = None, 
+        lazy : bool = False, 
+        crop : bool = False,
+        max_workers : int = None,
+        executor : Executor = None
+    ) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            lazy (bool, optional): if True, the layers and the original image are decoded on their first access. Defaults to False.
+            crop (bool, optional): if True, the layers are stored cropped to the bounding box of their masks. Defaults to False.
+            max_workers (int, optional): the number of threads decoding and encoding the png files of a pkg file. Defaults to None.
+            executor (Executor, optional): a shared executor used instead of creating a thread pool for each file. Defaults to None.
+        """
+        super().__init__(filter, max_workers, executor)
+        self.lazy = lazy
+        self.crop = crop
 
     def load(self, filepath: str, only_imgs : bool = False) -> phmImage:
         """Load the multi-layer image using the presented file path (pkg file).
+        In lazy mode, only the metadata is read and the images are decoded on demand.
 
         Args:
             filepath (str): the path to an openraster file
@@ -131,9 +284,8 @@ class PKGFileHandler(BaseFileHandler): # Parham, Keven, Kevin, and Gabriel (PKG)
                 # metrics
                 with pkg.open(self.__METRICS_FILE) as f:
                     metrics = json.loads(f.read())
-            # original image
-            orig_file = pkg.open(metainfo['original']['file'])
-            orig_img = np.asarray(Image.open(orig_file).convert("RGB"))
+            # original image (the source is kept for saving the untouched images without re-encoding them)
+            orig_img = PKGImage(filepath, metainfo['original']['file'], is_mask = False)
             metainfo.pop('original')
             # layers
             for layer_name, info in metainfo.items():
@@ -143,14 +295,14 @@ class PKGFileHandler(BaseFileHandler): # Parham, Keven, Kevin, and Gabriel (PKG)
                     continue
 
                 lfn = metainfo[layer_name]['file']
-                lfile = pkg.open(f'layers/{lfn}')
-                img = from_image(Image.open(lfile))
+                img = PKGImage(filepath, f'layers/{lfn}')
                 layers.append(Layer(
                     name = layer_name,
                     opacity = metainfo[layer_name]['opacity'],
                     visibility = metainfo[layer_name]['visibility'],
                     image = img,
-                    class_id = class_id))
+                    class_id = class_id,
+                    x = info.get('x', 0), y = info.get('y', 0)))
 
         entity = phmImage(
             filepath = filepath,
@@ -160,24 +312,136 @@ class PKGFileHandler(BaseFileHandler): # Parham, Keven, Kevin, and Gabriel (PKG)
             layers = layers,
             archive = PKGArchive(filepath)
         )
+        if not self.lazy:
+            # Each image is decoded from its own handle of the file, so they are decoded concurrently
+            self._map(Layer.load, entity)
         return entity
 
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a pkg file (meta.info, properties, metrics, and png headers) without decoding the images.
+
+        Args:
+            filepath (str): the path to a pkg file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with zipfile.ZipFile(filepath, mode = 'r') as pkg:
+            metainfo = json.loads(pkg.read(self.__METAINFO_FILE))
+            props = json.loads(pkg.read(self.__PROP_FILE)) if self.__PROP_FILE in pkg.NameToInfo else {}
+            metrics = json.loads(pkg.read(self.__METRICS_FILE)) if self.__METRICS_FILE in pkg.NameToInfo else {}
+            orig_info = metainfo.pop('original')
+            orig = pkg.getinfo(orig_info['file'])
+            layers = []
+            for layer_name, info in metainfo.items():
+                if self.init_class_id(layer_name) is None:
+                    continue
+                member = pkg.getinfo(f'layers/{info["file"]}')
+                layers.append(LayerInfo(
+                    name = layer_name,
+                    dimension = zipio.png_size(pkg, member),
+                    x = info.get('x', 0), y = info.get('y', 0),
+                    size = member.compress_size,
+                    opacity = info['opacity'],
+                    visibility = info['visibility']
+                ))
+            return phmImageInfo(
+                filepath = filepath,
+                title = Path(filepath).stem,
+                dimension = zipio.png_size(pkg, orig),
+                properties = props,
+                metrics = metrics,
+                layers = layers,
+                size = orig.compress_size,
+                stats = orig_info.get(STATS_KEY)
+            )
+
+    def __find_untouched(self, img : phmImage) -> Tuple[Dict[int, Tuple[str, zipfile.ZipInfo]], Tuple[str, zipfile.ZipInfo], Dict]:
+        """Find the untouched images (original and layers) of the multi-layer image in their source pkg files.
+
+        Args:
+            img (phmImage): the multi-layer image
+
+        Returns:
+            Tuple[Dict[int, Tuple[str, zipfile.ZipInfo]], Tuple[str, zipfile.ZipInfo], Dict]: the source file and the member of the untouched images 
+                (index 0 is the original layer and index i is the layer i - 1), the source thumbnail if nothing visible is changed, and the source statistics if the layers are untouched.
+        """
+        layers = tuple(img)
+        sources = {}
+        for index, layer in enumerate(layers):
+            if isinstance(layer.source, PKGImage) and not layer.is_dirty():
+                sources.setdefault(os.path.abspath(layer.source.filepath), []).append(index)
+
+        members = {}
+        thumbnail = None
+        stats = None
+        for srcpath, indexes in sources.items():
+            if not os.path.isfile(srcpath):
+                continue
+            with zipfile.ZipFile(srcpath, mode = 'r') as src:
+                for index in indexes:
+                    member = layers[index].source.member
+                    if member in src.NameToInfo:
+                        members[index] = (srcpath, src.getinfo(member))
+                # The statistics are reused (see ``phmImage.stats_metadata``) if all layers come untouched from this file with the same layout,
+                # and the thumbnail if the original image is untouched too
+                masks = [index for index in indexes if index > 0 and index in members]
+                if len(masks) == len(img.layers) and self.__METAINFO_FILE in src.NameToInfo:
+                    metainfo = json.loads(src.read(self.__METAINFO_FILE))
+                    orig_info = metainfo.pop('original', {})
+                    layout = {name : (info.get('x', 0), info.get('y', 0)) for name, info in metainfo.items()}
+                    if layout == {layer.name : (layer.x, layer.y) for layer in img.layers}:
+                        stats = orig_info.get(STATS_KEY)
+                        if 0 in indexes and 0 in members and 'thumbnail.png' in src.NameToInfo:
+                            thumbnail = (srcpath, src.getinfo('thumbnail.png'))
+        return members, thumbnail, stats
+
+    def __encode(self, job : Tuple[Layer, bool]) -> bytes:
+        # Encode a layer (or the original image) as a png file, it runs in the worker threads
+        layer, is_mask = job
+        img = create_image(layer) if is_mask else Image.fromarray(layer.image)
+        with io.BytesIO() as png_io:
+            img.save(png_io, format = 'png')
+            return png_io.getvalue()
+
     def save(self, img: phmImage, filepath: str):
         """
-        Save a multi-layer image as an pkg file
+        Save a multi-layer image as an pkg file.
+        The untouched images (see ``Layer.is_dirty``) and the archive are copied from their source pkg files as raw compressed bytes, 
+        and only the modified layers are encoded (concurrently, see ``max_workers``). The thumbnail is regenerated only if a visible change is made.
+        The statistics of the layers (see ``phmImage.stats_metadata``) are stored in the metadata (meta.info), the statistics of the source file are reused if the layers are untouched.
+        The file is written in a temporary file which replaces the destination once it is complete.
 
         Args:
             img (phmImage): Multi-layer image
             filepath (str): Path of openraster file
         """
-        
-        if img.archive is not None:
-            with img.archive as ac:
-                old_archives = ac.get_assets()
-        else:
-            old_archives = False
 
-        with zipfile.ZipFile(filepath, mode = 'w') as pkg:
+        untouched, thumbnail_src, stats = self.__find_untouched(img)
+        archive_src = None
+        if isinstance(img.archive, PKGArchive) and os.path.isfile(img.archive.filepath):
+            archive_src = os.path.abspath(img.archive.filepath)
+
+        srcpaths = {srcpath for srcpath, _ in untouched.values()}
+        if archive_src is not None:
+            srcpaths.add(archive_src)
+
+        # The untouched layers are copied (once per member), the others are encoded by the worker threads before writing the file
+        copied = {}
+        for index in range(1, len(img.layers) + 1):
+            if index in untouched and untouched[index][1].filename not in copied.values():
+                copied[index] = untouched[index][1].filename
+        jobs = {}
+        if 0 not in untouched:
+            jobs[0] = (img.orig_layer, False)
+        for index, layer in enumerate(img.layers, start = 1):
+            if index not in copied:
+                jobs[index] = (layer.cropped() if self.crop else layer, True)
+        encoded = dict(zip(jobs.keys(), self._map(self.__encode, jobs.values())))
+
+        with zipio.atomic_write(filepath) as tmppath, ExitStack() as stack:
+            sources = {srcpath : stack.enter_context(zipfile.ZipFile(srcpath, mode = 'r')) for srcpath in srcpaths}
+            pkg = stack.enter_context(zipfile.ZipFile(tmppath, mode = 'w'))
             img_list = {}
             # Save properties
             prop_dict = img.properties
@@ -192,39 +456,62 @@ class PKGFileHandler(BaseFileHandler): # Parham, Keven, Kevin, and Gabriel (PKG)
             mtr = json.dumps(img.metrics)
             pkg.writestr(self.__METRICS_FILE, mtr)
             # Save original image
+            orig_file = f'{img.title}.png'
+            if 0 in untouched:
+                srcpath, info = untouched[0]
+                orig_file = info.filename
+                zipio.copy_member(sources[srcpath], pkg, info)
+            else:
+                pkg.writestr(orig_file, encoded[0])
             img_list['original'] = {
-                'file' : f'{img.title}.png',
+                'file' : orig_file,
                 'opacity' : img.orig_layer.opacity,
-                'visibility' : img.orig_layer.visibility
+                'visibility' : img.orig_layer.visibility,
+                STATS_KEY : img.stats_metadata(stats)
             }
-            orig_io = io.BytesIO()
-            Image.fromarray(img.orig_layer.image).save(orig_io, format='png')
-            pkg.writestr(f'{img.title}.png', orig_io.getvalue())
-            orig_io.close()
             # Save thumbnail
-            thumbnail = img.thumbnail()
-            orig_io = io.BytesIO()
-            thumbnail.save(orig_io, format='png')
-            pkg.writestr('thumbnail.png', orig_io.getvalue())
-            orig_io.close()
+            if thumbnail_src is not None:
+                srcpath, info = thumbnail_src
+                zipio.copy_member(sources[srcpath], pkg, info)
+            else:
+                thumbnail = img.thumbnail()
+                orig_io = io.BytesIO()
+                thumbnail.save(orig_io, format='png')
+                pkg.writestr('thumbnail.png', orig_io.getvalue())
+                orig_io.close()
             # Create the layers folder
             zlayers = zipfile.ZipInfo('layers/')
             pkg.writestr(zlayers, '')
-            # Save Layers
-            for layer in img.layers:
+            # Save Layers (the untouched ones first to keep their member names)
+            layer_files = {}
+            for index, layer in enumerate(img.layers, start = 1):
+                if index in copied:
+                    srcpath, info = untouched[index]
+                    layer_files[index] = (info.filename.split('/', 1)[-1], layer.x, layer.y)
+                    zipio.copy_member(sources[srcpath], pkg, info)
+            for index, layer in enumerate(img.layers, start = 1):
+                if index not in layer_files:
+                    layer, _ = jobs[index]
+                    lfile = f'{layer.name}.png'
+                    suffix = 1
+                    while f'layers/{lfile}' in pkg.NameToInfo:
+                        lfile = f'{layer.name}_{suffix}.png'
+                        suffix += 1
+                    pkg.writestr(f'layers/{lfile}', encoded[index], zipfile.ZIP_DEFLATED)
+                    layer_files[index] = (lfile, layer.x, layer.y)
+            for index, layer in enumerate(img.layers, start = 1):
+                lfile, x, y = layer_files[index]
                 img_list[layer.name] = {
-                    'file' : f'{layer.name}.png',
+                    'file' : lfile,
                     'opacity' : layer.opacity,
-                    'visibility' : layer.visibility
+                    'visibility' : layer.visibility,
+                    'x' : x,
+                    'y' : y
                 }
-                layer_io = io.BytesIO()
-                create_image(layer).save(layer_io, format='png')
-                pkg.writestr(f'layers/{layer.name}.png', layer_io.getvalue(), zipfile.ZIP_DEFLATED)
-                layer_io.close()
             # Save metadata
             pkg.writestr(self.__METAINFO_FILE, json.dumps(img_list))
-        
-        # Save archive
-        if old_archives:
-            with img.archive as ac:
-                ac.set_assets(old_archives, overwrite=True)
+            # Save archive
+            if archive_src is not None:
+                for info in zipio.live_members(sources[archive_src]):
+                    if info.filename.startswith(f'{PKGArchive.ARCHIVE_DIR}/'):
+                        zipio.copy_member(sources[archive_src], pkg, info)
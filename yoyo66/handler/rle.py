@@ -1,15 +1,74 @@
 import os
-import numpy as np
 import json
+import shutil
+import tempfile
+import numpy as np
 from PIL import Image
-from typing import List, TypeVar, Dict
+from pathlib import Path
+from typing import Iterator, List, TypeVar, Dict, Tuple, Union
 import pycocotools.mask as mask_util
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, Layer
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, LazyImage, STATS_KEY
 
 Array = TypeVar("Array", bound=np.array)
 
+class RLEMask(LazyImage):
+    """
+    RLEMask keeps a binary mask in the COCO run-length encoding. The area, the bounding box,
+    the union and the intersection are calculated in the RLE domain and the mask is densified only when the pixels are requested.
+    """
+
+    cacheable = False
+
+    def __init__(self, rle: Dict) -> None:
+        """
+        Args:
+            rle (Dict): COCO RLE ({"size": [height, width], "counts": ...})
+        """
+        self.rle = rle
+
+    @classmethod
+    def from_array(cls, mask: Array):
+        """Create a RLE mask from a dense mask
+
+        Args:
+            mask (Array): the dense mask
+
+        Returns:
+            RLEMask: the encoded mask
+        """
+        return cls(mask_util.encode(np.asfortranarray(mask != 0, dtype=np.uint8)))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return tuple(self.rle["size"])
+
+    @property
+    def counts(self) -> str:
+        """The RLE counts as a string (JSON serializable)"""
+        counts = self.rle["counts"]
+        return counts.decode() if isinstance(counts, bytes) else counts
+
+    def decode(self) -> np.ndarray:
+        return np.ascontiguousarray(mask_util.decode(self.rle)).view(np.int8)
+
+    def count_nonzero(self) -> int:
+        return int(mask_util.area(self.rle))
+
+    def bbox(self) -> Tuple[int, int, int, int]:
+        return tuple(int(v) for v in mask_util.toBbox(self.rle))
+
+    @classmethod
+    def count_union(cls, images: List["RLEMask"]) -> int:
+        return int(mask_util.area(mask_util.merge([image.rle for image in images], intersect=False)))
+
+    def union(self, other: "RLEMask") -> "RLEMask":
+        return RLEMask(mask_util.merge([self.rle, other.rle], intersect=False))
+
+    def intersection(self, other: "RLEMask") -> "RLEMask":
+        return RLEMask(mask_util.merge([self.rle, other.rle], intersect=True))
+
 @mmfile_handler("rle", ["json"])
 class RLEFileHandler(BaseFileHandler):
     """
@@ -19,41 +78,52 @@ class RLEFileHandler(BaseFileHandler):
     __METRIC_KEY = "metric_"
     __ORIGINAL_LAYER = "Original"
 
-    def __init__(self, filter: List[str] = None) -> None:
+    def __init__(self, filter: List[str] = None, keep_rle: bool = False) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            keep_rle (bool, optional): if True, the loaded layers keep their masks as RLE (see ``RLEMask``). Defaults to False.
+        """
         super().__init__(filter)
+        self.keep_rle = keep_rle
 
-    def _binary_mask_to_rle(self, binary_mask: Array) -> bytearray:
+    def _create_annotations(self, input: List[Layer]) -> List[Dict]:
         """
         Checkout: https://cocodataset.org/#format-results
-        :param mask [numpy.ndarray of shape (height, width)]: Decoded 2d segmentation mask
-
-        This function returns the following dictionary:
-        {
-            "counts": encoded mask suggested by the official COCO dataset webpage.
-            "size": the size of the input mask/image
-        }
+        The layers are encoded in one call using a Fortran-ordered (height, width, layers) stack, the layers already
+        encoded (see ``RLEMask``) are kept as they are. The areas and the bounding boxes are calculated in the RLE domain.
+        The empty layers have no annotation.
         """
-        # Create dictionary for the segmentation key in the COCO dataset
-        rle = {"counts": [], "size": list(binary_mask.shape)}
-        # We need to convert it to a Fortran array
-        binary_mask_fortran = np.asfortranarray(binary_mask, dtype=np.uint8)
-        # Encode the mask as specified by the official COCO format
-        encoded_mask = mask_util.encode(binary_mask_fortran)
-        # We must decode the byte encoded string or otherwise we cannot save it as a JSON file
-        rle["counts"] = encoded_mask["counts"].decode()
-        return rle
+        rles = [None] * len(input)
+        dense = []
+        for index, contour in enumerate(input):
+            if isinstance(contour.compact_source, RLEMask):
+                # The layer is already encoded
+                rles[index] = contour.compact_source.rle
+            else:
+                dense.append(index)
+        if dense:
+            height, width = input[dense[0]].dimension
+            stack = np.empty((height, width, len(dense)), dtype=np.uint8, order="F")
+            for k, index in enumerate(dense):
+                np.not_equal(input[index].image, 0, out=stack[:, :, k])
+            for index, rle in zip(dense, mask_util.encode(stack)):
+                rles[index] = rle
+        if not rles:
+            return []
 
-    def _create_annotations(self, input: List[Layer]) -> List[Dict]:
         annotations = []
-        contour: Layer
-        for id_, contour in enumerate(input, start=1):
-            if contour.image.sum() == 0:
+        areas = mask_util.area(rles)
+        bboxes = mask_util.toBbox(rles)
+        for id_, (rle, area, bbox) in enumerate(zip(rles, areas, bboxes), start=1):
+            if area == 0:
                 continue
-            # This function takes the image and fills the contour inside it.
-            enc = self._binary_mask_to_rle(contour.image)
+            counts = rle["counts"]
             seg = {
-                "segmentation": enc,
-                "area": int(np.sum(contour.image)),
+                # We must decode the byte encoded string or otherwise we cannot save it as a JSON file
+                "segmentation": {"counts": counts.decode() if isinstance(counts, bytes) else counts, "size": list(rle["size"])},
+                "area": int(area),
+                "bbox": [int(v) for v in bbox],
                 "image_id": 0,
                 "category_id": id_,
                 "iscrowd": 0,
@@ -63,6 +133,44 @@ class RLEFileHandler(BaseFileHandler):
 
         return annotations
 
+    def _create_layers(self, entries: List[Tuple[str, int, Dict]], dimension: Tuple[int, int]) -> List[Layer]:
+        # Create the layers from their annotations (name, class id, annotation), the masks are decoded in one call
+        # and the layers without annotation (empty layers) are zero
+        rles = [ann["segmentation"] for _, _, ann in entries if ann is not None]
+        masks = mask_util.decode(rles) if rles and not self.keep_rle else None
+        layers = []
+        index = 0
+        for layer_name, class_id, ann in entries:
+            if ann is None:
+                image = np.zeros(dimension, dtype=np.int8)
+                if self.keep_rle:
+                    image = RLEMask.from_array(image)
+            else:
+                image = RLEMask(ann["segmentation"]) if self.keep_rle else masks[:, :, index].view(np.int8)
+                index += 1
+            layers.append(Layer(name=layer_name, class_id=class_id, image=image))
+        return layers
+
+    def _create_metadata(self, img: phmImage) -> Dict:
+        metrics = {}
+        for k, v in img.metrics.items():
+            metrics[f"{self.__METRIC_KEY}{k}"] = v
+        return {**img.properties, **metrics, "defects": img.layer_names, STATS_KEY: img.stats_metadata()}
+
+    def _split_metadata(self, metadata: Dict) -> Tuple[Dict, Dict, List[str], Dict]:
+        # Split the metadata into the properties, the metrics, the layer names and the statistics
+        properties = {}
+        metrics = {}
+        metadata = dict(metadata)
+        defects = metadata.pop("defects", [])
+        stats = metadata.pop(STATS_KEY, None)
+        for key, value in metadata.items():
+            if key.startswith(self.__METRIC_KEY):
+                metrics[key.replace(self.__METRIC_KEY, "")] = value
+            else:
+                properties[key] = value
+        return properties, metrics, defects, stats
+
     def save(self, img: phmImage, filepath: str) -> None:
         """Save a multi-layer image as a tiff file
 
@@ -70,13 +178,8 @@ class RLEFileHandler(BaseFileHandler):
             img (phmImage): Multi-layer image
             filepath (str): Path of tiff file
         """
-        #  Save Original image
-        metrics = {}
-        for k, v in img.metrics.items():
-            metrics[f"{self.__METRIC_KEY}{k}"] = v
-
-        annotations = self._create_annotations(img.layers)
-        metadata = {**img.properties, **metrics, "defects": img.layer_names}
+        annotations = self._create_annotations([layer.uncropped(img.dimension) for layer in img.layers])
+        metadata = self._create_metadata(img)
         
         orig_path = filepath.rsplit('.', 1)[0] + '.png'
         Image.fromarray(img.original_layer.image).save(orig_path)
@@ -89,6 +192,74 @@ class RLEFileHandler(BaseFileHandler):
         with open(filepath, "w") as fid:
             json.dump(rle_file, fid)
 
+    def open_dataset(self, filepath: str, mode: str = "r") -> Union["COCODatasetReader", "COCODatasetWriter"]:
+        """Open a COCO-style annotation file containing many multi-layer images.
+        In writing mode, the images are streamed into the file (see ``COCODatasetWriter``),
+        and in reading mode, the images are read one at a time using the byte-offset index of the file (see ``COCODatasetReader``).
+
+        Args:
+            filepath (str): The path to the annotation file (json file)
+            mode (str, optional): 'r' for reading and 'w' for writing. Defaults to "r".
+
+        Raises:
+            ValueError: if the mode is not supported
+
+        Returns:
+            Union[COCODatasetReader, COCODatasetWriter]: the opened dataset
+        """
+        if mode == "r":
+            return COCODatasetReader(self, filepath)
+        elif mode == "w":
+            return COCODatasetWriter(self, filepath)
+        raise ValueError(f"{mode} mode is not supported!")
+
+    def peek(self, filepath: str) -> phmImageInfo:
+        """Read the metadata of a rle file (metadata and RLE sizes) without decoding the masks.
+        The dimension is read from the header of the original image.
+
+        Args:
+            filepath (str): The path to an rle file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with open(filepath, "r") as rle_fid:
+            rle_file = json.load(rle_fid)
+
+        if not (imgpath := rle_file.get(self.__ORIGINAL_LAYER, False)):
+            raise ValueError("Original image path not in rle file.")
+        imgpath = os.path.join(os.path.dirname(filepath), imgpath)
+        with Image.open(imgpath) as orig:
+            width, height = orig.size
+
+        properties, metrics, defects, stats = self._split_metadata(rle_file.get("metadata", {}))
+
+        # The category identifiers are the (one-based) indexes of the layers, and the empty layers have no annotation
+        annotations = {ann["category_id"]: ann for ann in rle_file.get("annotations", [])}
+        layers = []
+        for index, layer_name in enumerate(defects, start=1):
+            if self.init_class_id(layer_name) is None:
+                continue
+            ann = annotations.get(index)
+            layers.append(
+                LayerInfo(
+                    name=layer_name,
+                    dimension=tuple(ann["segmentation"]["size"]) if ann else (height, width),
+                    size=len(ann["segmentation"]["counts"]) if ann else 0,
+                )
+            )
+
+        return phmImageInfo(
+            filepath=filepath,
+            title=Path(filepath).stem,
+            dimension=(height, width),
+            properties=properties,
+            metrics=metrics,
+            layers=layers,
+            size=os.path.getsize(imgpath),
+            stats=stats,
+        )
+
     def load(self, filepath: str) -> phmImage:
         """Load the multi-layer image using the presented file path (json file).
 
@@ -100,9 +271,6 @@ class RLEFileHandler(BaseFileHandler):
         """
 
         orig_img = None
-        properties = {}
-        metrics = {}
-        layers = []
         with open(filepath, "r") as rle_fid:
             rle_file = json.load(rle_fid)
 
@@ -112,23 +280,17 @@ class RLEFileHandler(BaseFileHandler):
             imgpath = os.path.join(os.path.dirname(filepath), imgpath)
             orig_img = np.array(Image.open(imgpath))
 
-        metadata = rle_file.get("metadata", {})
-        for key, value in metadata.items():
-            if key.startswith(self.__METRIC_KEY):
-                metrics[key.replace(self.__METRIC_KEY, "")] = value
-            else:
-                properties[key] = value
+        properties, metrics, defects, _ = self._split_metadata(rle_file.get("metadata", {}))
 
-        for layer_name, ann in zip(
-            rle_file["metadata"]["defects"], rle_file["annotations"]
-        ):
-            layers.append(
-                Layer(
-                    name=layer_name,
-                    class_id=ann["category_id"],
-                    image=mask_util.decode(ann["segmentation"]),
-                )
-            )
+        # The category identifiers are the (one-based) indexes of the layers
+        annotations = {ann["category_id"]: ann for ann in rle_file.get("annotations", [])}
+        entries = []
+        for index, layer_name in enumerate(defects, start=1):
+            class_id = self.init_class_id(layer_name)
+            if class_id is None:
+                continue
+            entries.append((layer_name, class_id, annotations.get(index)))
+        layers = self._create_layers(entries, orig_img.shape[:2])
 
         return phmImage(
             filepath=filepath,
@@ -137,3 +299,208 @@ class RLEFileHandler(BaseFileHandler):
             layers=layers,
             metrics=metrics,
         )
+
+
+def index_path(filepath: str) -> str:
+    """The path of the byte-offset index of a COCO-style annotation file written by ``COCODatasetWriter``
+
+    Args:
+        filepath (str): The path to the annotation file
+
+    Returns:
+        str: the path to the index file
+    """
+    return f"{filepath}.idx"
+
+class COCODatasetWriter:
+    """
+    Streams multi-layer images into one COCO-style annotation file ({"images": [...], "annotations": [...], "categories": [...]})
+    without keeping the document in memory. The records of the images are written as they are appended, the annotations are
+    spooled in a temporary file and copied after the images when the writer is closed. The original images are stored as png files
+    in a directory next to the annotation file (``<name>_images``).
+    A byte-offset index (see ``index_path``) keeps the position of the records of each image, so an image is read without parsing the file.
+    """
+
+    def __init__(self, handler: RLEFileHandler, filepath: str) -> None:
+        """
+        Args:
+            handler (RLEFileHandler): the file handler used for encoding the layers
+            filepath (str): The path to the annotation file (json file)
+        """
+        self.handler = handler
+        self.filepath = filepath
+        self.images_dir = f"{Path(filepath).stem}_images"
+        Path(os.path.dirname(filepath), self.images_dir).mkdir(parents=True, exist_ok=True)
+        self._categories = {}
+        # The position and the length of the image record and its annotations
+        self._offsets = []
+        self._ann_count = 0
+        self._fid = open(filepath, "wb")
+        self._ann_fid = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filepath)))
+        self._fid.write(b'{"images": [')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __write_record(self, fid, record: Dict, first: bool) -> Tuple[int, int]:
+        if not first:
+            fid.write(b", ")
+        data = json.dumps(record).encode()
+        offset = fid.tell()
+        fid.write(data)
+        return offset, len(data)
+
+    def append(self, img: phmImage) -> int:
+        """Append a multi-layer image to the annotation file
+
+        Args:
+            img (phmImage): Multi-layer image
+
+        Returns:
+            int: the identifier (position) of the image
+        """
+        image_id = len(self._offsets)
+        file_name = f"{self.images_dir}/{image_id}_{img.title}.png"
+        Image.fromarray(img.original_layer.image).save(os.path.join(os.path.dirname(self.filepath), file_name))
+        height, width = img.dimension
+        img_span = self.__write_record(self._fid, {
+            "id": image_id,
+            "file_name": file_name,
+            "height": height,
+            "width": width,
+            "title": img.title,
+            "metadata": self.handler._create_metadata(img),
+        }, image_id == 0)
+        # The annotations of an image are contiguous in the annotation list
+        layer_names = img.layer_names
+        annotations = self.handler._create_annotations([layer.uncropped(img.dimension) for layer in img.layers])
+        ann_start = ann_end = 0
+        for ann in annotations:
+            name = layer_names[ann["category_id"] - 1]
+            ann["category_id"] = self._categories.setdefault(name, len(self._categories) + 1)
+            ann["image_id"] = image_id
+            ann["id"] = self._ann_count + 1
+            offset, length = self.__write_record(self._ann_fid, ann, self._ann_count == 0)
+            if ann_end == 0:
+                ann_start = offset
+            ann_end = offset + length
+            self._ann_count += 1
+        self._offsets.append([*img_span, ann_start, ann_end - ann_start])
+        # The missing categories are the empty layers
+        for name in layer_names:
+            self._categories.setdefault(name, len(self._categories) + 1)
+        return image_id
+
+    def close(self) -> None:
+        """Complete the annotation file and write its index"""
+        if self._fid.closed:
+            return
+        self._fid.write(b'], "annotations": [')
+        ann_base = self._fid.tell()
+        self._ann_fid.seek(0)
+        shutil.copyfileobj(self._ann_fid, self._fid)
+        self._ann_fid.close()
+        categories = [{"id": cid, "name": name} for name, cid in self._categories.items()]
+        self._fid.write(b'], "categories": ')
+        self._fid.write(json.dumps(categories).encode())
+        self._fid.write(b"}")
+        self._fid.close()
+        with open(index_path(self.filepath), "w") as fid:
+            json.dump({
+                "categories": categories,
+                "images": [[img_off, img_len, ann_base + ann_off, ann_len] for img_off, img_len, ann_off, ann_len in self._offsets],
+            }, fid)
+
+class COCODatasetReader:
+    """
+    Reads the multi-layer images of a COCO-style annotation file written by ``COCODatasetWriter``.
+    The byte-offset index of the file is loaded once, then every image is read by seeking to its records,
+    so the images are accessed by their position (or iterated one at a time) without parsing the whole file.
+    """
+
+    def __init__(self, handler: RLEFileHandler, filepath: str) -> None:
+        """
+        Args:
+            handler (RLEFileHandler): the file handler used for decoding the layers
+            filepath (str): The path to the annotation file (json file)
+
+        Raises:
+            FileNotFoundError: if the index of the annotation file does not exist
+        """
+        if not os.path.isfile(index_path(filepath)):
+            raise FileNotFoundError(f"The index of {filepath} does not exist!")
+        self.handler = handler
+        self.filepath = filepath
+        with open(index_path(filepath), "r") as fid:
+            index = json.load(fid)
+        self._categories = {cat["id"]: cat["name"] for cat in index["categories"]}
+        self._offsets = index["images"]
+        self._fid = open(filepath, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the annotation file"""
+        self._fid.close()
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> phmImage:
+        return self.get(index)
+
+    def __iter__(self) -> Iterator[phmImage]:
+        for index in range(len(self)):
+            yield self.get(index)
+
+    @property
+    def categories(self) -> Tuple[str]:
+        """The names of the layers present in the dataset"""
+        return tuple(self._categories.values())
+
+    def __read(self, offset: int, length: int) -> bytes:
+        self._fid.seek(offset)
+        return self._fid.read(length)
+
+    def get(self, index: int) -> phmImage:
+        """Read an image of the dataset
+
+        Args:
+            index (int): the identifier (position) of the image
+
+        Returns:
+            phmImage: Loaded multi-layer image
+        """
+        img_off, img_len, ann_off, ann_len = self._offsets[index]
+        record = json.loads(self.__read(img_off, img_len))
+        annotations = json.loads(b"[" + self.__read(ann_off, ann_len) + b"]") if ann_len > 0 else []
+        annotations = {self._categories[ann["category_id"]]: ann for ann in annotations}
+
+        properties, metrics, defects, _ = self.handler._split_metadata(record["metadata"])
+        entries = []
+        for layer_name in defects:
+            class_id = self.handler.init_class_id(layer_name)
+            if class_id is None:
+                continue
+            entries.append((layer_name, class_id, annotations.get(layer_name)))
+        layers = self.handler._create_layers(entries, (record["height"], record["width"]))
+
+        imgpath = os.path.join(os.path.dirname(self.filepath), record["file_name"])
+        return phmImage(
+            filepath=self.filepath,
+            title=record["title"],
+            properties=properties,
+            orig_image=np.array(Image.open(imgpath)),
+            layers=layers,
+            metrics=metrics,
+        )
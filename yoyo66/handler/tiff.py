@@ -1,12 +1,65 @@
 
+import os
 import numpy as np
 import json
 
-from typing import List
-from tifffile import TiffFile, TiffWriter, DATATYPE, PHOTOMETRIC
+from typing import Dict, List, Tuple
+from pathlib import Path
+from tifffile import TiffFile, TiffPage, TiffWriter, DATATYPE, PHOTOMETRIC
 
 from yoyo66.handler import BaseFileHandler, mmfile_handler
-from yoyo66.datastruct import phmImage, Layer
+from yoyo66.handler.zipio import atomic_write
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, LazyImage, STATS_KEY
+
+def _read_page(tif : TiffFile, page : TiffPage, memmap : bool = True) -> np.ndarray:
+    if memmap and page.is_memmappable:
+        # The data of the page is mapped instead of being read
+        return np.memmap(tif.filehandle.path,
+            dtype = page.dtype.newbyteorder(tif.byteorder),
+            mode = 'r',
+            offset = page.dataoffsets[0],
+            shape = page.shape
+        )
+    return page.asarray()
+
+class TiffImage(LazyImage):
+    """
+    A lazy image stored as a page of a tiff file. The uncompressed pages are memory-mapped (see ``TiffFileHandler``).
+    The masks stored as pages of zeros and ones (int8 or binary uint8 pages) are used without conversion, the others are converted using their nonzero pixels.
+    """
+
+    def __init__(self, filepath : str, index : int, shape : Tuple[int, ...], is_mask : bool = True, memmap : bool = True, binary : bool = False) -> None:
+        """
+        Args:
+            filepath (str): the path to the tiff file
+            index (int): the index of the page
+            shape (Tuple[int, ...]): the shape of the page
+            is_mask (bool, optional): True if the image is a mask layer, otherwise it is the original image. Defaults to True.
+            memmap (bool, optional): if True, the uncompressed and contiguous page is loaded as a read-only memory-mapped array. Defaults to True.
+            binary (bool, optional): True if the page is a uint8 mask of zeros and ones (see the 'uint8' mask profile), it is viewed as int8. Defaults to False.
+        """
+        self.filepath = filepath
+        self.index = index
+        self.page_shape = tuple(shape)
+        self.is_mask = is_mask
+        self.memmap = memmap
+        self.binary = binary
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.page_shape[:2] if self.is_mask else self.page_shape
+
+    def decode(self) -> np.ndarray:
+        with TiffFile(self.filepath) as tif:
+            img = _read_page(tif, tif.pages[self.index], self.memmap)
+        if not self.is_mask:
+            return img
+        if img.dtype == np.bool_ or (self.binary and img.dtype == np.uint8 and img.ndim == 2):
+            return img.view(np.int8)
+        if img.ndim > 2 or img.dtype != np.int8:
+            img = np.max(img, axis=2) if img.ndim > 2 else img
+            img = (img != 0).view(np.int8)
+        return img
 
 @mmfile_handler('tiff', ['tif'])
 class TiffFileHandler(BaseFileHandler):
@@ -16,12 +69,67 @@ class TiffFileHandler(BaseFileHandler):
 
     __ORIGINAL_LAYER = 'Original'
     __METRIC_STARTKEY = 'metric_'
+    # Private tag keeping the class id of the mask pages
+    __CLASSID_TAG = 65000
+    __MAXSAMPLEVALUE_TAG = 281
+    __MASK_PROFILES = ('rgba', 'bilevel', 'uint8')
 
-    def __init__(self, filter : List[str] = None) -> None:
+    def __init__(self, 
+        filter : List[str] = None, 
+        memmap : bool = True, 
+        compression : str = 'zlib',
+        mask_profile : str = 'rgba'
+    ) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            memmap (bool, optional): if True, the uncompressed and contiguous pages are loaded as read-only memory-mapped arrays. Defaults to True.
+            compression (str, optional): the compression of the pages ('zlib', or None for uncompressed pages). Defaults to 'zlib'.
+            mask_profile (str, optional): the format of the mask pages, 'rgba' (class map colors), 'bilevel' (1-bit pages compressed with packbits),
+                or 'uint8' (single-channel pages of zeros and ones, memory-mapped when they are uncompressed). Defaults to 'rgba'.
+
+        Raises:
+            ValueError: if the mask profile is not supported
+        """
         super().__init__(filter)
+        if not mask_profile in self.__MASK_PROFILES:
+            raise ValueError(f'{mask_profile} mask profile is not supported!')
+        self.memmap = memmap
+        self.compression = compression
+        self.mask_profile = mask_profile
+
+    def __page_index(self, tif : TiffFile) -> Dict[str, int]:
+        # Map the names of the pages (PageName tag) to their positions, only the tags of the pages are read
+        index = {}
+        for i, page in enumerate(tif.pages):
+            # Check if the layer is named!
+            if 'PageName' in page.tags:
+                index.setdefault(page.tags['PageName'].value, i)
+        if not self.__ORIGINAL_LAYER in index:
+            raise KeyError('original layer is missing!')
+        return index
+
+    def __read_metadata(self, page : TiffPage) -> Tuple[Dict, Dict, Dict]:
+        properties = {}
+        metrics = {}
+        metadata = json.loads(page.description)
+        stats = metadata.pop(STATS_KEY, None)
+        for key, value in metadata.items():
+            if key.startswith(self.__METRIC_STARTKEY):
+                metrics[key.replace(self.__METRIC_STARTKEY, '')] = value
+            else:
+                properties[key] = value
+        return properties, metrics, stats
+
+    def __is_binary(self, page : TiffPage) -> bool:
+        # Check if a mask page is a uint8 page of zeros and ones (written by the 'uint8' mask profile)
+        tag = page.tags.get(self.__MAXSAMPLEVALUE_TAG)
+        return page.dtype == np.uint8 and len(page.shape) == 2 and tag is not None and tag.value == 1
 
     def load(self, filepath: str, only_imgs : bool = False) -> phmImage:
         """Load the multi-layer image using the presented file path (tiff file).
+        Only the original page and the pages of the requested layers are decoded.
+        The uncompressed pages are memory-mapped (see the ``memmap`` option), and the masks stored as pages of zeros and ones are used without conversion.
 
         Args:
             filepath (str): the path to an tiff file
@@ -30,58 +138,105 @@ class TiffFileHandler(BaseFileHandler):
             phmImage: Loaded multi-layer image
         """
 
-        orig_img = None
         properties = {}
         metrics = {}
         layers = []
         with TiffFile(filepath) as tif:
-            for page in tif.pages:
-                # Check if the layer is named!
-                if not 'PageName' in page.tags:
+            pages = self.__page_index(tif)
+            # Loading the original image
+            index = pages.pop(self.__ORIGINAL_LAYER)
+            page = tif.pages[index]
+            orig_img = TiffImage(filepath, index, page.shape, is_mask = False, memmap = self.memmap)
+            if not only_imgs:
+                properties, metrics, _ = self.__read_metadata(page)
+            # Loading the requested layers
+            for layer_name, index in pages.items():
+                page = tif.pages[index]
+                key = layer_name.strip().lower()
+                if not self._enable_filter and not key in self.categories and self.__CLASSID_TAG in page.tags:
+                    # The class id stored with the mask
+                    self.categories[key] = page.tags[self.__CLASSID_TAG].value
+                class_id = self.init_class_id(layer_name)
+                if class_id is None:
                     continue
-                layer_name = page.tags['PageName'].value
-                # Load image data
-                img = page.asarray()
-                # Loading the original image
-                if layer_name == self.__ORIGINAL_LAYER:
-                    orig_img = img
-                    # Loading metadata
-                    metadata = json.loads(page.description)
-                    for key, value in metadata.items():
-                        if key.startswith(self.__METRIC_STARTKEY):
-                            metrics[key.replace(self.__METRIC_STARTKEY, '')] = value
-                        else:
-                            properties[key] = value
-                else:
-                    class_id = self.init_class_id(layer_name)
-                    if class_id is None:
-                        continue
-                    
-                    img = np.max(np.asarray(img), axis=2) if len(img.shape) > 2 else img
-                    img = np.where(img != 0, 1, 0).astype(np.int8)
-                    layers.append(Layer(
-                        name = layer_name,
-                        class_id = class_id,
-                        image = img
-                    ))
-
-        return phmImage(
+                layers.append(Layer(
+                    name = layer_name,
+                    class_id = class_id,
+                    image = TiffImage(filepath, index, page.shape, memmap = self.memmap, binary = self.__is_binary(page))
+                ))
+
+        img = phmImage(
             filepath = filepath,
             properties = properties,
             orig_image = orig_img,
             layers = layers,
             metrics = metrics
         )
+        # The pages are decoded (or mapped) once the file is indexed, the sources are kept for detecting the untouched layers
+        for layer in img:
+            layer.load()
+        return img
+
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a tiff file (page tags and description) without decoding the pages.
+
+        Args:
+            filepath (str): the path to an tiff file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+
+        layers = []
+        with TiffFile(filepath) as tif:
+            pages = self.__page_index(tif)
+            page = tif.pages[pages.pop(self.__ORIGINAL_LAYER)]
+            dimension = tuple(page.shape[:2])
+            size = int(sum(page.databytecounts))
+            properties, metrics, stats = self.__read_metadata(page)
+            for layer_name, index in pages.items():
+                if self.init_class_id(layer_name) is None:
+                    continue
+                page = tif.pages[index]
+                layers.append(LayerInfo(
+                    name = layer_name,
+                    dimension = tuple(page.shape[:2]),
+                    size = int(sum(page.databytecounts))
+                ))
+
+        return phmImageInfo(
+            filepath = filepath,
+            title = Path(filepath).stem,
+            dimension = dimension,
+            properties = properties,
+            metrics = metrics,
+            layers = layers,
+            size = size,
+            stats = stats
+        )
+
+    def __stored_stats(self, img : phmImage) -> Dict:
+        # The statistics stored in the source tiff file of the layers (if all of them come from the same file)
+        sources = {os.path.abspath(layer.source.filepath) if isinstance(layer.source, TiffImage) else None for layer in img.layers}
+        if len(sources) != 1 or None in sources or not os.path.isfile(next(iter(sources))):
+            return None
+        with TiffFile(next(iter(sources))) as tif:
+            _, _, stats = self.__read_metadata(tif.pages[self.__page_index(tif)[self.__ORIGINAL_LAYER]])
+        return stats
 
     def save(self, img: phmImage, filepath: str) -> None:
-        """Save a multi-layer image as a tiff file
+        """Save a multi-layer image as a tiff file.
+        The statistics of the layers (see ``phmImage.stats_metadata``) are stored in the description of the original page, 
+        the statistics of the source file are reused if none of the layers is modified.
+        The file is written in a temporary file which replaces the destination once it is complete (the loaded pages may be mapped on it).
 
         Args:
             img (phmImage): Multi-layer image
             filepath (str): Path of tiff file
         """
 
-        with TiffWriter(filepath) as tif:
+        stats = img.stats_metadata(self.__stored_stats(img))
+        with atomic_write(filepath) as tmppath, TiffWriter(tmppath) as tif:
             #  Save Original image
             metrics = {}
             for k, v in img.metrics.items():
@@ -91,18 +246,42 @@ class TiffFileHandler(BaseFileHandler):
                 dtype = img.orig_layer.image.dtype,
                 photometric=PHOTOMETRIC.RGB,
                 software = 'PHM',
-                compression = 'zlib',
-                metadata = {**img.properties, **metrics},
+                compression = self.compression,
+                metadata = {**img.properties, **metrics, STATS_KEY : stats},
                 extratags=[(285, DATATYPE.ASCII, len(self.__ORIGINAL_LAYER), self.__ORIGINAL_LAYER, False)]
             )
             # Save layers
             for layer in img.layers:
-                # dd = layer.classmap()
-                dd = layer.classmap_rgba()
-                tif.write(dd,
-                    dtype = dd.dtype,
-                    photometric = PHOTOMETRIC.RGB,
+                # TIFF pages are stored with the size of the image
+                layer = layer.uncropped(img.dimension)
+                tags = [(285, DATATYPE.ASCII, len(layer.name), layer.name, False)]
+                if self.mask_profile == 'rgba':
+                    dd = layer.classmap_rgba()
+                    tif.write(dd,
+                        dtype = dd.dtype,
+                        photometric = PHOTOMETRIC.RGB,
+                        software = 'PHM',
+                        compression = self.compression,
+                        extratags = tags
+                    )
+                    continue
+                # The masks are stored as grayscale pages, the class id is kept in a tag
+                if layer.class_id is not None:
+                    tags.append((self.__CLASSID_TAG, DATATYPE.LONG, 1, int(layer.class_id), False))
+                mask = layer.image != 0
+                options = {}
+                if self.mask_profile == 'uint8':
+                    # The pages of zeros and ones are flagged by their maximum sample value, they are used without conversion
+                    mask = mask.view(np.uint8)
+                    tags.append((self.__MAXSAMPLEVALUE_TAG, DATATYPE.SHORT, 1, 1, False))
+                    options['compression'] = self.compression
+                    if self.compression == 'zlib':
+                        options['compressionargs'] = {'level' : 1}
+                else:
+                    options['compression'] = None if self.compression is None else 'packbits'
+                tif.write(mask,
+                    photometric = PHOTOMETRIC.MINISBLACK,
                     software = 'PHM',
-                    compression = 'zlib',
-                    extratags=[(285, DATATYPE.ASCII, len(layer.name), layer.name, False)]
+                    extratags = tags,
+                    **options
                 )
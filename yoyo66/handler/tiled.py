@@ -0,0 +1,286 @@
+import io
+import os
+import json
+import zipfile
+
+import numpy as np
+
+from pathlib import Path
+from PIL import Image
+from typing import Dict, Iterator, List, Tuple
+
+from yoyo66.handler import BaseFileHandler, mmfile_handler
+from yoyo66.handler import zipio
+from yoyo66.datastruct import phmImage, phmImageInfo, LayerInfo, Layer, LazyImage, STATS_KEY
+
+class TiledImage(LazyImage):
+    """
+    A lazy image stored as png tiles inside a tpk file. A region read decodes only the tiles intersecting the region.
+    """
+
+    def __init__(self,
+        filepath : str,
+        prefix : str,
+        shape : Tuple[int, ...],
+        tile_size : int,
+        tiles : List[Tuple[int, int]] = None,
+        dtype : np.dtype = np.int8
+    ) -> None:
+        """
+        Args:
+            filepath (str): the path to the tpk file
+            prefix (str): the directory of the tiles inside the tpk file
+            shape (Tuple[int, ...]): the shape of the image
+            tile_size (int): the size of the (square) tiles
+            tiles (List[Tuple[int, int]], optional): the stored tiles (row, column). The missing tiles are zero. Defaults to all tiles.
+            dtype (np.dtype, optional): the type of the image. Masks (int8) are stored as bilevel tiles. Defaults to np.int8.
+        """
+        self.filepath = filepath
+        self.prefix = prefix
+        self._shape = tuple(shape)
+        self.tile_size = tile_size
+        self.tiles = None if tiles is None else set(map(tuple, tiles))
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self._shape
+
+    def member(self, row : int, col : int) -> str:
+        """The member of a tile in the tpk file
+
+        Args:
+            row (int): the row of the tile
+            col (int): the column of the tile
+
+        Returns:
+            str: the path of the tile inside the tpk file
+        """
+        return f'{self.prefix}/{row}_{col}.png'
+
+    def stored_tiles(self) -> Iterator[Tuple[int, int]]:
+        """The tiles stored in the file
+
+        Yields:
+            Iterator[Tuple[int, int]]: the row and the column of the tiles
+        """
+        rows, cols = tile_grid(self._shape, self.tile_size)
+        for row in range(rows):
+            for col in range(cols):
+                if self.tiles is None or (row, col) in self.tiles:
+                    yield (row, col)
+
+    def read_region(self, x : int, y : int, width : int, height : int) -> np.ndarray:
+        region = np.zeros((height, width) + self._shape[2:], dtype = self.dtype)
+        if width <= 0 or height <= 0:
+            return region
+        ts = self.tile_size
+        with zipfile.ZipFile(self.filepath, mode = 'r') as tpk:
+            for row in range(y // ts, (y + height - 1) // ts + 1):
+                for col in range(x // ts, (x + width - 1) // ts + 1):
+                    if self.tiles is not None and (row, col) not in self.tiles:
+                        continue
+                    with tpk.open(self.member(row, col)) as f:
+                        tile = np.asarray(Image.open(f))
+                    # Intersection of the tile and the region
+                    ty0, tx0 = row * ts, col * ts
+                    y0, x0 = max(y, ty0), max(x, tx0)
+                    y1, x1 = min(y + height, ty0 + tile.shape[0]), min(x + width, tx0 + tile.shape[1])
+                    region[y0 - y:y1 - y, x0 - x:x1 - x] = tile[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+        return region
+
+    def decode(self) -> np.ndarray:
+        return self.read_region(0, 0, self._shape[1], self._shape[0])
+
+def tile_grid(shape : Tuple[int, ...], tile_size : int) -> Tuple[int, int]:
+    """The number of tiles covering an image
+
+    Args:
+        shape (Tuple[int, ...]): the shape of the image
+        tile_size (int): the size of the tiles
+
+    Returns:
+        Tuple[int, int]: the number of rows and columns of tiles
+    """
+    return (-(-shape[0] // tile_size), -(-shape[1] // tile_size))
+
+@mmfile_handler('tiled', ['tpk'])
+class TiledFileHandler(BaseFileHandler):
+    """
+    Tiled file handler for loading and saving tpk files (*.tpk).
+    A tpk file is a zip file in which the original image and the layers are stored as png tiles,
+    so the regions of very large images can be read without decoding the whole images (see ``phmImage.read_region``).
+    The empty tiles of the masks are not stored.
+    """
+
+    __METAINFO_FILE = 'meta.json'
+    __ORIG_DIR = 'original'
+    __LAYERS_DIR = 'layers'
+
+    def __init__(self, filter : List[str] = None, tile_size : int = 512, lazy : bool = True) -> None:
+        """
+        Args:
+            filter (List[str], optional): List of class names to load. Defaults to None.
+            tile_size (int, optional): the size of the tiles used for saving the images. Defaults to 512.
+            lazy (bool, optional): if True, the images are decoded on their first access (or by regions). Defaults to True.
+        """
+        super().__init__(filter)
+        self.tile_size = tile_size
+        self.lazy = lazy
+
+    def __source(self, filepath : str, info : Dict, tile_size : int) -> TiledImage:
+        return TiledImage(filepath, info['dir'], info['shape'], tile_size, info.get('tiles'), info['dtype'])
+
+    def load(self, filepath : str, only_imgs : bool = False) -> phmImage:
+        """Load the multi-layer image using the presented file path (tpk file).
+        In lazy mode, only the metadata is read and the tiles are decoded on demand.
+
+        Args:
+            filepath (str): the path to a tpk file
+
+        Returns:
+            phmImage: Loaded multi-layer image
+        """
+        with zipfile.ZipFile(filepath, mode = 'r') as tpk:
+            metainfo = json.loads(tpk.read(self.__METAINFO_FILE))
+        tile_size = metainfo['tile_size']
+        layers = []
+        for info in metainfo['layers']:
+            class_id = self.init_class_id(info['name'])
+            if class_id is None:
+                continue
+            layers.append(Layer(
+                name = info['name'],
+                opacity = info['opacity'],
+                visibility = info['visibility'],
+                image = self.__source(filepath, info, tile_size),
+                class_id = class_id,
+                x = info['x'], y = info['y']
+            ))
+
+        img = phmImage(
+            filepath = filepath,
+            properties = {} if only_imgs else metainfo['properties'],
+            metrics = {} if only_imgs else metainfo['metrics'],
+            orig_image = self.__source(filepath, metainfo['original'], tile_size),
+            layers = layers
+        )
+        if not self.lazy:
+            for layer in img:
+                layer.load()
+        return img
+
+    def peek(self, filepath : str) -> phmImageInfo:
+        """Read the metadata of a tpk file (meta.json) without decoding the tiles.
+
+        Args:
+            filepath (str): the path to a tpk file
+
+        Returns:
+            phmImageInfo: the metadata of the multi-layer image
+        """
+        with zipfile.ZipFile(filepath, mode = 'r') as tpk:
+            metainfo = json.loads(tpk.read(self.__METAINFO_FILE))
+            tile_size = metainfo['tile_size']
+
+            def stored_size(info : Dict) -> int:
+                source = self.__source(filepath, info, tile_size)
+                return sum(tpk.getinfo(source.member(*tile)).compress_size for tile in source.stored_tiles())
+
+            layers = []
+            for info in metainfo['layers']:
+                if self.init_class_id(info['name']) is None:
+                    continue
+                layers.append(LayerInfo(
+                    name = info['name'],
+                    dimension = tuple(info['shape'][:2]),
+                    x = info['x'], y = info['y'],
+                    size = stored_size(info),
+                    opacity = info['opacity'],
+                    visibility = info['visibility']
+                ))
+            return phmImageInfo(
+                filepath = filepath,
+                title = Path(filepath).stem,
+                dimension = tuple(metainfo['original']['shape'][:2]),
+                properties = metainfo['properties'],
+                metrics = metainfo['metrics'],
+                layers = layers,
+                size = stored_size(metainfo['original']),
+                stats = metainfo.get(STATS_KEY)
+            )
+
+    def __write_tiles(self, tpk : zipfile.ZipFile, layer : Layer, prefix : str, is_mask : bool) -> Dict:
+        # Write the tiles of a layer (the empty tiles of the masks are skipped) and return its metadata
+        source = layer.source
+        if isinstance(source, TiledImage) and source.tile_size == self.tile_size and \
+           not layer.is_dirty() and os.path.isfile(source.filepath):
+            # The tiles of the untouched layers are copied as raw bytes
+            tiles = list(source.stored_tiles())
+            with zipfile.ZipFile(source.filepath, mode = 'r') as src:
+                for row, col in tiles:
+                    zipio.copy_member(src, tpk, source.member(row, col), f'{prefix}/{row}_{col}.png')
+            shape, dtype = source.shape, source.dtype
+        else:
+            data = layer.image
+            shape, dtype = data.shape, (np.int8 if is_mask else data.dtype)
+            tiles = []
+            ts = self.tile_size
+            rows, cols = tile_grid(shape, ts)
+            for row in range(rows):
+                for col in range(cols):
+                    tile = data[row * ts:(row + 1) * ts, col * ts:(col + 1) * ts]
+                    if is_mask:
+                        # Masks are stored as bilevel images
+                        tile = tile != 0
+                        if not tile.any():
+                            continue
+                    tile_io = io.BytesIO()
+                    Image.fromarray(tile).save(tile_io, format = 'png')
+                    tpk.writestr(f'{prefix}/{row}_{col}.png', tile_io.getvalue())
+                    tiles.append((row, col))
+        return {
+            'dir' : prefix,
+            'shape' : list(shape),
+            'dtype' : np.dtype(dtype).str,
+            'tiles' : [list(tile) for tile in tiles] if is_mask else None
+        }
+
+    def __stored_stats(self, img : phmImage) -> Dict:
+        # The statistics stored in the source tpk file of the layers (if all of them come from the same file)
+        sources = {os.path.abspath(layer.source.filepath) if isinstance(layer.source, TiledImage) else None for layer in img.layers}
+        if len(sources) != 1 or None in sources or not os.path.isfile(next(iter(sources))):
+            return None
+        with zipfile.ZipFile(next(iter(sources)), mode = 'r') as tpk:
+            return json.loads(tpk.read(self.__METAINFO_FILE)).get(STATS_KEY)
+
+    def save(self, img : phmImage, filepath : str):
+        """Save a multi-layer image as a tpk file. The untouched tiled layers with the same tile size are copied without decoding them,
+        and the statistics of the source file are reused if none of the layers is modified (see ``phmImage.stats_metadata``).
+        The file is written in a temporary file which replaces the destination once it is complete.
+
+        Args:
+            img (phmImage): Multi-layer image
+            filepath (str): Path of tpk file
+        """
+        stats = img.stats_metadata(self.__stored_stats(img))
+        with zipio.atomic_write(filepath) as tmppath, zipfile.ZipFile(tmppath, mode = 'w') as tpk:
+            orig = self.__write_tiles(tpk, img.orig_layer, self.__ORIG_DIR, False)
+            layers = []
+            for index, layer in enumerate(img.layers):
+                layers.append({
+                    'name' : layer.name,
+                    'opacity' : layer.opacity,
+                    'visibility' : layer.visibility,
+                    'x' : layer.x,
+                    'y' : layer.y,
+                    **self.__write_tiles(tpk, layer, f'{self.__LAYERS_DIR}/{index}', True)
+                })
+            tpk.writestr(self.__METAINFO_FILE, json.dumps({
+                'tile_size' : self.tile_size,
+                'original' : orig,
+                'properties' : img.properties,
+                'metrics' : img.metrics,
+                'layers' : layers,
+                STATS_KEY : stats
+            }))
@@ -0,0 +1,260 @@
+"""
+yoyo66.handler.zipio contains the low-level functionalities for zip-based file formats (e.g. pkg),
+such as copying compressed members without decompressing them and compacting archives.
+"""
+
+import os
+import copy
+import time
+import zlib
+import shutil
+import struct
+import zipfile
+import tempfile
+import contextlib
+
+from typing import BinaryIO, Iterator, List, Tuple
+
+# Local file header (see zipfile.structFileHeader)
+__LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+__LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+__FILENAME_LENGTH = 10
+__EXTRA_FIELD_LENGTH = 11
+# General purpose flag indicating the sizes and CRC are stored in a data descriptor after the data
+__DATA_DESCRIPTOR_FLAG = 0x08
+# Size of the chunks used for streaming the members
+__CHUNK_SIZE = 1024 * 1024
+# Identifier of the extra field used for padding the local headers (same as zipalign)
+__ALIGNMENT_EXTRA_ID = 0xD935
+# PNG signature followed by the IHDR chunk (length, type, width, height)
+__PNG_HEADER = struct.Struct('>8sL4sLL')
+__PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def _seek_data(fp : BinaryIO, info : zipfile.ZipInfo):
+    # Move the file pointer to the compressed data of the member
+    fp.seek(info.header_offset)
+    header = __LOCAL_HEADER.unpack(fp.read(__LOCAL_HEADER.size))
+    if header[0] != __LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f'Bad local header for {info.filename}')
+    fp.seek(header[__FILENAME_LENGTH] + header[__EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+def data_offset(fp : BinaryIO, info : zipfile.ZipInfo) -> int:
+    """The position of the data of a zip member in the zip file.
+
+    Args:
+        fp (BinaryIO): the zip file opened in binary mode
+        info (zipfile.ZipInfo): the information of the member
+
+    Raises:
+        zipfile.BadZipFile: if the local header of the member is invalid
+
+    Returns:
+        int: the offset of the (compressed) data of the member
+    """
+    _seek_data(fp, info)
+    return fp.tell()
+
+def read_raw(fp : BinaryIO, info : zipfile.ZipInfo) -> bytes:
+    """Read the compressed bytes of a zip member without decompressing them.
+
+    Args:
+        fp (BinaryIO): the zip file opened in binary mode
+        info (zipfile.ZipInfo): the information of the member
+
+    Raises:
+        zipfile.BadZipFile: if the local header of the member is invalid
+
+    Returns:
+        bytes: the compressed data of the member
+    """
+    _seek_data(fp, info)
+    return fp.read(info.compress_size)
+
+def _write_member(zfile : zipfile.ZipFile, info : zipfile.ZipInfo, write_data, arcname : str = None) -> zipfile.ZipInfo:
+    # Write the local header of a member and its data (written by write_data(fp)) at the end of the zip file
+    zinfo = copy.copy(info)
+    if arcname is not None:
+        zinfo.filename = arcname
+        zinfo.orig_filename = arcname
+    # Sizes and CRC are known, so they are written in the local header
+    zinfo.flag_bits &= ~__DATA_DESCRIPTOR_FLAG
+    if hasattr(zinfo, '_end_offset'):
+        zinfo._end_offset = None
+    with zfile._lock:
+        if zfile._seekable:
+            zfile.fp.seek(zfile.start_dir)
+        zinfo.header_offset = zfile.fp.tell()
+        zfile._writecheck(zinfo)
+        zfile._didModify = True
+        zfile.fp.write(zinfo.FileHeader())
+        write_data(zfile.fp)
+        zfile.start_dir = zfile.fp.tell()
+        zfile.filelist.append(zinfo)
+        zfile.NameToInfo[zinfo.filename] = zinfo
+    return zinfo
+
+def write_raw(zfile : zipfile.ZipFile, info : zipfile.ZipInfo, data : bytes, arcname : str = None) -> zipfile.ZipInfo:
+    """Write already compressed bytes as a new member of a zip file (opened for writing).
+    The compression type, CRC and sizes are taken from the given member information.
+
+    Args:
+        zfile (zipfile.ZipFile): the destination zip file
+        info (zipfile.ZipInfo): the information of the member (e.g. from the source zip file)
+        data (bytes): the compressed data
+        arcname (str, optional): the name of the new member. Defaults to the name of the member.
+
+    Returns:
+        zipfile.ZipInfo: the information of the written member
+    """
+    return _write_member(zfile, info, lambda fp: fp.write(data), arcname)
+
+def write_aligned(zfile : zipfile.ZipFile, arcname : str, buffers : List, alignment : int = 64) -> zipfile.ZipInfo:
+    """Write a new uncompressed member of a zip file (opened for writing) whose data starts at an aligned offset of the file.
+    The local header is padded with an extra field, so the data can be memory-mapped directly from the zip file.
+
+    Args:
+        zfile (zipfile.ZipFile): the destination zip file
+        arcname (str): the name of the member
+        buffers (List): the data of the member as a list of buffers (e.g. bytes or contiguous arrays) which are written one after another
+        alignment (int, optional): the alignment of the data in bytes. Defaults to 64.
+
+    Returns:
+        zipfile.ZipInfo: the information of the written member
+    """
+    buffers = [memoryview(buf).cast('B') for buf in buffers]
+    zinfo = zipfile.ZipInfo(arcname, date_time = time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = zinfo.compress_size = sum(buf.nbytes for buf in buffers)
+    crc = 0
+    for buf in buffers:
+        crc = zlib.crc32(buf, crc)
+    zinfo.CRC = crc
+
+    def write_data(fp : BinaryIO):
+        for buf in buffers:
+            fp.write(buf)
+
+    with zfile._lock:
+        offset = zfile.start_dir if zfile._seekable else zfile.fp.tell()
+        # The padding extra field (4 bytes of header followed by zeros)
+        header_size = len(zinfo.FileHeader()) + 4
+        padding = (-(offset + header_size)) % alignment
+        zinfo.extra = struct.pack('<HH', __ALIGNMENT_EXTRA_ID, padding) + bytes(padding)
+        return _write_member(zfile, zinfo, write_data)
+
+def copy_member(src : zipfile.ZipFile, dest : zipfile.ZipFile, member, arcname : str = None) -> zipfile.ZipInfo:
+    """Copy a member from a zip file to another one as raw compressed bytes (no decompression or recompression).
+    The data is streamed by chunks, so the member is never entirely loaded in memory.
+
+    Args:
+        src (zipfile.ZipFile): the source zip file
+        dest (zipfile.ZipFile): the destination zip file
+        member (Union[str, zipfile.ZipInfo]): the name or the information of the member
+        arcname (str, optional): the name of the member in the destination. Defaults to the same name.
+
+    Returns:
+        zipfile.ZipInfo: the information of the written member
+    """
+    info = member if isinstance(member, zipfile.ZipInfo) else src.getinfo(member)
+
+    def stream(fp : BinaryIO):
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = src.fp.read(min(remaining, __CHUNK_SIZE))
+            if not chunk:
+                raise zipfile.BadZipFile(f'Truncated data for {info.filename}')
+            fp.write(chunk)
+            remaining -= len(chunk)
+
+    with src._lock:
+        _seek_data(src.fp, info)
+        return _write_member(dest, info, stream, arcname)
+
+def png_size(zfile : zipfile.ZipFile, member) -> Tuple[int, int]:
+    """Read the size of a png image stored in a zip file from its header (only the first bytes are decompressed).
+
+    Args:
+        zfile (zipfile.ZipFile): the zip file
+        member (Union[str, zipfile.ZipInfo]): the name or the information of the member
+
+    Raises:
+        ValueError: if the member is not a png image
+
+    Returns:
+        Tuple[int, int]: the size of the image (height, width)
+    """
+    with zfile.open(member) as f:
+        data = f.read(__PNG_HEADER.size)
+    if len(data) < __PNG_HEADER.size:
+        raise ValueError(f'Invalid png header for {member}')
+    signature, _, ctype, width, height = __PNG_HEADER.unpack(data)
+    if signature != __PNG_SIGNATURE or ctype != b'IHDR':
+        raise ValueError(f'Invalid png header for {member}')
+    return (height, width)
+
+def live_members(zfile : zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    """The members of a zip file that are not superseded by a member with the same name written later.
+
+    Args:
+        zfile (zipfile.ZipFile): the zip file
+
+    Returns:
+        List[zipfile.ZipInfo]: the live members in the order of the zip file
+    """
+    return [info for info in zfile.infolist() if zfile.NameToInfo.get(info.filename) is info]
+
+def count_garbage(filepath : str) -> int:
+    """Number of superseded (dead) members of a zip file
+
+    Args:
+        filepath (str): the path to the zip file
+
+    Returns:
+        int: number of dead members
+    """
+    with zipfile.ZipFile(filepath, mode = 'r') as zfile:
+        return len(zfile.infolist()) - len(live_members(zfile))
+
+@contextlib.contextmanager
+def atomic_write(filepath : str) -> Iterator[str]:
+    """Provide a temporary path for writing a file which replaces the given file atomically on success.
+    The temporary file is created in the same directory (same file system), and it is removed on failure,
+    so the original file is never left half-written.
+
+    Args:
+        filepath (str): the path to the final file
+
+    Yields:
+        str: the path to the temporary file
+    """
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    fd, tmppath = tempfile.mkstemp(prefix = '.yoyo66_', suffix = '.tmp', dir = dirname)
+    os.close(fd)
+    try:
+        yield tmppath
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, tmppath)
+        os.replace(tmppath, filepath)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def compact(filepath : str) -> int:
+    """Rewrite a zip file keeping only the live members. The members are copied as raw compressed bytes.
+    The new file is written in the same directory and replaces the original file atomically.
+
+    Args:
+        filepath (str): the path to the zip file
+
+    Returns:
+        int: number of removed members
+    """
+    removed = count_garbage(filepath)
+    if removed > 0:
+        with atomic_write(filepath) as tmppath:
+            with zipfile.ZipFile(filepath, mode = 'r') as src, zipfile.ZipFile(tmppath, mode = 'w') as dest:
+                dest.comment = src.comment
+                for info in live_members(src):
+                    copy_member(src, dest, info)
+    return removed
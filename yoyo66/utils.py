@@ -2,7 +2,7 @@ import os.path
 import numpy as np
 
 from pathlib import Path
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, Iterator, List, Tuple
 
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
@@ -171,8 +171,34 @@ def convert_file__(src_file : str, dest_file : str, filter : List[str] = None):
         dest_file = dest_file
     )
 
+def create_container(files : List[str], dest_file : str, filter : List[str] = None, **kwargs) -> Iterator[Tuple[bool, str]]:
+    """Pack multi-layer imagery files (e.g. a directory of pkg files) into one hdf5 container (see ``H5Container``).
+    The images are appended to the container if it already exists, the images already in the container are skipped.
+
+    Args:
+        files (List[str]): List of multi-layer imagery files
+        dest_file (str): the path to the hdf5 container
+        filter (List[str], optional): filter categories. Defaults to None.
+        kwargs: options passed to the constructor of the hdf5 file handler.
+
+    Yields:
+        Iterator[Tuple[bool, str]]: the status of packing and the path of each file
+    """
+    h5 = build_by_name('h5', filter, **kwargs)
+    with h5.open_container(dest_file, mode = 'a') as container:
+        for fin in files:
+            try:
+                img = load_file(fin, filter)
+                if not img.title in container:
+                    container.append(img)
+                yield True, fin
+            except Exception as e:
+                print(f"\nError packing file {fin}: {e}")
+                yield False, fin
+
 def calculate_stats(files : List[str], filter : List[str] = None) -> Tuple[Tuple[str], List[Dict[str, int]]]:
     """Calculate statistics for the multi-layer imagery files.
+    The statistics stored in the files (see ``phmImage.stats_metadata``) are used when they are valid, so the masks are not decoded.
 
     Args:
         files (List[str]): List of multi-layer imagery files
@@ -184,8 +210,12 @@ def calculate_stats(files : List[str], filter : List[str] = None) -> Tuple[Tuple
     
     for fin in files:
         try:
-            img = load_file(fin, filter)
-            sts = img.get_stats()
+            # The statistics stored in the file at save time are used when they match the layers
+            handler = build_by_file_extension(Path(fin).suffix[1:], filter)
+            info = handler.peek(fin)
+            sts = info.get_stats()
+            if sts is None:
+                sts = handler.load(fin).get_stats(pixcounts = info.get_pixcounts())
             yield list(sts.keys()), sts
         except Exception as e:
             print(f"\nError loading file {fin}")
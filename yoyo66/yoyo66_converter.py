@@ -17,7 +17,7 @@ from yoyo66.handler import (
     list_handler_names,
     get_file_extensions
 )
-from yoyo66.utils import convert_file__
+from yoyo66.utils import convert_file__, create_container
 
 create_out_filepath = lambda fin, fout, type : os.path.join(fout, f'{Path(os.path.basename(fin)).stem}.{get_file_extensions(type)[0]}')
 
@@ -43,7 +43,7 @@ def main__():
     
     parser.add_argument('-i', '--input', type = str, help = 'Filepath to the input file/directory. in case of directory mode, the input is a filter string like /home/phm/d*.xcf.')
     parser.add_argument('-o', '--output', default = os.getcwd(), type = str, help = 'Filepath to the output file/directory.')
-    parser.add_argument('-m', '--mode', default = 'file', choices = ['file', 'directory'], help = 'Determine the mode of given file/directory.')
+    parser.add_argument('-m', '--mode', default = 'file', choices = ['file', 'directory', 'container'], help = 'Determine the mode of given file/directory. In container mode, the input files are packed into one hdf5 file (the output).')
     parser.add_argument('-t', '--type', nargs = '?', choices = list_handler_names(), help = 'Determine the targeted file type. The file type is only used when the output is a directory')
     parser.add_argument('-c', '--classnames', type = str, nargs='*', help = 'Specify the list of class labels.')
     parser.add_argument('--override', action='store_false', help = 'Override mode prevent conversion when the output file has already exist if not set.')
@@ -91,6 +91,16 @@ def main__():
                 for res in pool.map(func, files):
                     bar.message = res[-1] + 'Successful' if res[0] else 'Failed'
                     bar.next()
+    elif args.mode == 'container':
+        if not outfile.endswith('.h5'):
+            print("output field must be a hdf5 file path (*.h5)")
+            return -1
+
+        files = glob.glob(infile)
+        with Bar(' Packing', max=len(files), suffix='%(percent)d%%') as bar:
+            for res in create_container(files, outfile, args.classnames):
+                bar.message = res[-1] + 'Successful' if res[0] else 'Failed'
+                bar.next()
 
 
 if __name__ == "__main__":